@@ -0,0 +1,42 @@
+"""
+Time per statement of ordinary assignment and call lines, which go through
+the keyword dispatch of the expression alternatives to assignment and
+simple_expr, with and without packrat memoization.
+Run from the repository root: python -m benchmarks.bench_dispatch
+"""
+import argparse
+import time
+
+import mxsp
+
+LINES = [
+    "a = b + 1", "print x", "foo x y:2", "c = sqrt (d * 2)", "append arr (f i)",
+    'n = getnodebyname "box01"', "x += 3", 'format "%\\n" v', "k = #(1, 2, 3)", "m = a[i] * 2"]
+
+
+def time_per_statement(text, statements, repeat):
+    """Best time of a parse of text, per statement"""
+    mxsp.file.parse(text)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        mxsp.file.parse(text)
+        best = min(best, time.perf_counter() - start)
+    return best / statements
+
+
+def main():
+    """Print the time per statement of the parse of ordinary lines"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--statements", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5, help="the best time of this many parses")
+    args = parser.parse_args()
+    text = "\n".join(LINES[i % len(LINES)] for i in range(args.statements))
+    for packrat in (False, True):
+        mxsp.PACKRAT = packrat
+        us = time_per_statement(text, args.statements, args.repeat) * 1e6
+        print(f"{'PACKRAT' if packrat else 'default'}: {us:.0f} us/statement")
+
+
+if __name__ == "__main__":
+    main()
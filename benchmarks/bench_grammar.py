@@ -0,0 +1,68 @@
+"""
+Parser objects built and time per statement of a file parse: the grammar
+combinators are built once, so a parse should not build any.
+Run from the repository root: python -m benchmarks.bench_grammar
+"""
+import argparse
+import time
+
+import parsec
+import mxsp
+
+# statements going through most productions (for loops with by, case,
+# struct, try, unary operators, references...)
+STATEMENTS = [
+    'for i = 1 to 10 by 2 do print i',
+    'if not a then b else c',
+    'fn f x y:1 = ( local z = x * 2; z )',
+    'struct S ( v = 1, fn m = v )',
+    'while i < 10 do i += 1',
+    'do ( i -= 1 ) while i > 0',
+    'case x of ( 1: print 1; default: print 2 )',
+    'try (f()) catch (print "e")',
+    'k = #(1, 2, 3); m = k[2] as string',
+    'p = [1, 2, 3]',
+    'n = $box01',
+    'c = -x',
+    'r = (a and b) or not c',
+    'g = &h',
+]
+
+
+def count_built(parse):
+    """Number of parser objects built while parse runs"""
+    built = [0]
+    init = parsec.Parser.__init__
+
+    def counting_init(self, *args, **kwargs):
+        built[0] += 1
+        init(self, *args, **kwargs)
+
+    parsec.Parser.__init__ = counting_init
+    try:
+        parse()
+    finally:
+        parsec.Parser.__init__ = init
+    return built[0]
+
+
+def main():
+    """Print the parsers built and the time per statement of a parse"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--statements", type=int, default=700)
+    parser.add_argument("--repeat", type=int, default=7, help="the best time of this many parses")
+    args = parser.parse_args()
+    text = "\n".join(STATEMENTS[i % len(STATEMENTS)] for i in range(args.statements))
+    statements = len(mxsp.file.parse(text)[1].args[0])
+    built = count_built(lambda: mxsp.file.parse(text))
+    best = float("inf")
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        mxsp.file.parse(text)
+        best = min(best, time.perf_counter() - start)
+    print(f"{statements} statements: {built} parsers built, "
+          f"{best / statements * 1e6:.0f} us per statement")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+"""
+Time of the tree walks of pytreeprocess (iterate_item, iterate_item_bfs,
+query) and of preprocess on deeply nested if/for/while blocks, each level
+holding 20 statements, under a low recursion limit.
+Run from the repository root: python -m benchmarks.bench_iterate
+"""
+import argparse
+import contextlib
+import io
+import sys
+import threading
+import time
+
+import mxsp
+import pytreeprocess as tp
+
+# the stack of the thread of the benchmark (for the parse of the deep sources)
+STACK_SIZE = 512 * 1024 * 1024
+
+
+def nested_source(depth):
+    """if/for/while blocks nested depth times, each holding 20 statements"""
+    body = "\n".join(f"print {i}" for i in range(20))
+    src = body
+    for level in range(depth):
+        if level % 3 == 0:
+            src = f"if a{level} then (\n{body}\n{src}\n)"
+        elif level % 3 == 1:
+            src = f"for i{level} in x do (\n{body}\n{src}\n)"
+        else:
+            src = f"while b{level} do (\n{body}\n{src}\n)"
+    return src
+
+
+def timed(fn):
+    """(result, seconds) of fn()"""
+    start = time.perf_counter()
+    res = fn()
+    return res, time.perf_counter() - start
+
+
+def run(depths, limit):
+    """Print the times of the walks at each depth"""
+    mxsp.STACKLESS = True
+    for depth in depths:
+        tree = mxsp.file.parse(nested_source(depth))[1]
+        outer = sys.getrecursionlimit()
+        sys.setrecursionlimit(limit)
+        try:
+            nodes, post = timed(lambda: sum(1 for _ in tp.iterate_item(tp.TreeItem(tree))))
+            _, bfs = timed(lambda: sum(1 for _ in tp.iterate_item_bfs(tp.TreeItem(tree))))
+            _, query = timed(lambda: tp.query([tp.filter_all], tp.TreeItem(tree)))
+            with contextlib.redirect_stderr(io.StringIO()):
+                _, preprocess = timed(lambda: tp.preprocess(tree))
+            print(f"depth {depth:4d} nodes {nodes:6d}  iterate_item {post:.3f}  "
+                  f"iterate_item_bfs {bfs:.3f}  query {query:.3f}  preprocess {preprocess:.3f}")
+        except RecursionError:
+            print(f"depth {depth:4d} RecursionError")
+        finally:
+            sys.setrecursionlimit(outer)
+
+
+def main():
+    """Print the times of the tree walks on deeply nested blocks"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("depths", nargs="*", type=int, default=[60, 120, 240, 480])
+    parser.add_argument("--recursion-limit", type=int, default=1000, help="during the walks")
+    args = parser.parse_args()
+    threading.stack_size(STACK_SIZE)
+    thread = threading.Thread(target=run, args=(args.depths, args.recursion_limit))
+    thread.start()
+    thread.join()
+
+
+if __name__ == "__main__":
+    main()
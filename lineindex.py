@@ -0,0 +1,52 @@
+"""
+Line index of a source text: the offsets where its lines start, so that
+the (line, column) of an offset is found by bisection instead of counting
+the newlines before it every time.
+The marks of the parsers, the comment blanking and the error reports share
+the index of the text they work on (see line_index).
+"""
+import bisect
+import re
+
+NEWLINE = re.compile("\n")
+
+# how many of the last indexed texts are kept indexed
+CACHED = 4
+
+
+class LineIndex:
+    """Offsets of the line starts of a text"""
+
+    def __init__(self, text):
+        self.text = text
+        self.starts = [0]
+        self.starts.extend(m.end() for m in NEWLINE.finditer(text))
+
+    def position(self, index):
+        """(line, column) of index"""
+        line = bisect.bisect_right(self.starts, index) - 1
+        return (line, index - self.starts[line])
+
+    def offset(self, line, col=0):
+        """Index of (line, col)"""
+        return self.starts[line] + col
+
+    def line(self, number):
+        """Text of a line (without its newline)"""
+        if number + 1 < len(self.starts):
+            return self.text[self.starts[number]:self.starts[number + 1] - 1]
+        return self.text[self.starts[number]:]
+
+
+_indexed = []
+
+
+def line_index(text):
+    """The LineIndex of text (shared with the last users of the same text)"""
+    for index in reversed(_indexed):
+        if index.text is text:
+            return index
+    index = LineIndex(text)
+    _indexed.append(index)
+    del _indexed[:-CACHED]
+    return index
@@ -10,7 +10,7 @@ from PySide6.QtWidgets import QApplication, QTextEdit, QSplitter, QMainWindow, Q
 
 from data import *
 
-from parsec import ParseError
+from lineindex import line_index
 import mxsp
 import pyout
 import mxscp
@@ -22,6 +22,10 @@ to_print = True
 initial_text2 = ''
 initial_text = ''
 
+# the parse of topy, only reparses the statements edited since the last text
+# and goes on past the statements that fail to parse
+file_parser = mxsp.IncrementalFile(recover=True)
+
 
 def preprocess(input_buf: str, filename: str) -> str:
 	"""
@@ -49,25 +53,27 @@ def preprocess(input_buf: str, filename: str) -> str:
 
 def topy(input_str, file_header=None, snippet=False):
 
-	comments = mxscp.anycomment.parse(input_str)
-	stripped = mxscp.blank_comments(input_str, comments)
-	parsed = mxsp.file.parse(stripped)
-	lines = stripped.split("\n")
-	num_lines = len(lines)
-	output = pyout.out_py(parsed[1], comments, file_header, snippet)
-	parsed_lines, dummy = parsed[2]
-	parsed_lines = parsed_lines + 1
+	scanned = mxscp.scan(input_str)
+	parsed = file_parser.parse(scanned.stripped)
+	output = pyout.out_py(parsed[1], scanned.comments, file_header, snippet)
 	error = None
-	if parsed_lines < num_lines:
-		error = f"partial parse parsed_lines = {parsed_lines}, num_lines = {num_lines} {parsed}\n"
-		to_reparse = '\n'.join(lines[parsed_lines:])
-		try:
-			mxsp.program_step.parse(to_reparse)
-		except ParseError as e:
-			error = f"{error}\n\n{e}\n\nin:\n\n<pre>{to_reparse}</pre>"
+	if file_parser.diagnostics:
+		error = f"partial parse, {len(file_parser.diagnostics)} statement(s) failed to parse\n"
+		for e in file_parser.diagnostics:
+			lines = line_index(e.text)
+			line, dummy = lines.position(e.index)
+			error = f"{error}\n\n{e}\n\nin:\n\n<pre>{lines.line(line)}</pre>"
 	return output, error
 
 
+def iter_topy(input_str, file_header=None, snippet=False):
+	"""Translate input_str as topy, giving the python of each top level
+	statement as soon as it is parsed and translated (the statements that
+	fail to parse are translated as error comments)"""
+	scanned = mxscp.scan(input_str)
+	yield from pyout.iter_py(mxsp.iter_file(scanned.stripped, recover=True), scanned.comments, file_header, snippet)
+
+
 class PythonHighlighter(QSyntaxHighlighter):
 	def __init__(self, parent=None):
 		super().__init__(parent)
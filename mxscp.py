@@ -5,78 +5,118 @@ is to leave the comments out of the syntax tree. Our first processing
 step consists in stripping out the comments but keeping the info or
 where they are in the original source file.
 """
-# pylint: disable=invalid-name, import-error, undefined-variable
-from parsec import *  # pylint: disable=wildcard-import, redefined-builtin, unused-wildcard-import, undefined-variable
+import re
+from lineindex import line_index
+import mxslex
 
 SINGLE = "SINGLE"
 MULTI = "MULTI"
 STRING = "STRING"
 OTHER = "OTHER"
 
-@mark
-@generate
-def singlecomment():
-    """parse a single mxs comment"""
-    c = yield regex(r"--.*$", re.MULTILINE)
-    return (SINGLE, c[2:])
-
-@mark
-@generate
-def multicomment():
-    """parse a multiline mxs comment"""
-    z = yield regex("/\\*.*?\\*/", re.MULTILINE | re.DOTALL)
-    return (MULTI, z[2:-2])
-
-@mark
-@generate
-def qstring():
-    '''Parse quoted string.'''
-    @generate
-    def normals():
-        body = yield regex(r'"([^"\\]|\\.)*"')
-        return body
-
-    @generate
-    def verbatims():
-        body = yield regex(r'@"[^"]*"')
-        return body
-
-    body = yield verbatims | normals
-
-    return (STRING, body)
-
-
-@mark
-@generate
-def other():
-    """Parse non commment section"""
-    o = yield regex('([^-/"@]|-(?!-)|/(?!\\*))*', re.MULTILINE | re.DOTALL)
-    return (OTHER, o)
-
-@generate
-def anycomment():
-    """Parse a comment, single or multiline"""
-    yield other
-    c = yield sepBy(
-        singlecomment^multicomment^qstring,
-        other)
-    yield other
-    return c
+# the text between the comments and strings: anything but the start of one
+OTHER_REGEX = re.compile(r'[^-/"@]*(?:(?:-(?!-)|/(?!\*))[^-/"@]*)*')
+
+# what blanking a comment replaces by a space
+NOT_NEWLINE = re.compile(r"[^\n]")
+
+# a comment or string (the first one that matches wins)
+COMMENT_REGEX = re.compile("|".join([
+    r"(?P<SINGLE>--[^\n]*)",
+    r"(?P<MULTI>/\*.*?\*/)",
+    r'(?P<STRING>@"[^"]*"|"(?:[^"\\]|\\[^\n])*")']), re.DOTALL)
+
+
+def scan_comments(inp):
+    """Find the comments and strings of inp in a single pass, as a list of
+    ((line, col), (kind, text), (line, col)); the scan stops where neither a
+    comment nor a string can be parsed (an unterminated string for instance)"""
+    position = line_index(inp).position
+    found = []
+    index = OTHER_REGEX.match(inp).end()
+    while True:
+        m = COMMENT_REGEX.match(inp, index)
+        if m is None:
+            return found
+        kind, text = m.lastgroup, m.group()
+        if kind == SINGLE:
+            text = text[2:]
+        elif kind == MULTI:
+            text = text[2:-2]
+        found.append((position(m.start()), (kind, text), position(m.end())))
+        index = OTHER_REGEX.match(inp, m.end()).end()
+
 
 def blank_comments(inp, comments):
-    """Replace comments by spaces"""
-    lines = inp.split('\n')
-
-    comments = list(filter(lambda c: c[1][0] in [SINGLE, MULTI], comments))
-
-    def blankline(line, number):
-        for c in comments:
-            (fl, fc) = c[0]
-            (tl, tc) = c[2]
-            if tl >= number >= fl:
-                f = fc if number == fl else 0
-                t = tc if number == tl else len(line)
-                line = line[0:f] + " " * (t-f) + line[t:]
-        return line
-
-    return '\n'.join([blankline(l, i) for i, l in enumerate(lines)])
+    """Replace comments by spaces (keeping their newlines)"""
+    lines = line_index(inp)
+    spans = sorted((lines.offset(*c[0]), lines.offset(*c[2]))
+                   for c in comments if c[1][0] in [SINGLE, MULTI])
+    buffer = list(inp)
+    for start, end in spans:
+        buffer[start:end] = NOT_NEWLINE.sub(" ", inp[start:end])
+    return "".join(buffer)
+
+
+class Scan:
+    """What the translation needs of a source, computed once per version of
+    the source: its comments and strings (for the formatter), the source
+    with the comments blanked (what is parsed) and the token table of the
+    blanked source, lexed by the windows that the parsers ask for (the
+    comments have to be blanked before lexing: a comment can start inside
+    what the lexer would take as one token)"""
+
+    def __init__(self, text):
+        self.text = text
+        self.comments = scan_comments(text)
+        self.stripped = blank_comments(text, self.comments)
+        self.table = {}
+        # the (start, end) ranges of stripped lexed in table, sorted and apart
+        self.lexed = []
+
+    def tokens(self, start=0, stop=None):
+        """The token table of the blanked source, lexed from start up to the
+        token that contains stop (only the parts not lexed before are: the
+        table has the tokens of the other windows too)"""
+        stop = len(self.stripped) if stop is None else min(stop, len(self.stripped))
+        lexed, position = [], start
+        for lexed_start, lexed_end in self.lexed:
+            if lexed_end < start or lexed_start > stop:
+                lexed.append((lexed_start, lexed_end))
+                continue
+            if position < lexed_start:
+                self.lex(position, lexed_start)
+            position = max(position, lexed_end)
+            start = min(start, lexed_start)
+        if position <= stop:
+            position = self.lex(position, stop)
+        lexed.append((start, position))
+        self.lexed = sorted(lexed)
+        return self.table
+
+    def lex(self, start, stop):
+        """Lex the blanked source in table from start up to the token that
+        contains stop: where the last token ends"""
+        tokens = mxslex.tokenize(self.stripped, start, stop)
+        self.table.update((token[1], token) for token in tokens)
+        return tokens[-1][2] if tokens else start
+
+
+_scanned = None
+
+
+def scan(text):
+    """The Scan of text (shared with the last user of the same text: only
+    the current version of the source is kept)"""
+    global _scanned  # pylint: disable=global-statement
+    if _scanned is None or _scanned.text != text:
+        _scanned = Scan(text)
+    return _scanned
+
+
+def stripped_tokens(stripped, start=0, stop=None):
+    """The token table of stripped from start to stop if it is the blanked
+    source of the current Scan (see Scan.tokens), None otherwise"""
+    if _scanned is not None and _scanned.stripped is stripped:
+        return _scanned.tokens(start, stop)
+    return None
@@ -0,0 +1,79 @@
+"""
+Lexing of maxscript source (once the comments have been blanked).
+A single regex pass splits the source in tokens. The grammar in mxsp
+looks the tokens up by position instead of re-scanning the characters
+each time it backtracks.
+"""
+import re
+
+KEYWORD = "KEYWORD"
+NAME = "NAME"
+QUOTED_NAME = "QUOTED_NAME"
+NUMBER = "NUMBER"
+TIME = "TIME"
+STRING = "STRING"
+MXSNAME = "MXSNAME"
+ARRAY_START = "ARRAY_START"
+BITARRAY_START = "BITARRAY_START"
+PATH_NAME = "PATH_NAME"
+OPERATOR = "OPERATOR"
+PUNCTUATION = "PUNCTUATION"
+SPACES = "SPACES"
+OTHER = "OTHER"
+
+# the reserved keywords (the words that mxsp.reserved parses)
+RESERVED_WORDS = (
+    "about", "and", "animate", "as", "at", "attributes", "by", "case", "catch",
+    "collect", "continue", "coordsys", "do", "else", "exit", "fn", "for", "from",
+    "function", "global", "if", "in", "local", "macroscript", "mapped", "max",
+    "not", "of", "off", "on", "or", "parameters", "persistent", "plugin", "rcmenu",
+    "return", "rollout", "set", "struct", "then", "throw", "to", "tool", "try",
+    "undo", "utility", "when", "where", "while", "with")
+RESERVED = frozenset(RESERVED_WORDS)
+
+_NUMBER = r"(([0-9]+)([.](?![.])[0-9]*)?|([.][0-9]+))([eE][+-]?[0-9]+)?[lL]?"
+_PATH_COMPONENT = r"('[^']*'|([A-Za-z0-9_\*\?\\]|(\.\.\.))*)"
+
+# order matters: the first group that matches wins
+TOKEN_REGEX = re.compile("|".join([
+    r"(?P<SPACES>[; \t\n\r\\]+)",
+    r"(?P<STRING>\"([^\"\\]|\\.)*\"|@\"[^\"]*\")",
+    r"(?P<WORD>[a-zA-Z_][a-zA-Z0-9_]*)",
+    r"(?P<QUOTED_NAME>'[^']*')",
+    r"(?P<HEX>0x[0-9a-fA-F]+)",
+    rf"(?P<TIME>({_NUMBER}[msft])+)",
+    rf"(?P<NUMBER>{_NUMBER})",
+    r"(?P<ARRAY_START>#\()",
+    r"(?P<BITARRAY_START>#\{)",
+    r"(?P<MXSNAME>#[a-zA-Z0-9_]+|#'[^']*')",
+    rf"(?P<PATH_NAME>\${_PATH_COMPONENT}(/{_PATH_COMPONENT})*)",
+    r"(?P<OPERATOR>==|!=|>=|<=|\+=|-=|\*=|/=|[-+*/^<>=&])",
+    r"(?P<PUNCTUATION>[()\[\]{},:.?#@])",
+    r"(?P<OTHER>.)"]), re.DOTALL)
+
+
+def iter_tokens(inp, start=0):
+    """Iterate over the (kind, start, end) tokens of inp from start"""
+    for m in TOKEN_REGEX.finditer(inp, start):
+        kind = m.lastgroup
+        if kind == "WORD":
+            kind = KEYWORD if m.group().lower() in RESERVED else NAME
+        elif kind == "HEX":
+            kind = NUMBER
+        yield kind, m.start(), m.end()
+
+
+def tokenize(inp, start=0, stop=None):
+    """Split inp in (kind, start, end) tokens, in a single pass (from start,
+    up to the token that contains stop)"""
+    tokens = []
+    for token in iter_tokens(inp, start):
+        if stop is not None and token[1] > stop:
+            break
+        tokens.append(token)
+    return tokens
+
+
+def token_table(inp, start=0, stop=None):
+    """Index the tokens of inp by start position"""
+    return {t[1]: t for t in tokenize(inp, start, stop)}
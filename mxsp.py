@@ -8,37 +8,199 @@ tree.
 Then the tree could be use to translate maxscript
 to python or for other purposes
 """
+import argparse
+import concurrent.futures
+import contextlib
+import copy
+import functools
+import os
 import re
 # pylint: disable=invalid-name, import-error, too-many-lines, unsupported-binary-operation, fixme, undefined-variable
 import sys
-from parsec import *  # pylint: disable=wildcard-import, redefined-builtin, unused-wildcard-import
+from stackparsec import *  # pylint: disable=wildcard-import, unused-wildcard-import
 import syntax as s
+import mxslex
+import mxscp
+from lineindex import line_index
 
 sys.setrecursionlimit(2500)
 
 
-###################################### HACK FOR DEBUGGING
-def logparser(nametext):
-	"""Decorate a parser for debugging"""
-	
-	def lp(p):
-		""" Make a parser as optional. If success, return the result, otherwise return
-		default_value silently, without raising any exception. If default_value is not
-		provided None is returned instead.
-		"""
-		
-		@Parser
-		def inner_parser(text, index):
+# ###### PROFILING
+# stackparsec.profiling() measures the productions (generate and stepped
+# parsers) of the parses run in its with block:
+#   python mxsp.py [--json] [--sort field] files...
+# prints the profile of the parse of the files.
+
+# ###### PER PARSE TABLES
+# A file parse first splits its text in tokens (see mxslex). The leaf
+# parsers that know how to, look the token at their index up instead of
+# running their regexes again on every backtrack.
+#
+# Some productions memoize their result for each (production, index) so
+# that backtracking over the ^ chains does not parse the same thing again
+# and again: the parenthesis blocks always, the hot productions when
+# PACKRAT is set.
+#
+# Both tables only live for the duration of a file parse.
+PACKRAT = False
+
+# When STACKLESS is set, a file parse runs the step forms of the parsers
+# (see stackparsec) with an explicit stack: the nesting depth is no more
+# limited by the recursion limit.
+STACKLESS = False
+
+# (text, {start: token}) of the running file parse
+_tokens = None
+
+# (text, {(production, index): result}) of the running file parse
+_memo = None
+
+
+def memoize(p):
+	"""Memoize the results of a production for the running file parse"""
+	
+	def handed_out(res):
+		if res.status and isinstance(res.value, s.Construct):
+			# program sets the location of its steps: every user of
+			# the result gets its own construct
+			return Value.success(res.index, copy.copy(res.value))
+		return res
+	
+	def memoize_parser(text, index):
+		if _memo is None or _memo[0] is not text:
+			return p(text, index)
+		table = _memo[1]
+		key = (p, index)
+		res = table.get(key)
+		if res is None:
 			res = p(text, index)
-			print(f"{nametext} {text[index:(index + 10)]} {index}")
-			return res
-		
-		return inner_parser
+			table[key] = res
+		return handed_out(res)
+	
+	def memoize_steps(text, index):
+		if _memo is None or _memo[0] is not text:
+			return (yield p, index)
+		table = _memo[1]
+		key = (p, index)
+		res = table.get(key)
+		if res is None:
+			res = yield p, index
+			table[key] = res
+		return handed_out(res)
+	
+	return Parser(memoize_parser, memoize_steps)
+
+
+def packrat(p):
+	"""Memoize the results of a production (only in packrat mode)"""
+	memoized = memoize(p)
+	
+	def packrat_parser(text, index):
+		return memoized(text, index) if PACKRAT else p(text, index)
+	
+	def packrat_steps(text, index):
+		return (yield memoized if PACKRAT else p, index)
 	
-	return lp
+	return Parser(packrat_parser, packrat_steps)
 
 
-###################################### HACK
+def lexed(fast, slow):
+	"""Make a parser that decides from the token table when there is one.
+	fast(token, text, index) gets the token starting at index (or None) and
+	returns the result, or None to let the character based slow parser decide"""
+	
+	@Parser
+	def lexed_parser(text, index):
+		if _tokens is not None and _tokens[0] is text:
+			res = fast(_tokens[1].get(index), text, index)
+			if res is not None:
+				return res
+		return slow(text, index)
+	
+	return lexed_parser
+
+
+# what may start a production that begins with a keyword
+LEADING_WORD = re.compile(r"[a-zA-Z0-9_]*")
+
+
+def dispatch(alternatives):
+	"""Make a try choice (^) of alternatives that only tries the ones that can
+	start with the word at index. alternatives() gives the (parser, keywords)
+	in trial order, keywords being None for a parser that can start with
+	anything (it is called on first use so that the grammar is complete).
+	The last alternative is always tried so that a failure is the one of the
+	full choice."""
+	table = {}
+	
+	def build():
+		parsers = alternatives()
+		*heads, (last, _) = parsers
+		
+		def choices(word):
+			return try_choices(*[p for p, kws in heads if kws is None or word in kws], last)
+		
+		table[None] = try_choices(*[p for p, _ in parsers])
+		table[""] = choices("")
+		for _, kws in heads:
+			for kw in kws or ():
+				table[kw] = choices(kw)
+	
+	def choices_at(text, index):
+		if not table:
+			build()
+		if index < len(text) and text[index] in "; \t\n\r\\":
+			# spaces before an optional keyword
+			return table[None]
+		word = LEADING_WORD.match(text, index).group().lower()
+		return table.get(word, table[""])
+	
+	def dispatch_parser(text, index):
+		return choices_at(text, index)(text, index)
+	
+	def dispatch_steps(text, index):
+		return (yield choices_at(text, index), index)
+	
+	return Parser(dispatch_parser, dispatch_steps)
+
+
+@contextlib.contextmanager
+def parse_tables(text, start=0, stop=None, tokens=None):
+	"""Install the token (of text from start to stop, unless the tokens table
+	is given, taken from the mxscp.Scan whose blanked source text is) and
+	memo tables of a parse"""
+	global _tokens, _memo  # pylint: disable=global-statement
+	outer = (_tokens, _memo)
+	if tokens is None:
+		tokens = mxscp.stripped_tokens(text, start, stop)
+	if tokens is None:
+		tokens = mxslex.token_table(text, start, stop)
+	_tokens = (text, tokens)
+	_memo = (text, {})
+	try:
+		yield
+	finally:
+		_tokens, _memo = outer
+
+
+def run_parser(p, text, index):
+	"""Run p at index, with the explicit stack if STACKLESS"""
+	if STACKLESS:
+		return run(p, text, index)
+	return p(text, index)
+
+
+def per_parse(p):
+	"""Give a parser its own token and memo tables, freed when it returns"""
+	
+	@Parser
+	def per_parse_parser(text, index):
+		with parse_tables(text):
+			return run_parser(p, text, index)
+	
+	return per_parse_parser
+
 
 lparen = string('(')
 rparen = string(')')
@@ -51,6 +213,12 @@ comma = string(',')
 true = string('true').result(True)
 false = string('false').result(False)
 null = string('null').result(None)
+hash_sign = string("#")
+dollar = string("$")
+slash = string("/")
+minus = string("-")
+ampersand = string("&")
+equals = string("=")
 
 
 def st(t):
@@ -58,6 +226,7 @@ def st(t):
 	return lambda x: s.Construct(t, x)
 
 
+@functools.lru_cache(maxsize=None)
 def number():
 	"""Parse number."""
 	return regex(
@@ -65,65 +234,103 @@ def number():
 	).parsecmap(st(s.NUMBER))
 
 
+@functools.lru_cache(maxsize=None)
 def intnumber():
 	"""Parse integer number."""
 	return regex(r'-?[1-9][0-9]*[lL]?').parsecmap(st(s.NUMBER))
 
 
+@functools.lru_cache(maxsize=None)
 def hexnumber():
 	"""parse a hex number"""
 	return regex(r'0x[0-9a-fA-F]+').parsecmap(st(s.NUMBER))
 
 
+@functools.lru_cache(maxsize=None)
 def question():
 	"""Parse number."""
 	return regex(r'\?').parsecmap(st(s.QUESTION))
 
 
+normal_string = regex(r'"([^"\\]|\\.)*"')
+verbatim_string = regex(r'@"[^"]*"')
+
+
+@generate
+def verbatim():
+	"""parse a verbatim string (as a normal one)"""
+	body = yield verbatim_string
+	body = body.replace("\\", "\\\\")
+	return body[1:]
+
+
+quoted_alternatives = normal_string | verbatim
+
+
 @generate
 def quoted():
 	"""Parse quoted string."""
-	
-	@generate
-	def normal():
-		body = yield regex(r'"([^"\\]|\\.)*"')
-		return body
-	
-	@generate
-	def verbatim():
-		body = yield regex(r'@"[^"]*"')
-		body = body.replace("\\", "\\\\")
-		return body[1:]
-	
-	body = yield normal | verbatim
+	body = yield quoted_alternatives
 	
 	return s.Construct(s.STRING, body[1:-1])
 
 
+@functools.lru_cache(maxsize=None)
 def reserved():
 	"""Parse a reserved keyword"""
-	# pylint: disable=line-too-long
-	return regex(
-		"(about|and|animate|as|at|attributes|by|case|catch|collect|continue|coordsys|do|else|exit|fn|for|from|function|global|if|in|local|macroscript|mapped|max|not|of|off|on|or|parameters|persistent|plugin|rcmenu|return|rollout|set|struct|then|throw|to|tool|try|undo|utility|when|where|while|with)(?![a-zA-Z0-9_])",
-		re.IGNORECASE)
+	return regex(f"({'|'.join(mxslex.RESERVED_WORDS)})(?![a-zA-Z0-9_])", re.IGNORECASE)
 
 
+@functools.lru_cache(maxsize=None)
 def nonkwchar():
 	"""parse a character that cannot be part of a keyword"""
 	return regex("[^a-zA-Z0-9_]")
 
 
-def keyword(kw):
-	"""parse a keyword"""
-	return ends_with(regex(kw, re.IGNORECASE), nonkwchar())
+# failure of a keyword that is not followed by a nonkwchar
+NONKWCHAR_FAILURE = "ends with [^a-zA-Z0-9_]"
+
+# keywords that the token table can answer (plain alternatives of words)
+PLAIN_KEYWORDS = re.compile(r"\([a-zA-Z_|]+\)|[a-zA-Z_|]+")
 
 
+@functools.lru_cache(maxsize=None)
+def keyword(kw):
+	"""parse a keyword"""
+	slow = ends_with(regex(kw, re.IGNORECASE), nonkwchar())
+	if PLAIN_KEYWORDS.fullmatch(kw) is None:
+		return slow
+	alternatives = kw.strip("()").lower().split("|")
+	
+	def fast(tok, text, index):
+		# same results as the regex (including the failures)
+		if tok is None or tok[0] == mxslex.OTHER:
+			return None
+		if tok[0] not in (mxslex.KEYWORD, mxslex.NAME):
+			return Value.failure(index, kw)
+		end = tok[2]
+		if end < len(text) and not text[end].isascii():
+			return None
+		word = text[index:end]
+		lword = word.lower()
+		for alternative in alternatives:
+			if lword.startswith(alternative):
+				if index + len(alternative) == end < len(text):
+					return Value.success(end, word)
+				return Value.failure(index + len(alternative), NONKWCHAR_FAILURE)
+		return Value.failure(index, kw)
+	
+	return lexed(fast, slow)
+
+
+@functools.lru_cache(maxsize=None)
 def on_value():
 	"""parse the mxs on"""
 	# note: in maxscript on & off are special... they are keywords (contrary to undefined, ...)
 	return keyword("on")
 
 
+@functools.lru_cache(maxsize=None)
 def off_value():
 	"""parse the mxs off"""
 	# note: in maxscript on & off are special... they are keywords (contrary to undefined, ...)
@@ -132,21 +339,34 @@ def off_value():
 
 # ###### SPACES
 
+@functools.lru_cache(maxsize=None)
 def singlelinespaces1():
 	"""normalspaces with no newlines"""
 	return regex("[ \t]+")
 
 
+@functools.lru_cache(maxsize=None)
 def singlelinespaces():
 	"""normalspaces with no newlines"""
 	return regex(r"([ \t]*(\\.*\n)?)*", re.MULTILINE)
 
 
+@functools.lru_cache(maxsize=None)
 def normalspaces():
 	"""parse spaces including newlines"""
-	return regex(r"[; \t\n\r\\]*", re.MULTILINE)
+	return lexed(normalspaces_token, regex(r"[; \t\n\r\\]*", re.MULTILINE))
 
 
+def normalspaces_token(tok, text, index):
+	"""normalspaces from the token table"""
+	if tok is None:
+		return None
+	if tok[0] == mxslex.SPACES:
+		return Value.success(tok[2], text[index:tok[2]])
+	return Value.success(index, "")
+
+
+@functools.lru_cache(maxsize=None)
 def statementsep():
 	"""statement separator"""
 	return regex("[;\n\r]")
@@ -154,15 +374,44 @@ def statementsep():
 
 # ################### LITERALS
 
+VAR_NAME_REGEX = "(::)?('[^']+'|[a-zA-Z_][a-zA-Z0-9_]*)(?!:)"
+
+
+@functools.lru_cache(maxsize=None)
 def var_name():
 	"""var_name"""
-	return (
+	return lexed(var_name_token, (
 			on_value() ^
 			off_value() ^
-			exclude(regex("(::)?('[^']+'|[a-zA-Z_][a-zA-Z0-9_]*)(?!:)"),
-					reserved())).parsecmap(st(s.VAR_NAME))
+			exclude(regex(VAR_NAME_REGEX),
+					reserved())).parsecmap(st(s.VAR_NAME)))
 
 
+def var_name_token(tok, text, index):
+	"""var_name from the token table (same results as the regexes)"""
+	if tok is None or tok[0] == mxslex.OTHER or text[index] in ":'":
+		return None
+	if tok[0] not in (mxslex.KEYWORD, mxslex.NAME):
+		return Value.failure(index, VAR_NAME_REGEX)
+	end = tok[2]
+	if end < len(text) and not text[end].isascii():
+		return None
+	name = text[index:end]
+	if tok[0] == mxslex.KEYWORD:
+		# on and off are names (if followed by something)
+		if name.lower() in ("on", "off") and end < len(text):
+			return Value.success(end, s.Construct(s.VAR_NAME, name))
+		return Value.failure(index, f"something other than {name}")
+	if end < len(text) and text[end] == ":":
+		# the regex backtracks to a name not followed by :
+		if len(name) == 1:
+			return Value.failure(index, VAR_NAME_REGEX)
+		end = end - 1
+		name = name[:-1]
+	return Value.success(end, s.Construct(s.VAR_NAME, name))
+
+
+@functools.lru_cache(maxsize=None)
 def named_arg_var_name():
 	"""var_name"""
 	return (
@@ -171,44 +420,62 @@ def named_arg_var_name():
 		regex("[a-zA-Z_][a-zA-Z0-9_]*(?=:)")).parsecmap(st(s.VAR_NAME))
 
 
+unquoted_mxsname_regex = regex("#[a-zA-Z0-9_]+")
+quoted_mxsname_regex = regex("#'[^']*'")
+
+
+@generate
+def unquoted_mxsname():
+	"""unquoted name"""
+	name = yield unquoted_mxsname_regex
+	return s.Construct(s.NAME, name[1:])
+
+
+@generate
+def quoted_mxsname():
+	"""quoted name"""
+	name = yield quoted_mxsname_regex
+	return s.Construct(s.NAME, name[2:-1])
+
+
+mxsname_alternatives = unquoted_mxsname | quoted_mxsname
+
+
 @generate
 def mxsname():
 	"""name"""
-	
-	@generate
-	def unquoted_mxsname():
-		name = yield regex("#[a-zA-Z0-9_]+")
-		return s.Construct(s.NAME, name[1:])
-	
-	@generate
-	def quoted_mxsname():
-		name = yield regex("#'[^']*'")
-		return s.Construct(s.NAME, name[2:-1])
-	
-	ret = yield unquoted_mxsname | quoted_mxsname
+	ret = yield mxsname_alternatives
 	return ret
 
 
+time_unit = regex("[msft]")
+
+
+@generate
+def tv():
+	"""parse a time value and its unit"""
+	num = yield number()
+	unit = yield time_unit
+	return f"{num.args[0]}{unit}"
+
+
+time_values = many1(tv)
+
+
 @generate
 def time():
 	"""parse a mxs time"""
-	
-	@generate
-	def tv():
-		# pylint: disable=redefined-outer-name
-		num = yield number()
-		unit = yield regex("[msft]")
-		return f"{num.args[0]}{unit}"
-	
-	tvs = yield many1(tv)
+	tvs = yield time_values
 	return s.Construct(s.TIME, "".join(tvs))
 
 
+@functools.lru_cache(maxsize=None)
 def smptetime():
 	"""parse a smpte time"""
 	return regex(r"-?[0-9]+:[0-9]+\.[0-9]+").parsecmap(st(s.SMPTE_TIME))
 
 
+@functools.lru_cache(maxsize=None)
 def listsep():
 	"""list separator"""
 	return regex("[ \t\n\r;]*,[ \t\n\r;]*")
@@ -262,175 +529,178 @@ def point4():
 @generate
 def array():
 	"""parse an array"""
-	yield string("#")
+	yield hash_sign
 	yield normalspaces()
-	yield string("(")
+	yield lparen
 	yield normalspaces()
-	values = yield sepBy(expression, listsep())
+	values = yield array_values
 	yield normalspaces()
 	yield rparen
 	return s.Construct(s.ARRAY, values)
 
 
+bitarray_to_start = string("")
+
+
+@generate
+def bitarray_to():
+	"""parse the end of a bitarray range"""
+	yield bitarray_to_start
+	yield normalspaces()
+	toexpr = yield expression
+	return toexpr
+
+
+@generate
+def bitarray_range():
+	"""parse a bitarray range"""
+	fromexpr = yield expression
+	yield normalspaces()
+	toexpr = yield optional_bitarray_to
+	return s.Construct(s.BITARRAY_RANGE, fromexpr, toexpr)
+
+
+optional_bitarray_to = optional(bitarray_to)
+bitarray_ranges = sepBy(bitarray_range, listsep())
+
+
 @generate
 def bitarray():
-	# pylint: disable=unused-variable
 	"""parse a bitarray"""
-	
-	@generate
-	def bitarray_number():
-		ret = yield (number() ^
-					 property_ref |
-					 expr_seq
-					 # ??? ? last listener result (OMG!!) ==> could be shimmed in python if true
-					 )
-		return ret
-	
-	@generate
-	def bitarray_to():
-		yield string("")
-		yield normalspaces()
-		toexpr = yield expression
-		return toexpr
-	
-	@generate
-	def bitarray_range():
-		fromexpr = yield expression
-		yield normalspaces()
-		toexpr = yield optional(bitarray_to)
-		return s.Construct(s.BITARRAY_RANGE, fromexpr, toexpr)
-	
-	yield string("#")
+	yield hash_sign
 	yield normalspaces()
-	yield string("{")
+	yield lbrace
 	yield normalspaces()
-	values = yield sepBy(bitarray_range, listsep())
+	values = yield bitarray_ranges
 	yield normalspaces()
 	yield rbrace
 	return s.Construct(s.BITARRAY, values)
 
 
+# the last part of this is a big hack of something that needs to be revisiter for sample 268
+path_name_components = sepBy(regex(r"'[^']*'|([A-Za-z0-9_\*\?\\]|(\.\.\.))*"), slash)
+
+
 @generate
 def path_name():
 	"""parse a pathname, the thing that starts with a $"""
-	# the last part of this is a big hack of something that needs to be revisiter for sample 268
-	name_component = regex(r"'[^']*'|([A-Za-z0-9_\*\?\\]|(\.\.\.))*")
-	yield string("$")
-	components = yield sepBy(name_component, string("/"))
+	yield dollar
+	components = yield path_name_components
 	pn = "$" + "/".join(components)
 	return s.Construct(s.PATH_NAME, pn)
 
 
 # ################# FUNCTIONS
 @generate
+def unary_minus():
+	"""parse a unary minus"""
+	yield minus
+	yield normalspaces()
+	expr = yield expression
+	return s.Construct(s.UNARY_MINUS, expr)
+
+
+@generate
+def unary_not():
+	"""parse a unary not"""
+	yield keyword("not")
+	yield normalspaces()
+	expr = yield expression
+	return s.Construct(s.UNARY_NOT, expr)
+
+
+@packrat
+@generate
 def factor():
 	"""parse a factor"""
-	
-	@generate
-	def unary_minus():
-		yield string("-")
-		yield normalspaces()
-		expr = yield expression
-		return s.Construct(s.UNARY_MINUS, expr)
-	
-	@generate
-	def unary_not():
-		yield keyword("not")
-		yield normalspaces()
-		expr = yield expression
-		return s.Construct(s.UNARY_NOT, expr)
-	
-	ret = yield (hexnumber() ^
-				 time ^
-				 smptetime() ^
-				 number() |
-				 quoted |
-				 path_name |
-				 var_name() |
-				 mxsname ^
-				 array ^
-				 bitarray ^
-				 point4 ^
-				 point3 ^
-				 point2 ^
-				 unary_minus ^
-				 unary_not ^
-				 expr_seq
-				 )
+	ret = yield factor_alternatives
 	return ret
 
 
+# This looks like a hack, but I don't think you can take the
+# reference of an arbitrary expression in maxscript, i.e. this is an error
+# zzz = 3
+# 3
+# fn getzzz = (return zzz)
+# getzzz()
+# getzzz ()
+# 3
+# &(getzzz())
+# but weirdly &(abc[3]) needs to work
+@generate
+def parenthesized_property_ref():
+	"""parse a parenthesized property ref (that can be referenced)"""
+	yield lparen
+	yield normalspaces()
+	pr = yield referenceable_property
+	yield normalspaces()
+	yield rparen
+	return pr
+
+
+@generate
+def unary_reference():
+	"""parse a reference"""
+	yield ampersand
+	yield normalspaces()
+	expr = yield referenceable_property
+	return s.Construct(s.REFERENCE, expr)
+
+
+@packrat
 @generate
 def operand():
 	"""parse an operand"""
-	
-	# This looks like a hack, but I don't think you can take the
-	# reference of an arbitrary expression in maxscript, i.e. this is an error
-	# zzz = 3
-	# 3
-	# fn getzzz = (return zzz)
-	# getzzz()
-	# getzzz ()
-	# 3
-	# &(getzzz())
-	# but weirdly &(abc[3]) needs to work
-	@generate
-	def parenthesized_property_ref():
-		yield string("(")
-		yield normalspaces()
-		pr = yield property_ref ^ parenthesized_property_ref
-		yield normalspaces()
-		yield string(")")
-		return pr
-	
-	@generate
-	def unary_reference():
-		yield string("&")
-		yield normalspaces()
-		expr = yield property_ref ^ parenthesized_property_ref
-		return s.Construct(s.REFERENCE, expr)
-	
 	# simple values that can be used as function args
-	ret = yield (
-			property_ref ^
-			unary_reference ^
-			factor
-		# index (this is included in property_ref the way we do it here)
-	)
+	ret = yield operand_alternatives
 	return ret
 
 
+optional_reference = optional(ampersand)
+
+
+@generate
+def argument_def():
+	"""parse an argument definition"""
+	ref = yield optional_reference
+	vn = yield var_name()
+	return s.Construct(s.ARGUMENT, vn, ref)
+
+
+@generate
+def named_argument_value():
+	"""parse the default value of a named argument definition"""
+	yield normalspaces()
+	value = yield operand
+	return value
+
+
+optional_named_argument_value = optional(named_argument_value)
+
+
+@generate
+def named_argument_def():
+	"""parse a named argument definition"""
+	ref = yield optional_reference
+	iden = yield named_arg_var_name()
+	yield colon
+	value = yield optional_named_argument_value
+	return s.Construct(s.NAMED_ARGUMENT, iden, value, ref)
+
+
+argument_defs = sepBy((named_argument_def ^ argument_def), normalspaces())
+
+
 @generate
 def function_def():
 	"""Parse function definition"""
-	
-	@generate
-	def argument_def():
-		ref = yield optional(string("&"))
-		vn = yield var_name()
-		return s.Construct(s.ARGUMENT, vn, ref)
-	
-	@generate
-	def named_argument_def():
-		@generate
-		def optional_value():
-			yield normalspaces()
-			value = yield operand
-			return value
-		
-		ref = yield optional(string("&"))
-		iden = yield named_arg_var_name()
-		yield string(":")
-		value = yield optional(optional_value)
-		return s.Construct(s.NAMED_ARGUMENT, iden, value, ref)
-	
 	yield keyword("fn|function")
 	yield normalspaces()
 	fname = yield var_name()
 	yield normalspaces()
-	fargs = yield sepBy((named_argument_def ^ argument_def), normalspaces())
+	fargs = yield argument_defs
 	yield normalspaces()
-	yield string("=")
+	yield equals
 	yield normalspaces()
 	funexpr = yield expression
 	return s.Construct(s.FUNCTION_DEF, fname, fargs, funexpr)
@@ -440,254 +710,373 @@ def function_def():
 def named_argument():
 	"""parse a named argument"""
 	iden = yield named_arg_var_name()
-	yield string(":")
+	yield colon
 	yield singlelinespaces()
 	value = yield operand
 	return s.Construct(s.NAMED_ARGUMENT, iden, value)
 
 
 @generate
-def function_call():
-	"""Parse a function call"""
-	
-	@generate
-	def no_parameters():
-		yield string("(")
-		yield singlelinespaces()
-		yield string(")")
-		return []
-	
-	@generate
-	def parameters():
-		fargs = yield sepBy1((named_argument ^ operand), singlelinespaces())
-		return fargs
-	
-	# pylint: disable=comparison-with-callable
-	fname = yield property_ref < regex(r"(?!(\-| *- ))")
+def no_parameters():
+	"""parse the empty parameters of a call"""
+	yield lparen
 	yield singlelinespaces()
-	fargs = yield no_parameters ^ parameters
-	return s.Construct(s.CALL, fname, fargs)
+	yield rparen
+	return []
+
+
+@generate
+def parameters():
+	"""parse the parameters of a call"""
+	fargs = yield parameter_list
+	return fargs
+
+
+parameter_list = sepBy1((named_argument ^ operand), singlelinespaces())
+# the name is not followed by a minus
+not_minus = regex(r"(?!(\-| *- ))")
+
+
+call_parameters_alternatives = no_parameters ^ parameters
+
+
+@generate
+def call_parameters():
+	"""Parse the parameters that follow the name of a function call"""
+	yield not_minus
+	yield singlelinespaces()
+	fargs = yield call_parameters_alternatives
+	return fargs
+
+
+@generate
+def return_value():
+	"""parse the value of a function return"""
+	yield normalspaces()
+	value = yield expression
+	return value
+
+
+optional_return_value = optional(return_value)
 
 
 @generate
 def function_return():
 	"""parse a function return"""
-	
-	@generate
-	def optional_value():
-		yield normalspaces()
-		value = yield expression
-		return value
-	
 	yield keyword("return")
-	value = yield optional(optional_value)
+	value = yield optional_return_value
 	return s.Construct(s.FUNCTION_RETURN, value)
 
 
 # ################ variable_decl (note these are NOT expressions)
 
+@generate
+def var_assignment():
+	"""parse a declared variable and its value"""
+	localiden = yield var_name()
+	yield normalspaces()
+	yield equals
+	yield normalspaces()
+	value = yield expression
+	return s.Construct(s.DECL, localiden, value)
+
+
+@generate
+def declaration():
+	"""parse a declared variable"""
+	localiden = yield var_name()
+	return s.Construct(s.DECL, localiden, None)
+
+
+decl_alternatives = var_assignment ^ declaration
+
+
 @generate
 def decl():
 	"""parse a decl"""
-	
-	@generate
-	def var_assignment():
-		localiden = yield var_name()
-		yield normalspaces()
-		yield string("=")
-		yield normalspaces()
-		value = yield expression
-		return s.Construct(s.DECL, localiden, value)
-	
-	@generate
-	def declaration():
-		localiden = yield var_name()
-		return s.Construct(s.DECL, localiden, None)
-	
-	v = yield var_assignment ^ declaration
+	v = yield decl_alternatives
 	return v
 
 
+@generate
+def persistent_global_scope():
+	"""parse a persistent global scope"""
+	yield keyword("persistent")
+	yield normalspaces()
+	yield keyword("global")
+	return s.Construct(s.PERSISTENTGLOBAL)
+
+
+@generate
+def global_scope():
+	"""parse a global scope"""
+	yield keyword("global")
+	return s.Construct(s.GLOBAL)
+
+
+@generate
+def local_scope():
+	"""parse a local scope"""
+	yield keyword("local")
+	return s.Construct(s.LOCAL)
+
+
+scope_alternatives = (
+		persistent_global_scope ^
+		global_scope ^
+		local_scope)
+
+
+@generate
+def scope_def():
+	"""parse a scope"""
+	sdef = yield scope_alternatives
+	return sdef
+
+
+decl_list = sepBy1(
+	decl,  # optional_assignment if scope else assignment,
+	listsep())
+
+
 @generate
 def variable_decl():
 	"""parse a variable decl"""
-	
-	@generate
-	def persistent_global_scope():
-		yield keyword("persistent")
-		yield normalspaces()
-		yield keyword("global")
-		return s.Construct(s.PERSISTENTGLOBAL)
-	
-	@generate
-	def global_scope():
-		yield keyword("global")
-		return s.Construct(s.GLOBAL)
-	
-	@generate
-	def local_scope():
-		yield keyword("local")
-		return s.Construct(s.LOCAL)
-	
-	@generate
-	def scope_def():
-		sdef = yield (
-				persistent_global_scope ^
-				global_scope ^
-				local_scope)
-		return sdef
-	
 	# parsing (if there is no scope, it not a decl it an assignment)
 	scope = yield scope_def
 	yield normalspaces()
-	assignments = yield sepBy1(
-		decl,  # optional_assignment if scope else assignment,
-		listsep())
+	assignments = yield decl_list
 	
 	return s.Construct(s.VARIABLE_DECL, scope, assignments)
 
 
 # ################# Assignment
 
+assignment_operator = regex(r"(=|\+=|-=|\*=|/=)")
+
+
 @generate
 def assignment():
 	"""parse and assignment"""
 	prop = yield property_ref
 	yield normalspaces()
-	oper = yield regex(r"(=|\+=|-=|\*=|/=)")
+	oper = yield assignment_operator
 	yield normalspaces()
 	val = yield expression
 	return s.Construct(s.ASSIGNMENT, prop, oper, val)
 
 
 # ################# STRUCTS
+@generate
+def struct_assignment():
+	"""parse a struct member and its value"""
+	localiden = yield var_name()
+	yield normalspaces()
+	yield equals
+	yield normalspaces()
+	value = yield expression
+	return s.Construct(s.STRUCT_MEMBER_ASSIGN, localiden, value)
+
+
+@generate
+def struct_declaration():
+	"""parse a struct member"""
+	localiden = yield var_name()
+	return s.Construct(s.STRUCT_MEMBER_DATA, localiden)
+
+
+@generate
+def struct_method():
+	"""parse a struct method"""
+	fcn = yield function_def
+	return s.Construct(s.STRUCT_MEMBER_METHOD, fcn)
+
+
+optional_visibility = optional(keyword("private|public"))
+
+
+@generate
+def struct_member():
+	"""parse a struct member"""
+	yield optional_visibility
+	yield normalspaces()
+	v = yield struct_member_alternatives
+	return v
+
+
+struct_members = sepBy1(
+	struct_member,
+	listsep()
+)
+
+
 @generate
 def struct_def():
 	"""parse a struct def"""
-	
-	@generate
-	def struct_assignment():
-		localiden = yield var_name()
-		yield normalspaces()
-		yield string("=")
-		yield normalspaces()
-		value = yield expression
-		return s.Construct(s.STRUCT_MEMBER_ASSIGN, localiden, value)
-	
-	@generate
-	def declaration():
-		localiden = yield var_name()
-		return s.Construct(s.STRUCT_MEMBER_DATA, localiden)
-	
-	@generate
-	def fcn():
-		fcn = yield function_def
-		return s.Construct(s.STRUCT_MEMBER_METHOD, fcn)
-	
-	@generate
-	def member():
-		yield optional(keyword("private|public"))
-		yield normalspaces()
-		v = yield struct_assignment ^ on_do_handler ^ declaration ^ fcn
-		return v
-	
 	yield keyword("struct")
 	yield normalspaces()
 	name = yield var_name()
 	yield normalspaces()
 	yield lparen
 	yield normalspaces()
-	members = yield sepBy1(
-		member,
-		listsep()
-	)
+	members = yield struct_members
 	yield normalspaces()
 	yield rparen
 	
 	return s.Construct(s.STRUCT_DEF, name, members)
 
 
+@functools.lru_cache(maxsize=None)
+def member_name():
+	"""member_name"""
+	return regex("[a-zA-Z_][a-zA-Z0-9_]*").parsecmap(st(s.VAR_NAME))
+
+
+quoted_member_name_regex = regex("'.*'")
+
+
+@generate
+def quoted_member_name():
+	"""quoted member_name"""
+	name = yield quoted_member_name_regex
+	return s.Construct(s.VAR_NAME, name[1:-1])
+
+
+member_prefix = string("core")
+member_accessor_name = quoted_member_name ^ member_name()
+
+
+@generate
+def member_accessor():
+	"""parse a member accessor"""
+	yield member_prefix
+	yield normalspaces()
+	iden = yield member_accessor_name
+	return s.Construct(s.PROPERTY_ACCESSOR_MEMBER, iden)
+
+
+@generate
+def index_accessor():
+	"""parse an index accessor"""
+	yield lbrack
+	yield normalspaces()
+	expr = yield expression
+	yield normalspaces()
+	yield rbrack
+	return s.Construct(s.PROPERTY_ACCESSOR_INDEX, expr)
+
+
+accessor_alternatives = (
+		member_accessor |
+		index_accessor
+)
+
+
+@generate
+def accessor():
+	"""parse a property accessor"""
+	acc = yield accessor_alternatives
+	return acc
+
+
+accessor_list = sepBy1(accessor, normalspaces())
+
+
+@generate
+def accessors():
+	"""parse the accessors following the root of a property"""
+	yield normalspaces()
+	indexing = yield accessor_list
+	return indexing
+
+
+@generate
+def parenthesized_subscriptable_property():
+	"""parse a property of a parenthesized simple_expr (the slow way)"""
+	yield lparen
+	yield normalspaces()
+	se = yield simple_expr
+	yield normalspaces()
+	yield rparen
+	indexing = yield accessors
+	return s.Construct(s.PROPERTY, se, indexing)
+
+
+@memoize
+@stepped
+def parenthesized(text, index):
+	"""parse an expr_seq and the accessors that may follow it: this gives the
+	property of which it is the root if there are accessors, else the expr_seq.
+	The parenthesis block is parsed once whatever it turns out to be."""
+	seq = yield expr_seq, index
+	if not seq.status:
+		return seq
+	indexing = yield accessors, seq.index
+	if not indexing.status:
+		return seq
+	steps = seq.value.args[0].args[0]
+	if len(steps) == 1 and steps[0].construct not in STATEMENT_CONSTRUCTS:
+		# the single step is what simple_expr gives (all the other
+		# expression alternatives give statements)
+		root = copy.copy(steps[0])
+		root.set_start_end(None, None)
+		return Value.success(indexing.index, s.Construct(s.PROPERTY, root, indexing.value))
+	# only a parenthesized simple_expr can be subscripted
+	prop = yield parenthesized_subscriptable_property, index
+	return prop if prop.status else seq
+
+
+not_subscripted = fail_with("a subscripted parenthesis")
+
+
+@generate
+def parenthesized_property():
+	"""parse a property whose root is parenthesized"""
+	prop = yield parenthesized
+	if prop.construct != s.PROPERTY:
+		return not_subscripted
+	return prop
+
+
+property_root = var_name() | path_name
+
+
+@generate
+def nestedproperty():
+	"""parse a property with accessors"""
+	# note: a parenthesized root is handled by parenthesized_property where
+	# the accessors are optional postfix operators of the parenthesis block
+	root = yield property_root
+	indexing = yield accessors
+	return s.Construct(s.PROPERTY, root, indexing)
+
+
+@generate
+def simpleproperty():
+	"""parse a property without accessors"""
+	iden = yield var_name()
+	return s.Construct(s.PROPERTY, iden, None)
+
+
+# this is wrong but will require more cleanup
+property_alternatives = (
+		nestedproperty ^
+		parenthesized_property ^
+		simpleproperty)
+
+
+@packrat
 @generate
 def property_ref():
 	"""parse a property ref"""
-	
-	def member_name():
-		"""member_name"""
-		return regex("[a-zA-Z_][a-zA-Z0-9_]*").parsecmap(st(s.VAR_NAME))
-	
-	@generate
-	def quoted_member_name():
-		"""quoted member_name"""
-		name = yield regex("'.*'")
-		return s.Construct(s.VAR_NAME, name[1:-1])
-	
-	@generate
-	def member_accessor():
-		yield string("core")
-		yield normalspaces()
-		iden = yield quoted_member_name ^ member_name()
-		return s.Construct(s.PROPERTY_ACCESSOR_MEMBER, iden)
-	
-	@generate
-	def index_accessor():
-		yield string("[")
-		yield normalspaces()
-		expr = yield expression
-		yield normalspaces()
-		yield string("]")
-		return s.Construct(s.PROPERTY_ACCESSOR_INDEX, expr)
-	
-	@generate
-	def accessor():
-		acc = yield (
-				member_accessor |
-				index_accessor
-		)
-		return acc
-	
-	@generate
-	def nestedproperty():
-		@generate
-		def parenthesized_subscriptable():
-			yield lparen
-			yield normalspaces()
-			se = yield simple_expr
-			yield normalspaces()
-			yield rparen
-			return se
-		
-		@generate
-		def subscriptable():
-			# note: the impact on performance of supporting the parenthesis thing here
-			# is pretty dramatic especially with nested parenthesis: every parenthesis
-			# block and all what it contains needs to be parsed twice.
-			# The way of fixing this (well the only way that I see) is to have optional
-			# subscripting after parameters (so this would be a completely different
-			# way of implementing this)
-			# factor # FIXME: also a parentesised expression
-			iden = yield var_name() | path_name | parenthesized_subscriptable
-			return iden
-		
-		root = yield subscriptable
-		yield normalspaces()
-		indexing = yield sepBy1(accessor, normalspaces())
-		return s.Construct(s.PROPERTY, root, indexing)
-	
-	@generate
-	def simpleproperty():
-		iden = yield var_name()
-		return s.Construct(s.PROPERTY, iden, None)
-	
-	# this is wrong but will require more cleanup
-	prop = yield (
-			nestedproperty ^
-			simpleproperty)
+	prop = yield property_alternatives
 	return prop
 
 
 # ################# EXPRESSIONS
 
 # ----- other expressions
+@functools.lru_cache(maxsize=None)
 def operator():
 	"""operator in some computation"""
 	return regex(
@@ -699,114 +1088,186 @@ def operator():
 #    """parse unary operator"""
 #    return regex(r"-|not(?![a-z0-9_])", re.IGNORECASE).parsecmap(st(s.UNARYOPERATOR))
 
+# binding power of the operators and the ones that are right associative
+OPERATOR_PRECEDENCE = {
+	"or": 1,
+	"and": 2,
+	"==": 3, "!=": 3, "<": 3, ">": 3, "<=": 3, ">=": 3,
+	"+": 4, "-": 4,
+	"*": 5, "/": 5,
+	"^": 6,
+	"as": 7}
+RIGHT_ASSOCIATIVE = frozenset(["^"])
+
+
+optional_call_parameters = optional(call_parameters)
+
+
+@packrat
 @generate
 def computation_operand():
-	"""parse an operand"""
-	ret = yield function_call ^ operand
+	"""parse an operand, or a function call if parameters follow a property"""
+	opnd = yield operand
+	if opnd.construct == s.PROPERTY:
+		fargs = yield optional_call_parameters
+		if fargs is not None:
+			return s.Construct(s.CALL, opnd, fargs)
+	return opnd
+
+
+def binds_before(stacked, oper):
+	"""Check if the stacked operator applies before oper"""
+	left = OPERATOR_PRECEDENCE[stacked.args[0].lower()]
+	right = OPERATOR_PRECEDENCE[oper.args[0].lower()]
+	return left > right or (left == right and oper.args[0] not in RIGHT_ASSOCIATIVE)
+
+
+@stepped
+def computation(text, index):
+	"""parse a computation into a tree of binary COMPUTATION (by precedence
+	climbing, in one pass). Without operator, this is the operand."""
+	res = yield computation_operand, index
+	if not res.status:
+		return res
+	first = res
+	operands = [res.value]
+	operators = []
+	
+	def apply():
+		right = operands.pop()
+		left = operands.pop()
+		operands.append(s.Construct(s.COMPUTATION, left, operators.pop(), right))
+	
+	while True:
+		oper = yield spaced_operator, res.index
+		if not oper.status:
+			break
+		res = yield spaced_computation_operand, oper.index
+		if not res.status:
+			# an operator needs its right operand
+			return first
+		while operators and binds_before(operators[-1], oper.value):
+			apply()
+		operators.append(oper.value)
+		operands.append(res.value)
+	while operators:
+		apply()
+	return Value.success(res.index, operands[0])
+
+
+spaced_operator = normalspaces() >> operator()
+spaced_computation_operand = normalspaces() >> computation_operand
+
+
+@packrat
+@generate
+def simple_expr():
+	"""parse a simple expr"""
+	ret = yield simple_expr_alternatives
 	return ret
 
 
+# what the expression alternatives other than simple_expr give
+STATEMENT_CONSTRUCTS = frozenset((
+	s.VARIABLE_DECL, s.ASSIGNMENT, s.IF_EXPR, s.WHILE_LOOP, s.DO_LOOP, s.FOR_LOOP,
+	s.LOOP_EXIT, s.CASE_EXPR, s.STRUCT_DEF, s.TRY_EXPR, s.THROW, s.FUNCTION_DEF,
+	s.FUNCTION_RETURN, s.LOOP_CONTINUE, s.CONTEXT_EXPR, s.SET_CONTEXT, s.MAX_COMMAND,
+	s.UTILITY_DEF, s.ROLLOUT_DEF, s.MOUSETOOL_DEF, s.RCMENU_DEF, s.MACROSCRIPT_DEF,
+	s.PLUGIN_DEF, s.ATTRIBUTES_DEF, s.WHEN_ATTRIBUTE, s.WHEN_OBJECTS))
+
+
+def expression_alternatives():
+	"""the expression alternatives in trial order with their leading keywords"""
+	with_keywords = (
+		"with", "animate", "undo", "redraw", "quiet", "printallelements", "defaultaction",
+		"mxscallstackcaptureenabled", "dontrepeatmessages", "macrorecorderemitterenabled")
+	return [
+		(variable_decl, ("persistent", "global", "local")),
+		(assignment, None),
+		(if_expr, ("if",)),
+		(while_loop, ("while",)),
+		(do_loop, ("do",)),
+		(for_loop, ("for",)),
+		(loop_exit, ("exit",)),
+		(case_expr, ("case",)),
+		(struct_def, ("struct",)),
+		(try_expr, ("try",)),
+		(throw, ("throw",)),
+		(function_def, ("fn", "function")),
+		(function_return, ("return",)),
+		(loop_continue, ("continue",)),  # !!!????
+		(context_expr, ("about", "in", "coordsys", "at") + with_keywords),
+		(set_context, ("set",)),
+		(max_command, ("max",)),
+		(simple_expr, None),
+		(utility_def, ("utility",)),
+		(rollout_def, ("rollout",)),
+		(mousetool_def, ("tool",)),
+		(rcmenu_def, ("rcmenu",)),
+		(macroscript_def, ("macroscript",)),
+		(plugin_def, ("plugin",)),
+		(attributes_def, ("attributes",)),
+		(when_handler, ("when",))
+	]
+
+
+@packrat
 @generate
-def op():
-	"""pare an operator"""
-	left = yield computation_operand
-	yield normalspaces()  # singlelinespaces()
-	oper = yield operator()
-	return [left, oper]
+def expression():
+	"""Maybe should be called a statement or..."""
+	# a statement that starts with a name only tries assignment & simple_expr
+	ret = yield expression_dispatch
+	return ret
+
+
+expression_dispatch = dispatch(expression_alternatives)
+
 
+# ############### PROGRAM CONTROL FLOW
 
 @generate
-def computation():
-	"""parse a computation"""
-	ops = yield sepBy1(op, normalspaces())
+def else_expr():
+	"""parse the else of an if expr"""
+	yield normalspaces()
+	yield keyword("else")
 	yield normalspaces()
-	final = yield computation_operand
-	flattened = [v for op in ops for v in op] + [final]
-	return s.Construct(s.COMPUTATION, flattened)
+	expr = yield expression
+	return expr
+
+
+optional_else_expr = optional(else_expr)
 
 
 @generate
-def simple_expr():
-	"""parse a simple expr"""
-	ret = yield (
-			computation ^
-			function_call ^
-			operand ^
-			expr_seq
-	)
-	return ret
+def if_then_else():
+	"""parse the then (and else) of an if expr"""
+	yield keyword("then")
+	yield normalspaces()
+	thenexpr = yield expression
+	elseexpr = yield optional_else_expr
+	return thenexpr, elseexpr
 
 
 @generate
-def expression():
-	"""Maybe should be called a statement or..."""
-	ret = yield (
-			variable_decl ^
-			assignment ^
-			if_expr ^
-			while_loop ^
-			do_loop ^
-			for_loop ^
-			loop_exit ^
-			case_expr ^
-			struct_def ^
-			try_expr ^
-			throw ^
-			function_def ^
-			function_return ^
-			loop_continue ^  # !!!????
-			context_expr ^
-			set_context ^
-			max_command ^
-			simple_expr ^
-			utility_def ^
-			rollout_def ^
-			mousetool_def ^
-			rcmenu_def ^
-			macroscript_def ^
-			plugin_def ^
-			attributes_def ^
-			when_handler
-	)
-	return ret
+def if_do():
+	"""parse the do of an if expr"""
+	yield keyword("do")
+	yield normalspaces()
+	thenexpr = yield expression
+	return thenexpr, None
 
 
-# ############### PROGRAM CONTROL FLOW
+if_alternatives = if_then_else ^ if_do
+
 
 @generate
 def if_expr():
 	"""parse an if expr"""
-	
-	@generate
-	def if_then_else():
-		yield keyword("then")
-		yield normalspaces()
-		thenexpr = yield expression
-		
-		# optional else
-		@generate
-		def else_expr():
-			yield normalspaces()
-			yield keyword("else")
-			yield normalspaces()
-			expr = yield expression
-			return expr
-		
-		elseexpr = yield optional(else_expr)
-		return thenexpr, elseexpr
-	
-	@generate
-	def if_do():
-		yield keyword("do")
-		yield normalspaces()
-		thenexpr = yield expression
-		return thenexpr, None
-	
 	yield keyword("if")
 	yield singlelinespaces()
 	expr = yield expression
 	yield normalspaces()
-	(thenexpr, elseexpr) = yield if_then_else ^ if_do
+	(thenexpr, elseexpr) = yield if_alternatives
 	
 	return s.Construct(s.IF_EXPR, expr, thenexpr, elseexpr)
 
@@ -837,6 +1298,69 @@ def do_loop():
 	return s.Construct(s.DO_LOOP, bodyexpr, whileexpr)
 
 
+@generate
+def by_expr():
+	"""parse the by of a for loop"""
+	yield keyword("by")
+	yield normalspaces()
+	expr = yield expression
+	return expr
+
+
+@generate
+def where_expr():
+	"""parse the where of a for loop"""
+	yield keyword("where")
+	yield normalspaces()
+	expr = yield expression
+	return expr
+
+
+@generate
+def while_expr():
+	"""parse the while of a for loop"""
+	yield keyword("while")
+	yield normalspaces()
+	expr = yield expression
+	return expr
+
+
+optional_by_expr = optional(by_expr)
+optional_where_expr = optional(where_expr)
+optional_while_expr = optional(while_expr)
+
+
+@generate
+def from_to_sequence():
+	"""parse the from to sequence of a for loop"""
+	fromexpr = yield expression
+	yield normalspaces()
+	yield keyword("to")
+	yield normalspaces()
+	toexpr = yield expression
+	yield normalspaces()
+	byexpr = yield optional_by_expr
+	return s.Construct(s.FOR_LOOP_FROM_TO_SEQUENCE, fromexpr, toexpr, byexpr)
+
+
+sequence_alternatives = from_to_sequence ^ expression
+
+
+@generate
+def source():
+	"""parse the source of a for loop"""
+	sequence = yield sequence_alternatives
+	yield normalspaces()
+	whileexpr = yield optional_while_expr
+	yield normalspaces()
+	whereexpr = yield optional_where_expr
+	return [sequence, whileexpr, whereexpr]
+
+
+for_variables = separated(var_name(), listsep(), 1, 3, False)
+for_in = keyword("in") ^ equals
+
+
 # this is an over simplification but easy
 # to improve
 @generate
@@ -844,52 +1368,10 @@ def for_loop():
 	"""parse a for loop"""
 	yield keyword("for")
 	yield normalspaces()
-	ident = yield separated(var_name(), listsep(), 1, 3, False)
+	ident = yield for_variables
 	yield normalspaces()
-	yield keyword("in") ^ string("=")
+	yield for_in
 	yield normalspaces()
-	
-	@generate
-	def by_expr():
-		yield keyword("by")
-		yield normalspaces()
-		expr = yield expression
-		return expr
-	
-	@generate
-	def where_expr():
-		yield keyword("where")
-		yield normalspaces()
-		expr = yield expression
-		return expr
-	
-	@generate
-	def while_expr():
-		yield keyword("while")
-		yield normalspaces()
-		expr = yield expression
-		return expr
-	
-	@generate
-	def from_to_sequence():
-		fromexpr = yield expression
-		yield normalspaces()
-		yield keyword("to")
-		yield normalspaces()
-		toexpr = yield expression
-		yield normalspaces()
-		byexpr = yield optional(by_expr)
-		return s.Construct(s.FOR_LOOP_FROM_TO_SEQUENCE, fromexpr, toexpr, byexpr)
-	
-	@generate
-	def source():
-		sequence = yield from_to_sequence ^ expression
-		yield normalspaces()
-		whileexpr = yield optional(while_expr)
-		yield normalspaces()
-		whereexpr = yield optional(where_expr)
-		return [sequence, whileexpr, whereexpr]
-	
 	src = yield source
 	yield normalspaces()
 	mode = yield keyword("do|collect")
@@ -905,20 +1387,24 @@ def loop_continue():
 	return s.Construct(s.LOOP_CONTINUE)
 
 
+@generate
+def with_expr():
+	"""parse the value of a loop exit"""
+	yield normalspaces()
+	yield keyword("with")
+	yield normalspaces()
+	value = yield operand
+	return value
+
+
+optional_with_expr = optional(with_expr)
+
+
 @generate
 def loop_exit():
 	"""parse a loop exit"""
-	
-	@generate
-	def with_expr():
-		yield normalspaces()
-		yield keyword("with")
-		yield normalspaces()
-		value = yield operand
-		return value
-	
 	yield keyword("exit")
-	value = yield optional(with_expr)
+	value = yield optional_with_expr
 	return s.Construct(s.LOOP_EXIT, value)
 
 
@@ -937,35 +1423,46 @@ def try_expr():
 	return s.Construct(s.TRY_EXPR, tryexpr, catchexpr)
 
 
+@generate
+def debug_thing():
+	"""parse the debug info of a throw"""
+	yield keyword("debugbreak:")
+	yield singlelinespaces()
+	val = yield simple_expr
+	return val
+
+
+optional_simple_expr = optional(simple_expr)
+optional_debug_thing = optional(debug_thing)
+
+
+@generate
+def full_throw():
+	"""parse what is thrown"""
+	message = yield simple_expr
+	yield singlelinespaces()
+	val = yield optional_simple_expr
+	yield singlelinespaces()
+	debuginfo = yield optional_debug_thing
+	return s.Construct(s.THROW, message, val, debuginfo)
+
+
+optional_full_throw = optional(full_throw)
+
+
 @generate
 def throw():
 	"""parse a throw"""
-	
-	@generate
-	def debug_thing():
-		yield keyword("debugbreak:")
-		yield singlelinespaces()
-		val = yield simple_expr
-		return val
-	
-	@generate
-	def full_throw():
-		message = yield simple_expr
-		yield singlelinespaces()
-		val = yield optional(simple_expr)
-		yield singlelinespaces()
-		debuginfo = yield optional(debug_thing)
-		return s.Construct(s.THROW, message, val, debuginfo)
-	
 	yield keyword("throw")
 	yield singlelinespaces()
-	full = yield optional(full_throw)
+	full = yield optional_full_throw
 	return full if full is not None else s.Construct(s.THROW, None, None, None)
 
 
 # ############## CASE EXPR
 # +/- hacky : this is the same as factor excepted
 # for name that here CAN be followed by a :
+@functools.lru_cache(maxsize=None)
 def case_var_name():
 	"""var_name"""
 	return (
@@ -979,88 +1476,69 @@ def case_var_name():
 @generate
 def case_factor():
 	"""parse a factor in a case"""
-	
-	@generate
-	def unary_minus():
-		yield string("-")
-		yield normalspaces()
-		expr = yield expression
-		return s.Construct(s.UNARY_MINUS, expr)
-	
-	@generate
-	def unary_not():
-		yield keyword("not")
-		yield normalspaces()
-		expr = yield expression
-		return s.Construct(s.UNARY_NOT, expr)
-	
-	ret = yield (hexnumber() ^
-				 time ^
-				 smptetime() ^
-				 number() |
-				 quoted |
-				 path_name |
-				 case_var_name() |
-				 mxsname ^
-				 array ^
-				 bitarray ^
-				 point4 ^
-				 point3 ^
-				 point2 ^
-				 unary_minus ^
-				 unary_not ^
-				 expr_seq
-				 # ??? ? last listener result (OMG!!) ==> could be shimmed in python if true
-				 )
+	ret = yield case_factor_alternatives
 	return ret
 
 
 @generate
-def case_expr():
+def default():
 	# pylint: disable=useless-return
+	"""parse the default case"""
+	yield keyword("default")
+	return None
+
+
+case_item_alternatives = default ^ case_factor
+
+
+@generate
+def case_item():
+	"""parse a case item"""
+	case = yield case_item_alternatives
+	yield normalspaces()
+	yield colon
+	yield normalspaces()
+	expr = yield expression
+	return s.Construct(s.CASE_ITEM, case, expr)
+
+
+optional_expression = optional(expression)
+
+
+@generate
+def case_expr():
 	"""parse a case expr"""
-	
-	@generate
-	def default():
-		yield keyword("default")
-		return None
-	
-	@generate
-	def case_item():
-		case = yield default ^ case_factor
-		yield normalspaces()
-		yield string(":")
-		yield normalspaces()
-		expr = yield expression
-		return s.Construct(s.CASE_ITEM, case, expr)
-	
 	yield keyword("case")
 	yield normalspaces()
-	expr = yield optional(expression)
+	expr = yield optional_expression
 	yield normalspaces()
 	yield keyword("of")
 	yield normalspaces()
 	yield lparen
 	yield normalspaces()
-	cases = yield sepBy(case_item, end_of_statement)
+	cases = yield case_items
 	yield normalspaces()
 	yield rparen
 	return s.Construct(s.CASE_EXPR, expr, cases)
 
 
 # ############## MAX_COMMAND
+@functools.lru_cache(maxsize=None)
+def max_command_var_name():
+	"""var_name"""
+	return (
+		regex("[a-zA-Z_][a-zA-Z0-9_]*")).parsecmap(st(s.VAR_NAME))
+
+
+max_command_things = sepBy((max_command_var_name() ^ question()), singlelinespaces())
+
+
 @generate
 def max_command():
 	"""parse max command"""
-	
-	def max_command_var_name():
-		"""var_name"""
-		return (
-			regex("[a-zA-Z_][a-zA-Z0-9_]*")).parsecmap(st(s.VAR_NAME))
-	
 	yield keyword("max")
 	yield singlelinespaces()
-	things = yield sepBy((max_command_var_name() ^ question()), singlelinespaces())
+	things = yield max_command_things
 	return s.Construct(s.MAX_COMMAND, things)
 
 
@@ -1074,11 +1552,15 @@ def about_context():
 	return s.Construct(s.CONTEXT_ABOUT, v)
 
 
+optional_with = optional(keyword("with"))
+optional_in = optional(keyword("in"))
+
+
 @generate
 def with_context():
 	"""parse the with context expr"""
 	# pylint: disable=line-too-long
-	yield optional(keyword("with"))
+	yield optional_with
 	yield normalspaces()
 	kw = yield keyword(
 		"(animate|undo|redraw|quiet|printAllElements|defaultAction|MXSCallstackCaptureEnabled|dontRepeatMessages|macroRecorderEmitterEnabled)")
@@ -1107,32 +1589,35 @@ def innode_context():
 	return s.Construct(s.CONTEXT_IN_NODE, v)
 
 
+@generate
+def special_name():
+	"""parse a coordsys name"""
+	name = yield keyword("world|local|parent|grid|screen")
+	return s.Construct(s.NAME, name)
+
+
+coordsys = special_name | operand
+
+
 @generate
 def incoordsys_context():
 	"""parse the in coordsys context expr"""
-	
-	@generate
-	def special_name():
-		name = yield keyword("world|local|parent|grid|screen")
-		return s.Construct(s.NAME, name)
-	
-	yield optional(keyword("in"))
+	yield optional_in
 	yield normalspaces()
 	yield keyword("coordsys")
 	yield normalspaces()
-	v = yield special_name | operand
+	v = yield coordsys
 	return s.Construct(s.CONTEXT_IN_COORDSYS, v)
 
 
+context = about_context ^ incoordsys_context ^ innode_context ^ at_context ^ with_context
+contexts_list = sepBy1(context, listsep())
+
+
 @generate
 def context_expr():
 	"""parse a context expr"""
-	contexts = yield sepBy1(
-		about_context ^
-		incoordsys_context ^
-		innode_context ^
-		at_context ^
-		with_context, listsep())
+	contexts = yield contexts_list
 	yield normalspaces()
 	expr = yield expression
 	return s.Construct(s.CONTEXT_EXPR, contexts, expr)
@@ -1144,7 +1629,7 @@ def set_context():
 	"""parse a set context"""
 	yield keyword("set")
 	yield normalspaces()
-	cxt = yield about_context ^ incoordsys_context ^ innode_context ^ at_context ^ with_context
+	cxt = yield context
 	return s.Construct(s.SET_CONTEXT, cxt)
 
 
@@ -1155,10 +1640,18 @@ def set_context():
 @generate
 def utility_clause():
 	"""parse a utility clause"""
-	res = yield rollout_def ^ rollout_clause
+	res = yield utility_clause_alternatives
 	return res
 
 
+named_arguments = sepBy(named_argument, normalspaces())
+singleline_named_arguments = sepBy(named_argument, singlelinespaces())
+optional_named_argument = optional(named_argument)
+optional_quoted = optional(quoted)
+optional_var_name = optional(var_name())
+optional_factor = optional(factor)
+
+
 @generate
 def utility_def():
 	"""parse a utility def"""
@@ -1168,13 +1661,13 @@ def utility_def():
 	yield normalspaces()
 	stri = yield quoted
 	yield normalspaces()
-	vnop = yield optional(named_argument)
+	vnop = yield optional_named_argument
 	yield normalspaces()
-	yield string("(")
+	yield lparen
 	yield normalspaces()
-	clauses = yield sepBy(rollout_clause, end_of_statement)  # normalspaces())
+	clauses = yield utility_clauses  # normalspaces())
 	yield normalspaces()
-	yield string(")")
+	yield rparen
 	return s.Construct(s.UTILITY_DEF, vname, stri, vnop, clauses)
 
 
@@ -1183,7 +1676,7 @@ def local_decl():
 	"""parse a local def"""
 	yield keyword("local")
 	yield normalspaces()
-	decls = yield sepBy1(decl, listsep())
+	decls = yield decl_list
 	return s.Construct(s.LOCAL_DECL, decls)
 
 
@@ -1192,7 +1685,7 @@ def global_decl():
 	"""parse a global decl"""
 	yield keyword("global")
 	yield normalspaces()
-	decls = yield sepBy1(decl, listsep())
+	decls = yield decl_list
 	return s.Construct(s.GLOBAL_DECL, decls)
 
 
@@ -1205,9 +1698,9 @@ def rollout_item():
 	yield normalspaces()
 	var = yield var_name()
 	yield normalspaces()
-	label = yield optional(quoted)
+	label = yield optional_quoted
 	yield normalspaces()
-	args = yield sepBy(named_argument, normalspaces())
+	args = yield named_arguments
 	return s.Construct(s.ROLLOUT_ITEM, kw, var, label, args)
 
 
@@ -1218,14 +1711,17 @@ def item_group():
 	yield normalspaces()
 	qstring = yield quoted
 	yield normalspaces()
-	yield string("(")
+	yield lparen
 	yield normalspaces()
-	group = yield sepBy(rollout_item, normalspaces())
+	group = yield rollout_items
 	yield normalspaces()
-	yield string(")")
+	yield rparen
 	return s.Construct(s.ROLLOUT_GROUP, qstring, group)
 
 
+rollout_items = sepBy(rollout_item, normalspaces())
+
+
 # FIXME: is this necessary? can we simply use the generic on_do_handler that we use elsewhere
 @generate
 def rollout_handler():
@@ -1236,9 +1732,9 @@ def rollout_handler():
 	yield normalspaces()
 	varn = yield var_name()
 	yield normalspaces()
-	varn2 = yield optional(var_name())
+	varn2 = yield optional_var_name
 	yield normalspaces()
-	varn3 = yield optional(var_name())
+	varn3 = yield optional_var_name
 	yield normalspaces()
 	yield keyword("do")
 	yield normalspaces()
@@ -1249,20 +1745,16 @@ def rollout_handler():
 @generate
 def rollout_clause():
 	"""parse a rollout clause"""
-	clause = yield (local_decl ^
-					global_decl ^
-					function_def ^
-					struct_def ^
-					mousetool_def ^
-					item_group ^
-					rollout_item ^
-					rollout_handler)
+	clause = yield rollout_clause_alternatives
 	# this is weird, why this clause?
 	# (in the macroscript thing we use it as a bundle of things...
 	# not sure I remember why either)
 	return s.Construct(s.ROLLOUT_CLAUSE, clause)
 
 
+rollout_clauses = sepBy(rollout_clause, normalspaces())
+
+
 @generate
 def rollout_def():
 	"""parse a rollout def"""
@@ -1272,13 +1764,13 @@ def rollout_def():
 	yield normalspaces()
 	qstring = yield quoted
 	yield normalspaces()
-	vnop = yield sepBy(named_argument, normalspaces())
+	vnop = yield named_arguments
 	yield normalspaces()
-	yield string("(")
+	yield lparen
 	yield normalspaces()
-	clauses = yield sepBy(rollout_clause, normalspaces())
+	clauses = yield rollout_clauses
 	yield normalspaces()
-	yield string(")")
+	yield rparen
 	return s.Construct(s.ROLLOUT_DEF, vname, qstring, vnop, clauses)
 
 
@@ -1291,7 +1783,7 @@ def rcmenu_item():
 	yield normalspaces()
 	label = yield quoted
 	yield normalspaces()
-	vnarg = yield sepBy(named_argument, singlelinespaces())
+	vnarg = yield singleline_named_arguments
 	return s.Construct(s.RCMENU_ITEM, varname, label, vnarg)
 
 
@@ -1310,15 +1802,18 @@ def rcmenu_handler():
 	return s.Construct(s.RCMENU_HANDLER, varname, vn2, expr)
 
 
+rcmenu_clause_alternatives = (
+		rcmenu_handler ^
+		local_decl ^
+		function_def ^
+		struct_def ^
+		rcmenu_item)
+
+
 @generate
 def rcmenu_clause():
 	"""parse a rcmenu clause"""
-	clause = yield (
-			rcmenu_handler ^
-			local_decl ^
-			function_def ^
-			struct_def ^
-			rcmenu_item)
+	clause = yield rcmenu_clause_alternatives
 	return clause
 
 
@@ -1329,44 +1824,40 @@ def rcmenu_def():
 	yield normalspaces()
 	vname = yield var_name()
 	yield normalspaces()
-	yield string("(")
+	yield lparen
 	yield normalspaces()
-	clauses = yield sepBy(rcmenu_clause, end_of_statement)
+	clauses = yield rcmenu_clauses
 	yield normalspaces()
-	yield string(")")
+	yield rparen
 	return s.Construct(s.RCMENU_DEF, vname, clauses)
 
 
+@generate
+def do_exprseq():
+	"""parse the do of a handler"""
+	yield keyword("do")
+	yield normalspaces()
+	handler = yield expression  # expr_seq
+	return handler
+
+
+handler_body = function_return | do_exprseq
+
+
 @generate
 def on_do_handler():
 	"""parse a on do handler"""
-	
-	@generate
-	def do_exprseq():
-		yield keyword("do")
-		yield normalspaces()
-		handler = yield expression  # expr_seq
-		return handler
-	
 	yield keyword("on")
 	yield normalspaces()
 	event = yield var_name()
 	yield normalspaces()
-	handler = yield function_return | do_exprseq
+	handler = yield handler_body
 	return s.Construct(s.ON_DO_HANDLER, event, handler)
 
 
 @generate
 def on_map_do_handler():
 	"""parse a on map do handler"""
-	
-	@generate
-	def do_exprseq():
-		yield keyword("do")
-		yield normalspaces()
-		handler = yield expression  # expr_seq
-		return handler
-	
 	yield keyword("on")
 	yield normalspaces()
 	yield keyword("map")
@@ -1375,7 +1866,7 @@ def on_map_do_handler():
 	yield normalspaces()
 	varname = yield var_name()  # pylint: disable=unused-variable
 	yield normalspaces()
-	handler = yield function_return | do_exprseq
+	handler = yield handler_body
 	# this is definitely faulty, we ignore the varname
 	return s.Construct(s.ON_MAP_DO_HANDLER, event, handler)
 
@@ -1383,36 +1874,33 @@ def on_map_do_handler():
 @generate
 def on_clone_do_handler():
 	"""parse a on clone do handler"""
-	
-	@generate
-	def do_exprseq():
-		yield keyword("do")
-		yield normalspaces()
-		handler = yield expression  # expr_seq
-		return handler
-	
 	yield keyword("on")
 	yield normalspaces()
 	yield keyword("clone")
 	yield normalspaces()
 	thing = yield var_name()
 	yield normalspaces()
-	handler = yield function_return | do_exprseq
+	handler = yield handler_body
 	return s.Construct(s.ON_CLONE_DO_HANDLER, thing, handler)
 
 
+@generate
+def handler_block_item():
+	"""parse an item of a macroscript clause"""
+	ret = yield handler_block_alternatives
+	return ret
+
+
+handler_block_alternatives = on_do_handler ^ local_decl ^ function_def
+handler_block_items = sepBy1(handler_block_item, normalspaces())
+
+
 @generate
 def macroscript_clause():
 	"""parse a macroscript clause"""
-	
-	@generate
-	def handler_block_item():
-		ret = yield on_do_handler ^ local_decl ^ function_def
-		return ret
-	
 	yield lparen
 	yield normalspaces()
-	handlers = yield sepBy1(handler_block_item, normalspaces())
+	handlers = yield handler_block_items
 	yield normalspaces()
 	yield rparen
 	return s.Construct(s.MACROSCRIPT_CLAUSE, handlers)
@@ -1425,9 +1913,9 @@ def macroscript_def():
 	yield normalspaces()
 	vname = yield var_name()
 	yield normalspaces()
-	vnop = yield sepBy(named_argument, normalspaces())
+	vnop = yield named_arguments
 	yield normalspaces()
-	handlers = yield expr_seq ^ macroscript_clause
+	handlers = yield macroscript_handlers
 	
 	return s.Construct(s.MACROSCRIPT_DEF, vname, vnop, handlers)
 
@@ -1435,10 +1923,7 @@ def macroscript_def():
 @generate
 def tool_clause():
 	"""parse a tool clause"""
-	yield (local_decl ^
-		   function_def ^
-		   struct_def ^
-		   tool_handler)
+	yield tool_clause_alternatives
 
 
 @generate
@@ -1448,7 +1933,7 @@ def tool_handler():
 	yield normalspaces()
 	yield var_name()
 	yield normalspaces()
-	yield optional(var_name())
+	yield optional_var_name
 	yield normalspaces()
 	yield keyword("do")
 	yield normalspaces()
@@ -1456,6 +1941,14 @@ def tool_handler():
 	return expr
 
 
+tool_clause_alternatives = (
+		local_decl ^
+		function_def ^
+		struct_def ^
+		tool_handler)
+tool_clauses = sepBy(tool_clause, normalspaces())
+
+
 @generate
 def mousetool_def():
 	"""parse a mousetool def"""
@@ -1463,31 +1956,35 @@ def mousetool_def():
 	yield normalspaces()
 	vname = yield var_name()
 	yield normalspaces()
-	vnop = yield sepBy(named_argument, normalspaces())
+	vnop = yield named_arguments
 	yield normalspaces()
-	yield string("(")
+	yield lparen
 	yield normalspaces()
-	toolclauses = yield sepBy(tool_clause, normalspaces())
+	toolclauses = yield tool_clauses
 	yield normalspaces()
-	yield string(")")
+	yield rparen
 	return s.Construct(s.MOUSETOOL_DEF, vname, vnop, toolclauses)
 
 
 # ----- parameters
 
 
+@generate
+def param_def():
+	"""parse a param def"""
+	yield var_name()
+	yield singlelinespaces()
+	# this looks faulty: we do nothing with vnop!?!?!
+	vnop = yield singleline_named_arguments  # pylint: disable=unused-variable
+
+
+param_def_list = sepBy1(param_def, singlelinespaces())
+
+
 @generate
 def param_defs():
 	"""parse param defs"""
-	
-	@generate
-	def param_def():
-		yield var_name()
-		yield singlelinespaces()
-		# this looks faulty: we do nothing with vnop!?!?!
-		vnop = yield sepBy(named_argument, singlelinespaces())  # pylint: disable=unused-variable
-	
-	defs = yield sepBy1(param_def, singlelinespaces())
+	defs = yield param_def_list
 	return defs
 
 
@@ -1508,13 +2005,16 @@ def param_handler():
 	return s.Construct(s.PARAMETERS_HANDLER, hname, action, other, expr)
 
 
+param_clause_alternatives = (
+		param_handler ^
+		param_defs
+)
+
+
 @generate
 def param_clause():
 	"""parse a param clause"""
-	clause = yield (
-			param_handler ^
-			param_defs
-	)
+	clause = yield param_clause_alternatives
 	return clause
 
 
@@ -1525,33 +2025,40 @@ def parameters_def():
 	yield normalspaces()
 	vname = yield var_name()
 	yield normalspaces()
-	vnop = yield sepBy(named_argument, normalspaces())
+	vnop = yield named_arguments
 	yield normalspaces()
-	yield string("(")
+	yield lparen
 	yield normalspaces()
-	paramclauses = yield sepBy1(param_clause, end_of_statement)  # normalspaces())
+	paramclauses = yield param_clauses  # normalspaces())
 	yield normalspaces()
-	yield string(")")
+	yield rparen
 	return s.Construct(s.PARAMETERS_DEF, vname, vnop, paramclauses)
 
 
 # ----- plugin
 
+plugin_clause_alternatives = (
+		local_decl ^
+		function_def ^
+		struct_def ^
+		parameters_def ^
+		mousetool_def ^
+		rollout_def ^
+		on_map_do_handler ^
+		on_clone_do_handler ^
+		on_do_handler)
+
+
 @generate
 def plugin_clause():
 	"""parse a plugin clause"""
-	clause = yield (local_decl ^
-					function_def ^
-					struct_def ^
-					parameters_def ^
-					mousetool_def ^
-					rollout_def ^
-					on_map_do_handler ^
-					on_clone_do_handler ^
-					on_do_handler)
+	clause = yield plugin_clause_alternatives
 	return clause
 
 
+plugin_clauses = sepBy(plugin_clause, normalspaces())
+
+
 @generate
 def plugin_def():
 	"""parse a plugin def"""
@@ -1561,26 +2068,30 @@ def plugin_def():
 	yield normalspaces()
 	vname = yield var_name()
 	yield normalspaces()
-	vnop = yield sepBy(named_argument, normalspaces())
+	vnop = yield named_arguments
 	yield normalspaces()
-	yield string("(")
+	yield lparen
 	yield normalspaces()
-	pluginclauses = yield sepBy(plugin_clause, normalspaces())
+	pluginclauses = yield plugin_clauses
 	yield normalspaces()
-	yield string(")")
+	yield rparen
 	return s.Construct(s.PLUGIN_DEF, vname, vnop, pluginclauses)
 
 
 # ----------- attributes
+attributes_clause_alternatives = (
+		local_decl ^
+		global_decl ^
+		parameters_def ^
+		rollout_def ^
+		function_def ^
+		on_do_handler)
+
+
 @generate
 def attributes_clause():
 	"""parse an attributes clause"""
-	clause = yield (local_decl ^
-					global_decl ^
-					parameters_def ^
-					rollout_def ^
-					function_def ^
-					on_do_handler)
+	clause = yield attributes_clause_alternatives
 	return clause
 
 
@@ -1591,70 +2102,80 @@ def attributes_def():
 	yield normalspaces()
 	attrname = yield expression
 	yield normalspaces()
-	vnop = yield sepBy(named_argument, normalspaces())
+	vnop = yield named_arguments
 	yield normalspaces()
-	yield string("(")
+	yield lparen
 	yield normalspaces()
-	attributesclauses = yield sepBy(attributes_clause, end_of_statement)
+	attributesclauses = yield attributes_clauses
 	yield normalspaces()
-	yield string(")")
+	yield rparen
 	return s.Construct(s.ATTRIBUTES_DEF, attrname, vnop, attributesclauses)
 
 
 # when
 
+@generate
+def when_attribute():
+	"""parse a when attribute handler"""
+	# pylint: disable=line-too-long
+	yield keyword("when")
+	yield normalspaces()
+	kw = yield keyword(
+		"topology|geometry|names?|transform|select|parameters|subAnimStructure|controller|children|any")
+	yield normalspaces()
+	objects = yield factor
+	yield normalspaces()
+	yield keyword("changes?")
+	yield normalspaces()
+	vnop = yield named_arguments
+	yield normalspaces()
+	objparam = yield optional_factor
+	yield normalspaces()
+	yield keyword("do")
+	yield normalspaces()
+	expr = yield expression
+	return s.Construct(s.WHEN_ATTRIBUTE, kw, objects, vnop, objparam, expr)
+
+
+@generate
+def when_objects():
+	"""parse a when deleted handler"""
+	yield keyword("when")
+	yield normalspaces()
+	obj = yield factor
+	yield normalspaces()
+	yield keyword("deleted")
+	yield normalspaces()
+	vnop = yield named_arguments
+	yield normalspaces()
+	objparam = yield optional_factor
+	yield normalspaces()
+	yield keyword("do")
+	yield normalspaces()
+	expr = yield expression
+	return s.Construct(s.WHEN_OBJECTS, obj, vnop, objparam, expr)
+
+
+when_alternatives = when_attribute ^ when_objects
+
+
 @generate
 def when_handler():
 	"""parse a when handler"""
-	
-	@generate
-	def when_attribute():
-		# pylint: disable=line-too-long
-		yield keyword("when")
-		yield normalspaces()
-		kw = yield keyword(
-			"topology|geometry|names?|transform|select|parameters|subAnimStructure|controller|children|any")
-		yield normalspaces()
-		objects = yield factor
-		yield normalspaces()
-		yield keyword("changes?")
-		yield normalspaces()
-		vnop = yield sepBy(named_argument, normalspaces())
-		yield normalspaces()
-		objparam = yield optional(factor)
-		yield normalspaces()
-		yield keyword("do")
-		yield normalspaces()
-		expr = yield expression
-		return s.Construct(s.WHEN_ATTRIBUTE, kw, objects, vnop, objparam, expr)
-	
-	@generate
-	def when_objects():
-		yield keyword("when")
-		yield normalspaces()
-		obj = yield factor
-		yield normalspaces()
-		yield keyword("deleted")
-		yield normalspaces()
-		vnop = yield sepBy(named_argument, normalspaces())
-		yield normalspaces()
-		objparam = yield optional(factor)
-		yield normalspaces()
-		yield keyword("do")
-		yield normalspaces()
-		expr = yield expression
-		return s.Construct(s.WHEN_OBJECTS, obj, vnop, objparam, expr)
-	
-	when_thing = yield when_attribute ^ when_objects
+	when_thing = yield when_alternatives
 	return when_thing
 
 
 # ############## PROGRAM
+statementseps = sepBy(statementsep(), singlelinespaces())
+trailing_statementseps = many(statementsep())
+
+
 @generate
 def end_of_statement():
 	"""Statement separator"""
 	yield singlelinespaces()
-	yield sepBy(statementsep(), singlelinespaces())
+	yield statementseps
 	yield singlelinespaces()
 
 
@@ -1666,17 +2187,22 @@ def program_step():
 	return expr
 
 
+program_steps = sepBy(
+	program_step,
+	end_of_statement)
+
+
+def mark_location(sloc):
+	"""Set the location of a marked statement"""
+	sloc[1].set_start_end(sloc[0], sloc[2])
+	return sloc[1]
+
+
 @generate
 def program():
 	"""Parse an mxs program"""
-	statements = yield sepBy(
-		program_step,
-		end_of_statement)
-	yield many(statementsep())
-	
-	def mark_location(sloc):
-		sloc[1].set_start_end(sloc[0], sloc[2])
-		return sloc[1]
+	statements = yield program_steps
+	yield trailing_statementseps
 	
 	lstatements = list(map(mark_location, statements))
 	return s.Construct(s.PROGRAM, lstatements)
@@ -1693,6 +2219,7 @@ def expr_seq():
 	return s.Construct(s.EXPR_SEQ, statements)
 
 
+@per_parse
 @mark
 @generate
 def file():
@@ -1701,3 +2228,468 @@ def file():
 	p = yield program
 	yield normalspaces()
 	return p
+
+
+# the alternatives and lists that refer to productions defined after their users
+array_values = sepBy(expression, listsep())
+factor_alternatives = (
+		hexnumber() ^
+		time ^
+		smptetime() ^
+		number() |
+		quoted |
+		path_name |
+		var_name() |
+		mxsname ^
+		array ^
+		bitarray ^
+		point4 ^
+		point3 ^
+		point2 ^
+		unary_minus ^
+		unary_not ^
+		expr_seq)
+case_factor_alternatives = (
+		hexnumber() ^
+		time ^
+		smptetime() ^
+		number() |
+		quoted |
+		path_name |
+		case_var_name() |
+		mxsname ^
+		array ^
+		bitarray ^
+		point4 ^
+		point3 ^
+		point2 ^
+		unary_minus ^
+		unary_not ^
+		expr_seq
+		# ??? ? last listener result (OMG!!) ==> could be shimmed in python if true
+)
+referenceable_property = property_ref ^ parenthesized_property_ref
+operand_alternatives = (
+		parenthesized | (
+			property_ref ^
+			unary_reference ^
+			factor)
+	# index (this is included in property_ref the way we do it here)
+)
+struct_member_alternatives = struct_assignment ^ on_do_handler ^ struct_declaration ^ struct_method
+simple_expr_alternatives = (
+		computation ^
+		expr_seq
+)
+case_items = sepBy(case_item, end_of_statement)
+rollout_clause_alternatives = (
+		local_decl ^
+		global_decl ^
+		function_def ^
+		struct_def ^
+		mousetool_def ^
+		item_group ^
+		rollout_item ^
+		rollout_handler)
+utility_clause_alternatives = rollout_def ^ rollout_clause
+utility_clauses = sepBy(rollout_clause, end_of_statement)
+rcmenu_clauses = sepBy(rcmenu_clause, end_of_statement)
+macroscript_handlers = expr_seq ^ macroscript_clause
+param_clauses = sepBy1(param_clause, end_of_statement)
+attributes_clauses = sepBy(attributes_clause, end_of_statement)
+
+
+# ############## INCREMENTAL PARSE
+# tokens lexed after the edit (the rest are scanned without the token table)
+INCREMENTAL_TOKENS_MARGIN = 4096
+
+
+def common_prefix_length(a, b, chunk=4096):
+	"""Length of the common beginning of the strings a and b"""
+	length = min(len(a), len(b))
+	start = 0
+	while start < length and a[start:start + chunk] == b[start:start + chunk]:
+		start += chunk
+	low, high = start, min(start + chunk, length)
+	while low < high:
+		mid = (low + high + 1) // 2
+		if a[start:mid] == b[start:mid]:
+			low = mid
+		else:
+			high = mid - 1
+	return low
+
+
+RECOVERY_OPENING = frozenset(("(", "[", "{", "#(", "#{"))
+RECOVERY_CLOSING = frozenset((")", "]", "}"))
+RECOVERY_LINE_START = re.compile(r"\n(?=[^\s;])")
+# the words that go on with the statement of the line before
+CONTINUATION_WORDS = frozenset((
+	"then", "else", "do", "catch", "of", "to", "by", "where", "while", "collect",
+	"and", "or", "as", "not", "in"))
+NAMED_ARGUMENT_START = re.compile(r"[a-zA-Z_][a-zA-Z0-9_]*[ \t]*:")
+STATEMENT_WORD_START = re.compile(r"[a-zA-Z_]")
+
+
+def column(text, index):
+	"""Column of index in text"""
+	return index - text.rfind("\n", 0, index) - 1
+
+
+def starts_statement(text, index):
+	"""If the line at index likely starts a top level statement: with a word
+	that does not go on with the statement of the line before"""
+	return bool(
+		STATEMENT_WORD_START.match(text, index) and
+		LEADING_WORD.match(text, index).group().lower() not in CONTINUATION_WORDS and
+		not NAMED_ARGUMENT_START.match(text, index))
+
+
+def recovery_point(text, index):
+	"""(end, next statement start) of the statement that failed to parse at
+	index: it runs up to a statement separator out of brackets followed by a
+	line that is not more indented, or up to a line that is not more
+	indented and likely starts a statement (an unclosed bracket does not
+	take in the statements after it), or else up to a line at column 0"""
+	depth, indent = 0, column(text, index)
+	for kind, start, end in mxslex.iter_tokens(text, index):
+		spaces = text[start:end]
+		if kind == mxslex.SPACES:
+			if depth == 0 and ";" in spaces:
+				return start, end
+			if "\n" in spaces and column(text, end) <= indent and (depth == 0 or starts_statement(text, end)):
+				return start, end
+		elif spaces in RECOVERY_OPENING:
+			depth += 1
+		elif spaces in RECOVERY_CLOSING:
+			depth = max(depth - 1, 0)
+	line_start = RECOVERY_LINE_START.search(text, index)
+	if line_start is None:
+		return len(text), len(text)
+	return line_start.start(), line_start.end()
+
+
+def same_line(statements, text, start):
+	"""If the last of statements ends on the line of start (no separator)"""
+	return bool(statements) and not re.search("[;\n]", text[statements[-1][1]:start])
+
+
+def parse_statement(statements, text, start, recover=False):
+	"""Parse the top level statement of text at start, adding its (start,
+	end, following, tree) to statements (following is where the next one
+	starts, None if the statement separator failed): give where the next one
+	starts, None when the parse of the statements is over.
+	With recover, a statement that fails to parse is added as a PARSE_ERROR
+	construct (source, expected, offset of the failure), along with what
+	parsed before it on the same line, up to the next statement (see
+	recovery_point)"""
+	res = run_parser(program_step, text, start)
+	if res.status:
+		(step_start, tree, step_end), end = res.value, res.index
+		tree.set_start_end(step_start, step_end)
+		res = run_parser(end_of_statement, text, end)
+		following = res.index if res.status else None
+		statements.append((start, end, following, tree))
+		return following
+	if not recover or not text[start:].strip("; \t\n\r\\"):
+		return None
+	while same_line(statements, text, start):
+		# what parsed before on the same line is part of the error
+		start = statements.pop()[0]
+	end, following = recovery_point(text, start)
+	tree = s.Construct(s.PARSE_ERROR, text[start:end], res.expected, res.index - start)
+	tree.set_start_end(line_index(text).position(start), line_index(text).position(end))
+	statements.append((start, end, following, tree))
+	return following
+
+
+def copy_tree(tree):
+	"""Copy a parse tree (the constructs, lists and tuples)"""
+	if isinstance(tree, s.Construct):
+		res = s.Construct.__new__(s.Construct)
+		res.__dict__.update(tree.__dict__)
+		res.args = [copy_tree(arg) for arg in tree.args]
+		res.comments = list(tree.comments)
+		return res
+	if isinstance(tree, list):
+		return [copy_tree(item) for item in tree]
+	if isinstance(tree, tuple):
+		return tuple(copy_tree(item) for item in tree)
+	return tree
+
+
+def shift_tree(tree, shift):
+	"""Change the positions of the constructs of a parse tree by shift(pos)"""
+	if isinstance(tree, s.Construct):
+		if tree.start is not None:
+			tree.start, tree.end = shift(tree.start), shift(tree.end)
+		tree = tree.args
+	if isinstance(tree, (list, tuple)):
+		for item in tree:
+			shift_tree(item, shift)
+
+
+class IncrementalFile(Parser):
+	"""Parse the successive versions of an edited text as file does, but only
+	reparse the top level statements around the edit.
+	The parse of a statement only depends on the text from its start on: the
+	statements in the unchanged end of the text are reused with their
+	positions shifted. Those in the unchanged beginning are reused but for
+	the one just before the edit, which is reparsed as a statement may look a
+	bit past its end (for an = or an operator on the next line...), up to the
+	first PARSE_ERROR, as what failed may have looked up to the end.
+	The trees given are copies, free to be transformed, unless copy_trees is
+	False (they are then shared with the next parses).
+	With recover, a statement that fails to parse does not end the parse: it
+	becomes a PARSE_ERROR construct (see parse_statement) and its ParseError
+	is added to diagnostics."""
+	
+	def __init__(self, copy_trees=True, recover=False):
+		super().__init__(self.parse_file)
+		self.copy_trees = copy_trees
+		self.recover = recover
+		self.text = ""
+		# the (start, end, following, tree) of the top level statements of
+		# text: following is where the next one starts (None if the statement
+		# separator failed)
+		self.statements = []
+		self.diagnostics = []
+	
+	def parse_file(self, text, index):
+		"""Parser function, same result as file"""
+		if index != 0:
+			return file(text, index)
+		old_text, old_statements = self.text, self.statements
+		prefix = common_prefix_length(old_text, text)
+		limit = min(len(old_text), len(text)) - prefix
+		suffix = min(common_prefix_length(old_text[::-1], text[::-1]), limit)
+		delta = len(text) - len(old_text)
+		changed_end = len(text) - suffix
+		
+		keep = 0
+		while (keep + 1 < len(old_statements) and
+				old_statements[keep + 1][2] is not None and
+				old_statements[keep + 1][2] <= prefix and
+				old_statements[keep][3].construct != s.PARSE_ERROR):
+			keep += 1
+		statements = old_statements[:keep]
+		if statements:
+			start, stop = statements[-1][2], changed_end + INCREMENTAL_TOKENS_MARGIN
+		else:
+			start, stop = 0, None
+		
+		with parse_tables(text, start, stop):
+			if not statements:
+				start = run_parser(normalspaces(), text, 0).index
+			program_start = start
+			old_starts = {statement[0]: n for n, statement in enumerate(old_statements)}
+			while True:
+				if (start >= changed_end and start - delta in old_starts and not (
+						old_statements[old_starts[start - delta]][3].construct == s.PARSE_ERROR and
+						same_line(statements, text, start))):
+					statements.extend(self.shifted(
+						old_statements[old_starts[start - delta]:], old_text, text, delta))
+					break
+				start = parse_statement(statements, text, start, self.recover)
+				if start is None:
+					break
+			
+			end = statements[-1][1] if statements else program_start
+			end = run_parser(trailing_statementseps, text, end).index
+			end = run_parser(normalspaces(), text, end).index
+		
+		self.text, self.statements = text, statements
+		trees = [statement[3] for statement in statements]
+		self.diagnostics = [
+			ParseError(tree.args[1], text, start + tree.args[2])
+			for (start, _, _, tree) in statements if tree.construct == s.PARSE_ERROR]
+		if self.copy_trees:
+			trees = copy_tree(trees)
+		program = s.Construct(s.PROGRAM, trees)
+		return Value.success(end, (line_index(text).position(0), program, line_index(text).position(end)))
+	
+	@staticmethod
+	def shifted(statements, old_text, text, delta):
+		"""The statements of the unchanged end of old_text, moved by the edit"""
+		old_line, old_col = line_index(old_text).position(statements[0][0])
+		line, col = line_index(text).position(statements[0][0] + delta)
+		
+		def shift(pos):
+			if pos[0] == old_line:
+				return (line, pos[1] + col - old_col)
+			return (pos[0] + line - old_line, pos[1])
+		
+		if (line, col) != (old_line, old_col):
+			shift_tree([statement[3] for statement in statements], shift)
+		return [
+			(start + delta, end + delta, None if following is None else following + delta, tree)
+			for start, end, following, tree in statements]
+
+
+def parse_recovering(text):
+	"""Parse text as file, going on past the statements that fail to parse:
+	give the file value and the ParseError of these statements"""
+	parser = IncrementalFile(recover=True)
+	return parser.parse(text), parser.diagnostics
+
+
+# ############## STREAMED PARSE
+# the tokens of a streamed parse are lexed by windows of this size, a new one
+# starting when a statement starts in the second half of the current one
+STREAM_TOKENS_WINDOW = 64 * 1024
+
+
+def iter_file(text, recover=False):
+	"""Parse text as file, giving its top level statements (with their
+	positions) one at a time, as soon as they are parsed: the memo table is
+	the one of a statement and the token table the one of a window.
+	With recover, a statement that fails to parse gives a PARSE_ERROR (see
+	parse_statement), so the statements of a line are given once the next
+	line is reached."""
+	pending = []
+	start = run_parser(normalspaces(), text, 0).index
+	tokens, window_middle = None, -1
+	while True:
+		if not same_line(pending, text, start):
+			yield from (statement[3] for statement in pending)
+			pending = []
+		if start > window_middle:
+			tokens = mxslex.token_table(text, start, start + STREAM_TOKENS_WINDOW)
+			window_middle = start + STREAM_TOKENS_WINDOW // 2
+		with parse_tables(text, tokens=tokens):
+			start = parse_statement(pending, text, start, recover)
+		if start is None:
+			break
+	yield from (statement[3] for statement in pending)
+
+
+# ############## PARALLEL PARSE
+# a chunk is at least this long, and the text is split in this many chunks per worker
+PARALLEL_MIN_CHUNK = 16 * 1024
+PARALLEL_CHUNKS_PER_WORKER = 4
+# the strings, quoted names and brackets, and the lines starting with a word
+CHUNK_SPLIT = re.compile(r"""("([^"\\]|\\.)*"|@"[^"]*"|'[^']*')|([(\[{])|([)\]}])|\n(?=[a-zA-Z_])""")
+def chunk_bounds(text, size):
+	"""Split text in (start, stop) chunks of at least size characters, cut at
+	lines that start with a word out of brackets and strings, which likely
+	start a top level statement"""
+	bounds, start, depth = [], 0, 0
+	for m in CHUNK_SPLIT.finditer(text):
+		if m.group(3):
+			depth += 1
+		elif m.group(4):
+			depth = max(depth - 1, 0)
+		elif not m.group(1) and depth == 0 and m.end() - start >= size and starts_statement(text, m.end()):
+			bounds.append((start, m.end()))
+			start = m.end()
+	bounds.append((start, len(text)))
+	return bounds
+
+
+def top_level_statements(text, start, stop=None):
+	"""Parse the top level statements of text from start up to the first one
+	that starts at stop or past it: their (start, end, following, tree) as in
+	IncrementalFile.statements"""
+	statements = []
+	while stop is None or start < stop:
+		start = parse_statement(statements, text, start)
+		if start is None:
+			break
+	return statements
+
+
+_chunked_text = None
+
+
+def set_chunked_text(text):
+	"""Set the text of the chunks parsed by a worker"""
+	global _chunked_text  # pylint: disable=global-statement
+	_chunked_text = text
+
+
+def parse_chunk(bounds):
+	"""Parse the top level statements of a chunk of the worker text"""
+	start, stop = bounds
+	with parse_tables(_chunked_text, start, stop + INCREMENTAL_TOKENS_MARGIN):
+		start = run_parser(normalspaces(), _chunked_text, start).index
+		return top_level_statements(_chunked_text, start, stop)
+
+
+class ParallelFile(Parser):
+	"""Parse a text as file does, with its top level statements parsed by
+	chunks in a pool of worker processes.
+	The chunks are cut where a top level statement likely starts (see
+	chunk_bounds). Each worker gets the whole text and parses the statements
+	that start in its chunk, up to their end, so that their positions are
+	the ones in the text. As the parse of a statement only depends on the text
+	from its start on, the statements of the chunks are stitched together
+	from the start of the text, going from a statement to the one that
+	starts where it is followed: a statement that no chunk has (the cut was
+	in the middle of a statement, or a worker failed) is parsed here.
+	With a single worker, the text is parsed here as file does."""
+	
+	def __init__(self, workers=None, chunk_size=None):
+		super().__init__(self.parse_file)
+		self.workers = workers or os.cpu_count() or 1
+		self.chunk_size = chunk_size
+	
+	def parse_file(self, text, index):
+		"""Parser function, same result as file"""
+		if index != 0 or self.workers == 1:
+			return file(text, index)
+		size = self.chunk_size or max(PARALLEL_MIN_CHUNK, len(text) // (self.workers * PARALLEL_CHUNKS_PER_WORKER))
+		bounds = chunk_bounds(text, size)
+		if len(bounds) == 1:
+			return file(text, index)
+		known = {}
+		with concurrent.futures.ProcessPoolExecutor(
+				self.workers, initializer=set_chunked_text, initargs=(text,)) as pool:
+			for chunk in [pool.submit(parse_chunk, chunk_bound) for chunk_bound in bounds]:
+				try:
+					known.update((statement[0], statement) for statement in chunk.result())
+				except Exception:  # pylint: disable=broad-exception-caught
+					# a worker that failed (or a tree too deep to be sent back):
+					# its statements are parsed here if needed
+					continue
+		
+		with parse_tables(text, 0, bounds[0][1] + INCREMENTAL_TOKENS_MARGIN):
+			start = run_parser(normalspaces(), text, 0).index
+		program_start = start
+		statements = []
+		while True:
+			if start not in known:
+				with parse_tables(text, start, start + size + INCREMENTAL_TOKENS_MARGIN):
+					known.update((statement[0], statement) for statement in top_level_statements(text, start, start + 1))
+				if start not in known:
+					break
+			statements.append(known[start])
+			start = known[start][2]
+			if start is None:
+				break
+		
+		end = statements[-1][1] if statements else program_start
+		with parse_tables(text, end, end + INCREMENTAL_TOKENS_MARGIN):
+			end = run_parser(trailing_statementseps, text, end).index
+			end = run_parser(normalspaces(), text, end).index
+		program = s.Construct(s.PROGRAM, [statement[3] for statement in statements])
+		return Value.success(end, (line_index(text).position(0), program, line_index(text).position(end)))
+
+
+def main():
+	"""Print the profile of the parse of the files given as arguments"""
+	parser = argparse.ArgumentParser(description=main.__doc__)
+	parser.add_argument("files", nargs="+")
+	parser.add_argument("--json", action="store_true", help="json instead of a table")
+	parser.add_argument("--sort", default="self", choices=Profile.FIELDS)
+	parser.add_argument("--limit", type=int, default=None, help="number of productions in the table")
+	args = parser.parse_args()
+	with profiling() as profile:
+		for filename in args.files:
+			with open(filename, encoding="utf-8", errors="replace") as f:
+				text = f.read().replace("\r\n", "\n")
+			file.parse(mxscp.scan(text).stripped)
+	print(profile.json(args.sort) if args.json else profile.table(args.sort, args.limit))
+
+
+if __name__ == "__main__":
+	main()
@@ -2,6 +2,8 @@
 Formats the processed syntax tree as python code.
 """
 # pylint: disable=invalid-name, import-error, too-many-lines, fixme, unused-argument
+import bisect
+import contextlib
 import keyword
 import functools
 import syntax as s
@@ -20,6 +22,89 @@ SCOPE_PREFIX = {
 
 RESERVED_PYTHON_NAMES = keyword.kwlist + ["str"]
 
+INDENT = "    "
+
+
+class IndentLevel:
+	"""An indentation level, offset levels deeper than its parent (the offset
+	can be set after code has been written at the level)"""
+	
+	def __init__(self, parent, offset):
+		self.parent = parent
+		self.offset = offset
+		self.depth = 0
+
+
+class CodeEmitter:
+	"""
+	Code written as chunks of lines, each at an indentation level: the
+	indentation is applied once, when the chunks are joined, instead of
+	re-indenting the code of a block at each nesting level.
+	With a sink (a writable text file), the chunks are written to the sink
+	when they are flushed instead of being joined.
+	"""
+	
+	def __init__(self, sink=None):
+		self.root = IndentLevel(None, 0)
+		self.level = self.root
+		# the levels created since the chunks were last flushed
+		self.levels = []
+		self.chunks = []
+		self.sink = sink
+		self.separator = ""
+	
+	def write(self, text):
+		"""write text (one or more lines) at the current level"""
+		self.chunks.append((self.level, text))
+	
+	def reserve(self):
+		"""reserve a chunk at the current level, to be filled later"""
+		self.chunks.append((self.level, None))
+		return len(self.chunks) - 1
+	
+	def fill(self, slot, text):
+		"""fill a reserved chunk (a chunk never filled is left out)"""
+		self.chunks[slot] = (self.chunks[slot][0], text)
+	
+	@contextlib.contextmanager
+	def indented(self, offset=1):
+		"""write at a level offset levels deeper, in the with block"""
+		outer = self.level
+		self.level = IndentLevel(outer, offset)
+		self.levels.append(self.level)
+		try:
+			yield self.level
+		finally:
+			self.level = outer
+	
+	def indented_chunks(self):
+		"""the chunks written, indented"""
+		for level in self.levels:
+			level.depth = level.parent.depth + level.offset
+		for level, text in self.chunks:
+			if text is None:
+				continue
+			if level.depth > 0:
+				prefix = INDENT * level.depth
+				text = prefix + text.replace("\n", "\n" + prefix)
+			yield text
+	
+	def getvalue(self):
+		"""the code written, indented"""
+		return "\n".join(self.indented_chunks())
+	
+	def flush(self):
+		"""write the chunks to the sink, if any, and forget them (only at the
+		root level: deeper, reserved chunks and levels may not be final)"""
+		if self.sink is None or self.level is not self.root:
+			return
+		for text in self.indented_chunks():
+			self.sink.write(self.separator)
+			self.sink.write(text)
+			self.separator = "\n"
+		self.levels = []
+		self.chunks = []
+
 
 #pylint: disable=too-many-public-methods
 class PythonFormatter():
@@ -37,23 +122,17 @@ class PythonFormatter():
 			s.BITARRAY                 : self.out_bitarray,
 			s.BITARRAY_RANGE           : self.out_bitarray_range,
 			s.CALL                     : self.out_call,
-			s.CASE_EXPR                : self.out_case_expr,
 			s.CASE_ITEM                : self.out_case_item,
 			s.COMPUTATION              : self.out_computation,
 			s.CONTEXT_AT               : self.out_context_at,
-			s.CONTEXT_EXPR             : self.out_context_expr,
 			s.CONTEXT_IN_COORDSYS      : self.out_context_in_coordsys,
 			s.CONTEXT_IN_NODE          : self.out_context_in_node,
 			s.CONTEXT_WITH             : self.out_context_with,
 			s.CONTEXT_ABOUT            : self.out_context_about,
 			s.DECL                     : self.out_decl,
-			s.DO_LOOP                  : self.out_do_loop,
-			s.FOR_LOOP                 : self.out_for_loop,
 			s.FOR_LOOP_FROM_TO_SEQUENCE: self.out_for_loop_from_to_sequence,
-			s.FUNCTION_DEF             : self.out_function_def,
 			s.FUNCTION_RETURN          : self.out_function_return,
 			s.VAR_NAME                 : self.out_var_name,
-			s.IF_EXPR                  : self.out_if_expr,
 			s.LOOP_CONTINUE            : self.out_loop_continue,
 			s.LOOP_EXIT                : self.out_loop_exit,
 			s.MAX_COMMAND              : self.out_max_command,
@@ -65,27 +144,23 @@ class PythonFormatter():
 			s.ON_MAP_DO_HANDLER        : self.out_on_map_do_handler,
 			s.OPERATOR                 : self.out_operator,
 			s.PATH_NAME                : self.out_path_name,
+			s.PARSE_ERROR              : self.out_parse_error,
 			s.POINT2                   : self.out_point2,
 			s.POINT3                   : self.out_point3,
 			s.POINT4                   : self.out_point4,
-			s.PROGRAM                  : self.out_program,
 			s.PROPERTY                 : self.out_property,
 			s.PROPERTY_ACCESSOR_INDEX  : self.out_property_accessor_index,
 			s.PROPERTY_ACCESSOR_MEMBER : self.out_property_accessor_member,
 			s.QUESTION                 : self.out_question,
 			s.REFERENCE                : self.out_reference,
 			s.STRING                   : self.out_string,
-			s.STRUCT_DEF               : self.out_struct_def,
 			s.STRUCT_MEMBER_ASSIGN     : self.out_struct_member_assign,
 			s.STRUCT_MEMBER_DATA       : self.out_struct_member_data,
-			s.STRUCT_MEMBER_METHOD     : self.out_struct_member_method,
 			s.EXPR_SEQ                 : self.out_expr_seq,
 			s.THROW                    : self.out_throw,
-			s.TRY_EXPR                 : self.out_try_expr,
 			s.UNARY_MINUS              : self.out_unary_minus,
 			s.UNARY_NOT                : self.out_unary_not,
 			s.VARIABLE_DECL            : self.out_variable_decl,
-			s.WHILE_LOOP               : self.out_while_loop,
 			s.LOCAL_DECL               : self.out_local_decl,
 			s.GLOBAL_DECL              : self.out_global_decl,
 			s.MOUSETOOL_DEF            : self.out_mousetool_def,
@@ -112,6 +187,22 @@ class PythonFormatter():
 			s.PY_NOVAR                 : self.out_py_novar
 			
 		}
+		# the constructs that are blocks of code: they are written to the
+		# emitter, at its current indentation level
+		self.EMIT = {
+			s.CASE_EXPR                : self.emit_case_expr,
+			s.CONTEXT_EXPR             : self.emit_context_expr,
+			s.DO_LOOP                  : self.emit_do_loop,
+			s.FOR_LOOP                 : self.emit_for_loop,
+			s.FUNCTION_DEF             : self.emit_function_def,
+			s.IF_EXPR                  : self.emit_if_expr,
+			s.PROGRAM                  : self.emit_program,
+			s.STRUCT_DEF               : self.emit_struct_def,
+			s.STRUCT_MEMBER_METHOD     : self.emit_struct_member_method,
+			s.TRY_EXPR                 : self.emit_try_expr,
+			s.WHILE_LOOP               : self.emit_while_loop
+		}
+		self.emitter = CodeEmitter()
 		# this are mxs globals that need a special translation in python
 		self.wellknown_var_names = {
 			"true"      : "True",
@@ -122,6 +213,11 @@ class PythonFormatter():
 			"unsupplied": "None"  # TODO Check this one
 		}
 		self.comments = comments
+		# the single line comments (the ones emitted) sorted by end line, with
+		# their rank in comments to emit them in the same order
+		single = sorted((c[2][0], n, "# " + c[1][1]) for n, c in enumerate(comments) if c[1][0] in [mxscp.SINGLE])
+		self.comment_lines = [c[0] for c in single]
+		self.comment_texts = [c[1:] for c in single]
 		self.cl = 0
 		self.generation_comments = []
 		self.limitations = {}
@@ -129,7 +225,7 @@ class PythonFormatter():
 	
 	def append_construct_comments(self, construct):
 		"""Appends generated commetns to code comments"""
-		self.generation_comments = self.generation_comments + construct.comments
+		self.generation_comments.extend(construct.comments)
 	
 	def warning_generation_comment(self, new_comment, limitation=None):
 		"""Emits a code generation comment that will be inserted in the generated code"""
@@ -166,8 +262,10 @@ class PythonFormatter():
 	
 	def consume_generation_comments(self):
 		"""Consumes the accumulated code generation comments"""
-		for _, _, limit in self.generation_comments:
-			if limit is not None:
+		consumed = self.generation_comments
+		self.generation_comments = []
+		for _, _, limit in consumed:
+			if limit is not None and limit not in self.limitations:
 				self.limitations[limit] = lim.LIMITATIONS[limit]
 		
 		def formatc(cmt):
@@ -176,10 +274,9 @@ class PythonFormatter():
 					if lim is None
 					else f"# ****** {kind} : {text} ({limi})")
 		
-		formatted = "\n".join(map(formatc, self.generation_comments))
+		formatted = "\n".join(map(formatc, consumed))
 		if len(formatted) > 0:
 			formatted = formatted + "\n"
-		self.generation_comments = []
 		return formatted
 	
 	def consume_limitations(self):
@@ -203,11 +300,9 @@ class PythonFormatter():
 		
 		ret = self.consume_generation_comments()
 		
-		def select(c):
-			(tol, _) = c[2]
-			return self.cl <= tol <= l and c[1][0] in [mxscp.SINGLE]
-		
-		selected = list(map(lambda c: "# " + c[1][1], filter(select, self.comments)))
+		first = bisect.bisect_left(self.comment_lines, self.cl)
+		last = bisect.bisect_right(self.comment_lines, l)
+		selected = [text for _, text in sorted(self.comment_texts[first:last])]
 		if len(selected) > 0:
 			ret = ret + '\n'.join(selected) + "\n"
 		self.cl = l + 1  # yucky
@@ -221,22 +316,62 @@ class PythonFormatter():
 	def out_py(self, v):
 		"""output a givn syntactic construct"""
 		self.append_construct_comments(v)
+		if v.construct in self.EMIT:
+			return self.rendered(v)
 		return self.SWITCH[v.construct](v)
 	
-	def out_program(self, t):
-		"""output the program construct"""
-		
-		def outline(c):
+	def rendered(self, v):
+		"""output a block construct (written to an emitter of its own)"""
+		outer = self.emitter
+		self.emitter = CodeEmitter()
+		try:
+			self.EMIT[v.construct](v)
+			return self.emitter.getvalue()
+		finally:
+			self.emitter = outer
+	
+	def write_py(self, v, sink):
+		"""output a given syntactic construct to a writable text sink (a top
+		level statement at a time)"""
+		outer = self.emitter
+		self.emitter = CodeEmitter(sink)
+		try:
+			self.emit(v)
+			self.emitter.flush()
+		finally:
+			self.emitter = outer
+	
+	def emit(self, v):
+		"""write a given syntactic construct to the emitter"""
+		self.append_construct_comments(v)
+		if v.construct in self.EMIT:
+			self.EMIT[v.construct](v)
+		else:
+			self.emitter.write(self.SWITCH[v.construct](v))
+	
+	def emit_all(self, constructs):
+		"""write constructs one after the other (an empty line if there are none)"""
+		if len(constructs) == 0:
+			self.emitter.write("")
+		for c in constructs:
+			self.emit(c)
+	
+	def emit_block(self, t):
+		"""write the body of a block, one level deeper"""
+		with self.emitter.indented():
+			self.emit(self.strip_subprogram_wrapper(t))
+	
+	def emit_program(self, t):
+		"""write the program construct"""
+		if len(t.args[0]) == 0:
+			self.emitter.write("pass")
+		for c in t.args[0]:
 			if not c.start is None:
 				comments = self.comments_before_line(c.start[0])
-				line = self.out_py(c)
-				return comments + line
-			return self.out_py(c)
-		
-		if len(t.args[0]) == 0:
-			return "pass"
-		mapped = map(outline, t.args[0])
-		return '\n'.join(mapped)
+				if comments:
+					self.emitter.write(comments[:-1])
+			self.emit(c)
+			self.emitter.flush()
 	
 	def out_expr_seq(self, t):
 		"""output the expr seq construct"""
@@ -250,11 +385,10 @@ class PythonFormatter():
 	
 	def out_computation(self, t):
 		"""output the computation construct"""
-		# we want to flatten the computation
-		argops = t.args[0]
-		flattened = [self.out_py(val) for val in argops]
-		joined = ' '.join(flattened)
-		return f"{joined}"
+		# the python operators have the same precedences than
+		# the mxs ones so the tree goes out without parenthesis
+		left, oper, right = t.args
+		return f"{self.out_py(left)} {self.out_py(oper)} {self.out_py(right)}"
 	
 	def out_call(self, t):
 		"""output the call construct"""
@@ -280,31 +414,22 @@ class PythonFormatter():
 		# otherwise, must be a mxs function from rt
 		return f"{fname}({arg})"
 	
-	def out_function_method(self, t, method=False):
-		"""output the function_method construct"""
+	def emit_function_method(self, t, method=False):
+		"""write the function_method construct"""
 		fname = t.args[0].args[0]
 		# set param names in the inner scope
 		targs = list(map(self.out_py, t.args[1]))
 		if method:
 			targs = ["self"] + targs
 		fargs = ', '.join(targs)
-		inner = t.args[2]
-		
-		# if the body is a subprogram
-		inner = self.strip_subprogram_wrapper(inner)
-		
-		fbody = self.out_py(inner)
-		
-		bodylines = fbody.split("\n")
-		if len(bodylines) == 0:
-			bodylines = ["pass"]
-		bodylines = map(lambda l: "    " + l, bodylines)
-		ifbody = '\n'.join(bodylines)
-		return f"def {fname}({fargs}):\n{ifbody}\n"
+		self.emitter.write(f"def {fname}({fargs}):")
+		# if the body is a subprogram, it is stripped
+		self.emit_block(t.args[2])
+		self.emitter.write("")
 	
-	def out_function_def(self, t):
-		"""output the function_def construct"""
-		return self.out_function_method(t)
+	def emit_function_def(self, t):
+		"""write the function_def construct"""
+		self.emit_function_method(t)
 	
 	def out_operand(self, t):
 		"""output the operand construct"""
@@ -382,43 +507,53 @@ class PythonFormatter():
 		"""output the string construct"""
 		return f'"{t.args[0]}"'
 	
-	def out_if_expr(self, t):
-		"""output the if_expr construct"""
+	def emit_if_expr(self, t):
+		"""write the if_expr construct"""
 		# the truth here is that in mxs if is
 		# an expression and in python it is a statement
 		# when the value of an if is ignored it does not
 		# matter but we will eventually have to deal with this
 		condition = self.out_py(t.args[0])
-		thenexpr = self.out_py(self.strip_subprogram_wrapper(t.args[1]))
-		ithenexpr = self.indent_block(thenexpr)
-		if t.args[2] is None:
-			return f"if {condition}:\n{ithenexpr}"
-		elseexpr = self.out_py(self.strip_subprogram_wrapper(t.args[2]))
-		ielseexpr = self.indent_block(elseexpr)
-		return f"if {condition}:\n{ithenexpr}\nelse:\n{ielseexpr}"
-	
-	def out_while_loop(self, t):
-		"""output the while_loop construct"""
+		self.emitter.write(f"if {condition}:")
+		self.emit_block(t.args[1])
+		if t.args[2] is not None:
+			self.emitter.write("else:")
+			self.emit_block(t.args[2])
+	
+	def emit_while_loop(self, t):
+		"""write the while_loop construct"""
 		whileexpr = self.out_py(t.args[0])
-		bodyexpr = self.out_py(self.strip_subprogram_wrapper(t.args[1]))
-		ibodyexpr = self.indent_block(bodyexpr)
-		return f"while {whileexpr}:\n{ibodyexpr}"
+		self.emitter.write(f"while {whileexpr}:")
+		self.emit_block(t.args[1])
 	
-	def out_do_loop(self, t):
-		"""output the do_loop construct"""
-		bodyexpr = self.out_py(self.strip_subprogram_wrapper(t.args[0]))
+	def emit_do_loop(self, t):
+		"""write the do_loop construct"""
+		self.emitter.write("while True:")
+		self.emit_block(t.args[0])
 		whileexpr = self.out_py(t.args[1])
-		ibodyexpr = self.indent_block(bodyexpr)
-		return f"while True:\n{ibodyexpr}\n    if not ({whileexpr}):\n        break"
+		with self.emitter.indented():
+			self.emitter.write(f"if not ({whileexpr}):")
+			with self.emitter.indented():
+				self.emitter.write("break")
 	
-	def out_for_loop(self, t):
-		"""output the for_loop construct"""
+	def emit_for_loop(self, t):
+		"""write the for_loop construct"""
 		var_names = ", ".join(list(map(self.out_py, t.args[0])))
 		source = t.args[1]
 		sequence = source[0]
 		whilev = source[1]
 		wherev = source[2]
-		bodyexpr = self.out_py(self.strip_subprogram_wrapper(t.args[2]))
+		# the loop line and the where/while tests come before the body but
+		# are output after it
+		header = self.emitter.reserve()
+		with self.emitter.indented():
+			wheretest = self.emitter.reserve()
+			with self.emitter.indented():
+				wherejump = self.emitter.reserve()
+			whiletest = self.emitter.reserve()
+			with self.emitter.indented():
+				whilejump = self.emitter.reserve()
+			self.emit(self.strip_subprogram_wrapper(t.args[2]))
 		
 		sequencestr = self.out_py(sequence)
 		
@@ -426,18 +561,19 @@ class PythonFormatter():
 		with self.nowarn():
 			if whilev is not None:
 				whilev = self.out_py(whilev)
-				bodyexpr = f"if not {whilev}:\n    break\n{bodyexpr}"
+				self.emitter.fill(whiletest, f"if not {whilev}:")
+				self.emitter.fill(whilejump, "break")
 		if wherev is not None:
 			wherev = self.out_py(wherev)
-			bodyexpr = f"if not {wherev}:\n    continue\n{bodyexpr}"
+			self.emitter.fill(wheretest, f"if not {wherev}:")
+			self.emitter.fill(wherejump, "continue")
 		
-		ibodyexpr = self.indent_block(bodyexpr)
 		# --- collect not supported
 		if t.args[3] == "collect":
 			self.warning_generation_comment("collect not yet supported in for loops", lim.L3)
 		# -------------------------
 		
-		return f"for {var_names} in {sequencestr}:\n{ibodyexpr}"
+		self.emitter.fill(header, f"for {var_names} in {sequencestr}:")
 	
 	def out_for_loop_from_to_sequence(self, t):
 		"""output the for_loop_from_to_sequence construct"""
@@ -452,7 +588,7 @@ class PythonFormatter():
 	def indent_lines(self, lines):
 		"""split a block of text in lines, indent them and return the
 		resulting list"""
-		return map(lambda l: "    " + l, lines.split("\n"))
+		return map(lambda l: INDENT + l, lines.split("\n"))
 	
 	def indent_block(self, lines):
 		"""indent a block of multiline text"""
@@ -500,8 +636,8 @@ class PythonFormatter():
 			return "\n".join(map(out_global, assignments))
 		return "\n".join(map(out_persistentglobal, assignments))
 	
-	def out_struct_def(self, t):
-		"""output the struct_def construct"""
+	def emit_struct_def(self, t):
+		"""write the struct_def construct"""
 		name = t.args[0].args[0]
 		members = t.args[1]
 		# filter data members
@@ -514,8 +650,16 @@ class PythonFormatter():
 		eventmembers = list(filter(lambda x: x.construct == s.ON_DO_HANDLER, members))
 		
 		# filter other members
-		imembers = self.indent_block('\n'.join(map(self.out_py, omembers)))
-		cmembers = self.indent_block(self.indent_block('\n'.join(map(self.out_py, amembers))))
+		self.emitter.write(f"class {name}:")
+		with self.emitter.indented():
+			self.emit_all(omembers)
+		with self.emitter.indented():
+			self.emitter.write("def __init__(self, **kwargs):")
+			with self.emitter.indented():
+				self.emitter.write("for key, value in kwargs.items():")
+				with self.emitter.indented():
+					self.emitter.write("setattr(self, key, value)")
+				self.emit_all(amembers)
 		
 		# we can take care of "on create" event members (in the constructor)
 		#createevents = filter(lambda x: x.args[0] == "create", eventmemebers)
@@ -524,8 +668,6 @@ class PythonFormatter():
 		if len(eventmembers) > 0:
 			self.warning_generation_comment("event handlers in structs not supported", lim.L4)
 		# -------------------------
-		#pylint: disable=line-too-long
-		return f"class {name}:\n{imembers}\n    def __init__(self, **kwargs):\n        for key, value in kwargs.items():\n            setattr(self, key, value)\n{cmembers}"
 	
 	def out_struct_member_assign(self, t):
 		"""output the struct_member_assign construct"""
@@ -538,9 +680,9 @@ class PythonFormatter():
 		name = t.args[0].args[0]
 		return f"{name} = None"
 	
-	def out_struct_member_method(self, t):
-		"""output the struct_member_method construct"""
-		return self.out_function_method(t.args[0], True)
+	def emit_struct_member_method(self, t):
+		"""write the struct_member_method construct"""
+		self.emit_function_method(t.args[0], True)
 	
 	def out_property(self, t):
 		"""output the property construct"""
@@ -612,82 +754,49 @@ class PythonFormatter():
 			return f"{tloopval} # WARNING: evaluated for side effects\nbreak # WARNING: loop exit value not supported yet"
 		return "break"
 	
-	def out_case_expr(self, t):
-		"""output the case_expr construct"""
+	def emit_case_expr(self, t):
+		"""write the case_expr construct"""
 		cases = t.args[1]
 		if len(cases) == 0:
-			return ""
+			self.emitter.write("")
+			return
 		lastcase = list(filter(lambda x: x.args[0] is None, cases))
 		normalcases = list(filter(lambda x: x.args[0] is not None, cases))
+		val = self.out_py(t.args[0]) if t.args[0] is not None else None
 		
-		def format_action(c):
-			return self.indent_block(self.out_py(self.strip_subprogram_wrapper(c)))
-		
-		def format_condition_action(c):
+		def emit_condition_action(keyword, c):
 			cond = self.out_py(c.args[0])
-			act = format_action(c.args[1])
-			return (cond, act)
+			condition = cond if val is None else f"{val} == {cond}"
+			self.emitter.write(f"{keyword} {condition}:")
+			self.emit_block(c.args[1])
 		
-		def with_val(normalcases):
-			val = self.out_py(t.args[0])
-			
-			def format_elif(c):
-				condition, action = format_condition_action(c)
-				return f"elif {val} == {condition}:\n{action}"
-			
-			firstcase = normalcases[0]
-			normalcases = normalcases[1:]
-			if len(normalcases) == 0:
-				# only a default case! do it all the time
-				return format_action(lastcase[0].args[1])
-			(condition, action) = format_condition_action(firstcase)
-			ret = f"if {val} == {condition}:\n{action}"
-			
-			if len(normalcases) > 0:
-				ret = ret + "\n" + "\n".join(list(map(format_elif, normalcases)))
-			
-			if len(lastcase) > 0:
-				action = format_action(lastcase[0].args[1])
-				ret = ret + f"\nelse:\n{action}"
-			return ret
+		firstcase = normalcases[0]
+		normalcases = normalcases[1:]
+		if len(normalcases) == 0:
+			# only a default case! do it all the time
+			self.emit_block(lastcase[0].args[1])
+			return
+		emit_condition_action("if", firstcase)
+		for c in normalcases:
+			emit_condition_action("elif", c)
 		
-		def without_val(normalcases):
-			def format_elif(c):
-				condition, action = format_condition_action(c)
-				return f"elif {condition}:\n{action}"
-			
-			firstcase = normalcases[0]
-			normalcases = normalcases[1:]
-			if len(normalcases) == 0:
-				# only a default case! do it all the time
-				return format_action(lastcase[0].args[1])
-			(condition, action) = format_condition_action(firstcase)
-			ret = f"if {condition}:\n{action}"
-			
-			if len(normalcases) > 0:
-				ret = ret + "\n" + "\n".join(list(map(format_elif, normalcases)))
-			
-			if len(lastcase) > 0:
-				action = format_action(lastcase[0].args[1])
-				ret = ret + f"\nelse:\n{action}"
-			return ret
-		
-		return without_val(normalcases) if t.args[0] is None else with_val(normalcases)
+		if len(lastcase) > 0:
+			self.emitter.write("else:")
+			self.emit_block(lastcase[0].args[1])
 	
 	def out_case_item(self, t):
 		"""output the case_item construct"""
 	
-	def out_try_expr(self, t):
-		"""output the try_expr construct"""
+	def emit_try_expr(self, t):
+		"""write the try_expr construct"""
 		# the truth here is that in mxs if is
 		# an expression and in python it is a statement
 		# when the value of an if is ignored it does not
 		# matter but we will eventually have to deal with this
-		tryexpr = self.out_py(self.strip_subprogram_wrapper(t.args[0]))
-		itryexpr = self.indent_block(tryexpr)
-		catchexpr = self.out_py(self.strip_subprogram_wrapper(t.args[1]))
-		icatchexpr = self.indent_block(catchexpr)
-		return f"try:\n{itryexpr}\nexcept Exception:\n{icatchexpr}"
+		self.emitter.write("try:")
+		self.emit_block(t.args[0])
+		self.emitter.write("except Exception:")
+		self.emit_block(t.args[1])
 	
 	def out_max_command(self, t):
 		"""output the max_command construct"""
@@ -749,14 +858,17 @@ class PythonFormatter():
 		val = self.out_py(t.args[0])
 		return f"with mxsshim.in_coordsys({val}):"
 	
-	def out_context_expr(self, t):
-		"""output the context_expr construct"""
+	def emit_context_expr(self, t):
+		"""write the context_expr construct"""
 		
 		def join_indented(prev, new):
 			return new if prev is None else f"{new}\n" + self.indent_block(prev)
 		
-		expr = self.strip_subprogram_wrapper(t.args[1])
-		texpr = self.out_py(expr)
+		# the with lines come before the expression but are output after
+		# it: the expression is one level deeper per with line
+		header = self.emitter.reserve()
+		with self.emitter.indented(0) as level:
+			self.emit(self.strip_subprogram_wrapper(t.args[1]))
 		contexts = t.args[0]
 		#tc = list(map(self.out_py, contexts))
 		tcontexts = list(filter(lambda x: x != "", map(self.out_py, contexts)))
@@ -764,10 +876,10 @@ class PythonFormatter():
 		if len(tcontexts) > 0:
 			context = functools.reduce(
 				join_indented,
-				reversed(tcontexts + [texpr])
+				reversed(tcontexts)
 			)
-			return context
-		return texpr
+			self.emitter.fill(header, context)
+			level.offset = len(tcontexts)
 	
 	def out_path_name(self, t):
 		"""output the path_name construct"""
@@ -998,6 +1110,14 @@ class PythonFormatter():
 		message = self.out_py(d.args[0])
 		return f'raise RuntimeError({message})'
 	
+	def out_parse_error(self, d):
+		"""output the parse_error construct (maxscript that failed to parse)"""
+		source, expected, _ = d.args
+		lines = [f"# ****** {s.COMMENT_ERROR} : could not parse, expected {expected}"]
+		# (the blanked comments leave spaces, the comments are output apart)
+		lines += [f"# {line}".rstrip() for line in source.split("\n")]
+		return "\n".join(lines)
+	
 	def out_reference(self, d):
 		"""output the reference construct"""
 		inner = self.out_py(d.args[0])
@@ -1060,17 +1180,47 @@ class PythonFormatter():
 		return ''
 
 
-def out_py(constructs, comments, file_header="Auto translated maxscript", snippet=False):
-	"""output the py construct"""
+def out_py(constructs, comments, file_header="Auto translated maxscript", snippet=False, sink=None):
+	"""output the py construct (written to sink, a writable text file, as it is
+	produced if given)"""
 	# mutating, disgusting:
 	pytreeprocess.preprocess(constructs)
 	#eprint(" ------ transformed syntax tree ---")
 	#eprint(constructs)
 	#eprint(" ----------------------------------")
 	cxt = PythonFormatter(comments)
+	if sink is not None:
+		if not snippet and file_header is not None:
+			sink.write(f"'''{file_header}'''\n")
+		cxt.write_py(constructs, sink)
+		sink.write("\n")
+		return None
 	if snippet:
 		return cxt.out_py(constructs) + "\n"
 	fh = "" if file_header is None else f"'''{file_header}'''\n"
 	# pylint: disable=line-too-long
 	# return f"{fh}from pymxs import runtime as rt\nimport mxsshim\nimport pymxs\n{cxt.out_py(constructs)}\n{cxt.flush_comments_at_end()}\n{cxt.consume_limitations()}"
 	return f"{fh}{cxt.out_py(constructs)}\n"
+
+
+def iter_py(statements, comments, file_header="Auto translated maxscript", snippet=False):
+	"""output the py of the top level constructs of statements (consumed one
+	at a time): give the python of each as soon as it is ready, the scopes and
+	generated names carrying over from a statement to the next.
+	Joined, the pieces are what out_py gives for the program of statements,
+	but for the functions and classes that the processing adds to the
+	program: they come just before their statement instead of at the top."""
+	state = pytreeprocess.ProcessState()
+	cxt = PythonFormatter(comments)
+	if not snippet and file_header is not None:
+		yield f"'''{file_header}'''\n"
+	separator = ""
+	for statement in statements:
+		program = s.Construct(s.PROGRAM, [statement])
+		pytreeprocess.preprocess(program, state)
+		yield separator + cxt.out_py(program)
+		separator = "\n"
+	if not separator:
+		# as out_program for an empty program
+		yield "pass"
+	yield "\n"
@@ -7,6 +7,7 @@ become possible in python:
 - The last line of functions is converted to a return statement
 """
 # pylint: disable=invalid-name, line-too-long, too-many-lines, broad-exception-raised
+import bisect
 import syntax
 from log import eprint
 
@@ -41,6 +42,7 @@ class TreeItem():
             self.parent_item.construct.args[self.arg_index] = c
         else:
             raise ValueError("Invalid parent")
+        add_to_index(self.parent_item, c)
 
     def append_construct(self, c):
         """Append a construct after this one"""
@@ -48,37 +50,121 @@ class TreeItem():
             self.parent_item.construct.args[self.arg_index].insert(self.array_index + 1, c)
         else:
             raise ValueError("Invalid parent")
+        add_to_index(self.parent_item, c)
+
+def iterate_children(tree_item):
+    """Iterate over the items of the children of tree_item (the args are
+    read as the iteration goes, like the tree is changed)"""
+    for index, arg in enumerate(tree_item.construct.args):
+        if isinstance(arg, syntax.Construct):
+            yield TreeItem(arg, tree_item, index)
+        elif isinstance(arg, list):
+            for i, litem in enumerate(arg):
+                yield TreeItem(litem, tree_item, index, i)
+
+# The iterations keep a stack of the children iterations of the items
+# they are in: no generator is as deep as the tree, nor the recursion.
 
 def iterate_item(tree_item):
     """Iterate below tree_itemi strting by the children, then this item"""
     if not tree_item.is_construct():
         return
-    for index, arg in enumerate(tree_item.construct.args):
+    stack = [(tree_item, iterate_children(tree_item))]
+    while stack:
+        item, children = stack[-1]
+        child = next(children, None)
+        if child is None:
+            stack.pop()
+            yield item
+        elif child.is_construct():
+            stack.append((child, iterate_children(child)))
+
+def child_constructs(construct):
+    """Iterate over the constructs that are the children of construct"""
+    for arg in construct.args:
         if isinstance(arg, syntax.Construct):
-            yield from iterate_item(TreeItem(arg, tree_item, index))
+            yield arg
         elif isinstance(arg, list):
-            for i, litem in enumerate(arg):
-                yield from iterate_item(TreeItem(litem, tree_item, index, i))
-    yield tree_item
+            for litem in arg:
+                if isinstance(litem, syntax.Construct):
+                    yield litem
+
+def index_kinds(construct, fresh=False):
+    """The kinds of the constructs in the tree of construct, indexed in the
+    constructs of the tree the first time (fresh indexes construct again)"""
+    kinds = None if fresh else getattr(construct, "indexed_kinds", None)
+    if kinds is not None:
+        return kinds
+    stack = [(construct, child_constructs(construct), {construct.construct})]
+    while True:
+        cnstr, children, kinds = stack[-1]
+        child = next(children, None)
+        if child is None:
+            stack.pop()
+            cnstr.indexed_kinds = frozenset(kinds)
+            if not stack:
+                return cnstr.indexed_kinds
+            stack[-1][2].update(cnstr.indexed_kinds)
+        else:
+            child_kinds = getattr(child, "indexed_kinds", None)
+            if child_kinds is None:
+                stack.append((child, child_constructs(child), {child.construct}))
+            else:
+                kinds.update(child_kinds)
+
+def add_to_index(item, construct):
+    """Index the kinds of construct, just put below item (or in place of the
+    construct of item), in item and its parents.
+    The indexed kinds are kept a superset of the kinds of the tree: the
+    constructs taken out of the tree stay indexed"""
+    kinds = None
+    for parent in iterate_parent(item):
+        indexed = getattr(parent.construct, "indexed_kinds", None)
+        if indexed is None:
+            continue
+        if kinds is None:
+            kinds = index_kinds(construct, True)
+        if kinds <= indexed:
+            break
+        parent.construct.indexed_kinds = indexed | kinds
+
+def iterate_kinds(tree_item, kinds):
+    """iterate_item for the items of the kinds of constructs only (the trees
+    indexed without them are skipped)"""
+    def has_kinds(item):
+        return item.is_construct() and not kinds.isdisjoint(index_kinds(item.construct))
+    if not has_kinds(tree_item):
+        return
+    stack = [(tree_item, iterate_children(tree_item))]
+    while stack:
+        item, children = stack[-1]
+        child = next(children, None)
+        if child is None:
+            stack.pop()
+            if item.construct.construct in kinds:
+                yield item
+        elif has_kinds(child):
+            stack.append((child, iterate_children(child)))
 
 def iterate_item_bfs(tree_item):
     """Iterate below tree_item starting by this item then the children"""
     if not tree_item.is_construct():
         return
     yield tree_item
-    for index, arg in enumerate(tree_item.construct.args):
-        if isinstance(arg, syntax.Construct):
-            yield from iterate_item_bfs(TreeItem(arg, tree_item, index))
-        elif isinstance(arg, list):
-            for i, litem in enumerate(arg):
-                yield from iterate_item_bfs(TreeItem(litem, tree_item, index, i))
+    stack = [iterate_children(tree_item)]
+    while stack:
+        child = next(stack[-1], None)
+        if child is None:
+            stack.pop()
+        elif child.is_construct():
+            yield child
+            stack.append(iterate_children(child))
 
 def iterate_parent(tree_item):
     """Iterate, walking the parents of this item"""
-    if tree_item is None:
-        return
-    yield tree_item
-    yield from iterate_parent(tree_item.parent_item)
+    while tree_item is not None:
+        yield tree_item
+        tree_item = tree_item.parent_item
 
 def all(selectors, subitem): #pylint: disable=redefined-builtin
     """Make sure all selectors match"""
@@ -95,9 +181,27 @@ def all(selectors, subitem): #pylint: disable=redefined-builtin
             return False
     return True
 
+def selected_kinds(selectors):
+    """The kinds of constructs that selectors can select (None for any)"""
+    kinds = None
+    for sel in selectors:
+        if isinstance(sel, list):
+            if any(getattr(subsel, "kinds", None) is None for subsel in sel):
+                continue
+            sel_kinds = frozenset().union(*(subsel.kinds for subsel in sel))
+        else:
+            sel_kinds = getattr(sel, "kinds", None)
+            if sel_kinds is None:
+                continue
+        kinds = sel_kinds if kinds is None else kinds & sel_kinds
+    return kinds
+
 def query(selectors, tree_item):
-    """Query by selectors starting at tree_item"""
-    return [subitem for subitem in iterate_item(tree_item)
+    """Query by selectors starting at tree_item (by the index of the kinds
+    of constructs when the selectors are for some kinds)"""
+    kinds = selected_kinds(selectors)
+    items = iterate_item(tree_item) if kinds is None else iterate_kinds(tree_item, kinds)
+    return [subitem for subitem in items
         if all(selectors, subitem)]
 
 def query_bfs(selectors, tree_item):
@@ -146,11 +250,45 @@ def filter_by_layering(item, layers):
     """Filter by layering"""
     return find_by_layering(item, layers) is not None
 
+def compile_layer(layer):
+    """(kinds, top level) of a layer of a layering: the kinds of constructs it
+    matches (None for any) and whether it matches above the top level"""
+    if layer == ANY_CONSTRUCT:
+        return None, False
+    if isinstance(layer, list):
+        return frozenset(layer) - {TOP_LEVEL}, TOP_LEVEL in layer
+    return frozenset([layer]) - {TOP_LEVEL}, layer == TOP_LEVEL
+
+class Pattern:
+    #pylint: disable=too-few-public-methods
+    """A compiled selector: the layering that an item and its parents match
+    (as find_by_layering), then other filters on the item.
+    kinds has the kinds of constructs of the items it can select (None for
+    any): the queries only go through the trees indexed with them"""
+    def __init__(self, layering, filters=()):
+        self.layers = [compile_layer(layer) for layer in layering]
+        self.kinds = self.layers[0][0] if self.layers else None
+        self.filters = list(filters)
+
+    def __call__(self, item):
+        parent = item
+        for kinds, top_level in self.layers:
+            if parent is None:
+                # (the rest of the layering is not looked at, see find_by_layering)
+                if not top_level:
+                    return False
+                break
+            if kinds is not None and parent.construct.construct not in kinds:
+                return False
+            parent = parent.parent_item
+        for filt in self.filters:
+            if not filt(item):
+                return False
+        return True
+
 def filter_constructs(constructs):
     """Filter constructs (need to be in the provided list)"""
-    def filt(item):
-        return item.construct.construct in constructs
-    return filt
+    return Pattern([list(constructs)])
 
 def filter_and(filters):
     """Filter items that need to match all filters (and multiple filters)"""
@@ -185,22 +323,50 @@ def last_program_step(item):
 			item.array_index is not None and
 			item.array_index == len(item.parent_item.construct.args[0]) - 1)
 
-def at_indent_0_from_function_program(item):
-    # this is what we need above our head to be in this category
-    """Filter at indent 0 of function program"""
-    layering = [ANY_CONSTRUCT, syntax.PROGRAM, syntax.EXPR_SEQ, syntax.FUNCTION_DEF]
-    return filter_by_layering(item, layering)
+# Filter at indent 0 of function program
+# (this is what we need above our head to be in this category)
+at_indent_0_from_function_program = Pattern(
+        [ANY_CONSTRUCT, syntax.PROGRAM, syntax.EXPR_SEQ, syntax.FUNCTION_DEF])
 
-def is_function_program(item):
-    """Filter is function program"""
-    return find_by_layering(
-            item,
-            [syntax.PROGRAM, [TOP_LEVEL, syntax.EXPR_SEQ], syntax.FUNCTION_DEF]) is not None
+# Filter is function program
+is_function_program = Pattern(
+        [syntax.PROGRAM, [TOP_LEVEL, syntax.EXPR_SEQ], syntax.FUNCTION_DEF])
 
 def is_program(item):
     """Filter is program"""
     return item.construct.construct == syntax.PROGRAM
 
+def find_enclosing(tree_item, selector, memo):
+    """find_first_parent([selector], tree_item), memoized in the items climbed
+    (as their memo attribute): the items of a query or a traversal share
+    their parents, the next ones only climb up to an item already climbed.
+    The parents of an item and their kinds of constructs that selector looks
+    at do not change, whatever the passes do to the tree"""
+    climbed = []
+    item = tree_item
+    found = None
+    while item is not None:
+        known = vars(item)
+        if memo in known:
+            found = known[memo]
+            break
+        climbed.append(item)
+        if selector(item):
+            found = item
+            break
+        item = item.parent_item
+    for item in climbed:
+        setattr(item, memo, found)
+    return found
+
+def enclosing_function_program(tree_item):
+    """The function program tree_item is in (or is)"""
+    return find_enclosing(tree_item, is_function_program, "function_program")
+
+def enclosing_program(tree_item):
+    """The program tree_item is in (or is)"""
+    return find_enclosing(tree_item, is_program, "program")
+
 PYTHON_EXPR = [
             syntax.ARRAY,
             syntax.BITARRAY,
@@ -225,20 +391,12 @@ is_try_expr = filter_constructs([syntax.TRY_EXPR])
 is_if_expr = filter_constructs([syntax.IF_EXPR])
 
 def is_layering(layering):
-    """A filter that deos filter_by_layering"""
-    def filt(item):
-        return filter_by_layering(item, layering)
-    return filt
+    """A filter that deos filter_by_layering (compiled)"""
+    return Pattern(layering)
 
-def is_used_as_statement(item):
-    """Filter someting tat is used as a statement"""
-    # this is what we need above our head to be in this category
-    layering = [
-            ANY_CONSTRUCT,
-            syntax.PROGRAM
-            ]
-
-    return filter_by_layering(item, layering)
+# Filter someting tat is used as a statement
+# (this is what we need above our head to be in this category)
+is_used_as_statement = Pattern([ANY_CONSTRUCT, syntax.PROGRAM])
 
 def is_used_as_expression(item):
     """Filter someting tat is used as an expression"""
@@ -255,8 +413,12 @@ def return_last_function_value(topconstruct):
         ], TreeItem(topconstruct))
     # for each of these items we want to wrap them in a return
     for item in items:
-        item.replace_construct(
-            syntax.Construct(syntax.FUNCTION_RETURN, item.construct))
+        return_value(item)
+
+def return_value(item):
+    """Wrap the value of item in a return"""
+    item.replace_construct(
+        syntax.Construct(syntax.FUNCTION_RETURN, item.construct))
 
 def return_last_function_assignment(topconstruct):
     """(processing) makes the last assignement of a function be returned"""
@@ -266,54 +428,51 @@ def return_last_function_assignment(topconstruct):
             last_program_step
         ], TreeItem(topconstruct))
     for item in items:
-        # special case of returning a PY_TUPLE
-        if item.construct.args[0].construct == syntax.PY_TUPLE:
-            # if the first element of the tuple is a no var (_) replace it by a ret
-            retprop = item.construct.args[0].args[0][0]
-            if retprop.construct == syntax.PY_NOVAR:
-                retprop = syntax.Construct(syntax.VAR_NAME, "_ret")
-                retprop.resolution = RESOLUTION_NAKED
-                item.construct.args[0].args[0][0] = retprop
+        return_assigned_value(item)
+
+def return_assigned_value(item):
+    """Return what the assignment item assigns, after it"""
+    # special case of returning a PY_TUPLE
+    if item.construct.args[0].construct == syntax.PY_TUPLE:
+        # if the first element of the tuple is a no var (_) replace it by a ret
+        retprop = item.construct.args[0].args[0][0]
+        if retprop.construct == syntax.PY_NOVAR:
+            retprop = syntax.Construct(syntax.VAR_NAME, "_ret")
+            retprop.resolution = RESOLUTION_NAKED
+            item.construct.args[0].args[0][0] = retprop
+            add_to_index(TreeItem(item.construct.args[0], item, 0), retprop)
+        item.append_construct(
+            syntax.Construct(syntax.FUNCTION_RETURN, retprop))
+
+    else:
+        assigned_varname = item.construct.args[0].args[0]
+        # does not work for paths
+        if assigned_varname.construct == syntax.VAR_NAME:
+            assigned_string = assigned_varname.args[0]
+            prop = syntax.Construct(syntax.VAR_NAME, assigned_string)
+            prop.resolution = assigned_varname.resolution
             item.append_construct(
-                syntax.Construct(syntax.FUNCTION_RETURN, retprop))
-
-        else:
-            assigned_varname = item.construct.args[0].args[0]
-            # does not work for paths
-            if assigned_varname.construct == syntax.VAR_NAME:
-                assigned_string = assigned_varname.args[0]
-                prop = syntax.Construct(syntax.VAR_NAME, assigned_string)
-                prop.resolution = assigned_varname.resolution
-                item.append_construct(
-                    syntax.Construct(syntax.FUNCTION_RETURN, prop))
+                syntax.Construct(syntax.FUNCTION_RETURN, prop))
 
 def replace_op_by_call(construct, opname, call, call_id_construct):
-    """Damn"""
-    def replace(ops_and_operands):
-        selection = filter(
-            lambda iop: iop[1].construct == syntax.OPERATOR and iop[1].args[0] == opname,
-            enumerate(ops_and_operands))
-
-        l = []
-        prev = 0
-        for i, _ in selection:
-            l = (l + ops_and_operands[prev: i-1] +
-                    [syntax.Construct(
-                        syntax.CALL,
-                        syntax.Construct(call_id_construct, call),
-                        [ops_and_operands[i-1], ops_and_operands[i+1]])])
-            prev = i + 2
-
-        l = l + ops_and_operands[prev:]
-        return l
-    if construct.construct == syntax.COMPUTATION:
-        construct.args = (replace(construct.args[0]),)
+    """Turn a binary computation with the opname operator into a call (tells
+    if it did)"""
+    if construct.construct != syntax.COMPUTATION:
+        return False
+    left, oper, right = construct.args
+    if oper.args[0] == opname:
+        construct.construct = syntax.CALL
+        construct.args = [syntax.Construct(call_id_construct, call), [left, right]]
+        return True
+    return False
 
 def return_last_block_step(topitem):
     """Damn"""
     cnstr = topitem.construct
+    cnstr_item = topitem
     if cnstr.construct == syntax.EXPR_SEQ:
         cnstr = cnstr.args[0]
+        cnstr_item = TreeItem(cnstr, topitem, 0)
     if cnstr.construct == syntax.PROGRAM:
         steplist = cnstr.args[0]
         # we could add a return None to an empty steplist but
@@ -323,6 +482,7 @@ def return_last_block_step(topitem):
             if last.construct != syntax.FUNCTION_RETURN:
                 ret = syntax.Construct(syntax.FUNCTION_RETURN, last)
                 steplist[-1] = ret
+                add_to_index(cnstr_item, ret)
     # there are plenty of cases where the construct is one thing
     # and is returnable
     elif cnstr.construct in PYTHON_EXPR:
@@ -332,12 +492,13 @@ def replace_operators_by_calls(topconstruct, opname, call, call_id_construct):
     """Replace multiple operators by calls"""
     # find all computations
     for computation in query([is_computation], TreeItem(topconstruct)):
-        replace_op_by_call(computation.construct, opname, call, call_id_construct)
+        if replace_op_by_call(computation.construct, opname, call, call_id_construct):
+            add_to_index(computation, computation.construct)
 
 # if trycatch is not used at the root level of a program, its value
 # is needed, so it needs to be transformed to an expression
-def replace_non_program_trycatch(topconstruct):
-    """Hardcore"""
+def replace_non_program_trycatch(topconstruct, first=0):
+    """Hardcore (the functions are numbered from first, gives how many were made)"""
     def replace(n, trycatchitem):
         trycatchconstruct = trycatchitem.construct
         new_func_name = f"try_catch_fn_{n}"
@@ -359,9 +520,10 @@ def replace_non_program_trycatch(topconstruct):
         # (this may not even be needed because we go bottom up... not too sure)
 
         # add the created function to the outer function
-        function_program = find_first_parent([is_function_program], trycatchitem)
+        function_program = enclosing_function_program(trycatchitem)
         function_program_construct = function_program.construct
         function_program_construct.args[0].insert(0, func)
+        add_to_index(function_program, func)
 
         # replace the trycatch item by A CALL to the the new func
         fn = syntax.Construct(syntax.VAR_NAME, new_func_name)
@@ -382,16 +544,17 @@ def replace_non_program_trycatch(topconstruct):
 
     # for the more complex case of try cach in the middle of expressions, we
     # need to replace them by function calls
-    for n, trycatch in enumerate(
-            query([is_try_expr,
+    trycatches = query([is_try_expr,
             is_used_as_expression],
-            TreeItem(topconstruct))):
+            TreeItem(topconstruct))
+    for n, trycatch in enumerate(trycatches, first):
         replace(n, trycatch)
+    return len(trycatches)
 
 # if ifexpr is not used at the root level of a program, its value
 # is needed, so it needs to be transformed to an expression
-def replace_non_program_ifexpr(topconstruct):
-    """Hardcore, ifexpr replacement by function"""
+def replace_non_program_ifexpr(topconstruct, first=0):
+    """Hardcore, ifexpr replacement by function (numbered from first, gives how many were made)"""
     def replace(n, ifexpritem):
         ifexprconstruct = ifexpritem.construct
         new_func_name = f"if_expr_fn_{n}"
@@ -414,9 +577,10 @@ def replace_non_program_ifexpr(topconstruct):
         # (this may not even be needed because we go bottom up... not too sure)
 
         # add the created function to the outer function
-        function_program = find_first_parent([is_function_program], ifexpritem)
+        function_program = enclosing_function_program(ifexpritem)
         function_program_construct = function_program.construct
         function_program_construct.args[0].insert(0, func)
+        add_to_index(function_program, func)
 
         # replace the ifexpr item by A CALL to the the new func
         fn = syntax.Construct(syntax.VAR_NAME, new_func_name)
@@ -438,19 +602,25 @@ def replace_non_program_ifexpr(topconstruct):
 
     # for the more complex case of try cach in the middle of expressions, we
     # need to replace them by function calls
-    for n, ifexpr in enumerate(query([is_if_expr, is_used_as_expression], TreeItem(topconstruct))):
+    ifexprs = query([is_if_expr, is_used_as_expression], TreeItem(topconstruct))
+    for n, ifexpr in enumerate(ifexprs, first):
         eprint(f">>> {is_used_as_expression(ifexpr)} <<<< {ifexpr.construct.construct}")
         eprint(f"{ ifexpr.parent_item.construct.construct }")
         eprint(f"{is_used_as_statement(ifexpr)}")
         eprint(f"{is_layering([ANY_CONSTRUCT])(ifexpr)}")
         eprint(f"{is_layering([ANY_CONSTRUCT, syntax.PROGRAM])(ifexpr)}")
         replace(n, ifexpr)
+    return len(ifexprs)
 
 
 def lowercase_names(topconstruct):
     """replace all names by lowercase (mxs is case insensitive, keep things consistent)"""
     for vn  in query([is_layering([syntax.VAR_NAME])], TreeItem(topconstruct)):
-        vn.construct.args[0] = vn.construct.args[0].lower()
+        lowercase_name(vn)
+
+def lowercase_name(vn):
+    """replace the name of the VAR_NAME item vn by lowercase"""
+    vn.construct.args[0] = vn.construct.args[0].lower()
 
 def declare_assigned_locals_as_nonlocal(topconstruct: syntax.Construct):
     """
@@ -738,11 +908,12 @@ class ScopeSet:
         """Declare the usage of a variable, setting its scope and resolution"""
         self.resolve(v)
 
-def annotate_scopes(topconstruct):
+def annotate_scopes(topconstruct, global_scopeset=None):
     """Transform the syntax tree from a topconstruct so that all variables are
-    scoped and resolved"""
+    scoped and resolved (global_scopeset has the globals declared before)"""
     #pylint: disable=too-many-branches, too-many-statements
-    global_scopeset = ScopeSet()
+    if global_scopeset is None:
+        global_scopeset = ScopeSet()
     scopeset = global_scopeset
     for vn in iterate_item_bfs(TreeItem(topconstruct)):
         cn = vn.construct.construct
@@ -951,9 +1122,10 @@ def substitute_macroscripts(topconstruct):
         # program
         # (note: we do this after because this breaks indices... could cause other
         # problems?)
-        function_program = find_first_parent([is_function_program], macro_script_it)
+        function_program = enclosing_function_program(macro_script_it)
         function_program_construct = function_program.construct
         function_program_construct.args[0].insert(0, decl_class)
+        add_to_index(function_program, decl_class)
 
 def substitute_rollouts(topconstruct):
     """Process the syntax tree to subsitute rollouts with python constructs"""
@@ -1010,9 +1182,10 @@ def substitute_rollouts(topconstruct):
         # program
         # (note: we do this after because this breaks indices... could cause other
         # problems?)
-        function_program = find_first_parent([is_function_program], rollout_it)
+        function_program = enclosing_function_program(rollout_it)
         function_program_construct = function_program.construct
         function_program_construct.args[0].insert(0, decl_class)
+        add_to_index(function_program, decl_class)
 
 def substitute_plugins(topconstruct):
     """Process the syntax tree to subsitute plugins with python constructs"""
@@ -1069,9 +1242,10 @@ def substitute_plugins(topconstruct):
         # program
         # (note: we do this after because this breaks indices... could cause other
         # problems?)
-        function_program = find_first_parent([is_function_program], plugin_it)
+        function_program = enclosing_function_program(plugin_it)
         function_program_construct = function_program.construct
         function_program_construct.args[0].insert(0, decl_class)
+        add_to_index(function_program, decl_class)
 
 def substitute_attributes(topconstruct):
     """Process the syntax tree to subsitute attributes with python constructs"""
@@ -1128,9 +1302,10 @@ def substitute_attributes(topconstruct):
         # program
         # (note: we do this after because this breaks indices... could cause other
         # problems?)
-        function_program = find_first_parent([is_function_program], plugin_it)
+        function_program = enclosing_function_program(plugin_it)
         function_program_construct = function_program.construct
         function_program_construct.args[0].insert(0, decl_class)
+        add_to_index(function_program, decl_class)
 
 def flatten_exprseq_outside_computation(topconstruct):
     """Flattens an expr seq"""
@@ -1148,57 +1323,83 @@ def flatten_exprseq_outside_computation(topconstruct):
 def declare_references(topconstruct):
     """omg"""
     for vn in query([is_layering([syntax.REFERENCE])], TreeItem(topconstruct)):
-        referenced = vn.construct.args[0]
-        if referenced.construct == syntax.PROPERTY:
-            if referenced.args[1] is None:
-                # this is a simple "name" thing. if it has been
-                # scoped as rt. then well we should instead declare it locally
-                varname = referenced.args[0]
-                if hasattr(varname, "mark_for_local_declaration"):
-                    program = find_first_parent([is_program], vn)
-                    snamec = syntax.Construct(syntax.VAR_NAME, varname.args[0])
-                    snamec.resolution = RESOLUTION_NAKED
-                    undefc = syntax.Construct(syntax.VAR_NAME, "udefined")
-                    undefc.resolution = RESOLUTION_NAKED
-                    declc = syntax.Construct(syntax.DECL, snamec, None)
-                    program.construct.args[0].insert(0, declc)
+        declare_reference(vn)
+
+def declare_reference(vn):
+    """Declare the name referenced by the REFERENCE item vn in its program,
+    if it has been marked for a local declaration"""
+    referenced = vn.construct.args[0]
+    if referenced.construct == syntax.PROPERTY:
+        if referenced.args[1] is None:
+            # this is a simple "name" thing. if it has been
+            # scoped as rt. then well we should instead declare it locally
+            varname = referenced.args[0]
+            if hasattr(varname, "mark_for_local_declaration"):
+                program = enclosing_program(vn)
+                snamec = syntax.Construct(syntax.VAR_NAME, varname.args[0])
+                snamec.resolution = RESOLUTION_NAKED
+                undefc = syntax.Construct(syntax.VAR_NAME, "udefined")
+                undefc.resolution = RESOLUTION_NAKED
+                declc = syntax.Construct(syntax.DECL, snamec, None)
+                program.construct.args[0].insert(0, declc)
+                add_to_index(program, declc)
 
 def process_call_byref_assign(topconstruct):
     """we are looking for byref calls that are at the toplevel of a program block"""
     for topcalls in query([is_layering([syntax.CALL, syntax.ASSIGNMENT, syntax.PROGRAM])], TreeItem(topconstruct)):
-        assignment = topcalls.parent_item
-        #c = topcalls.construct
-        # -- check the args of this call: do them contain a reference
-        # we need to find all the
-        refs = query([is_layering([syntax.REFERENCE, syntax.CALL, syntax.ASSIGNMENT, syntax.PROGRAM])], topcalls)
-        if len(refs) > 0:
-            var_names = list(map(lambda r: r.construct.args[0].args[0], refs))
-            var_names.insert(0, assignment.construct.args[0])
-            res_tuple = syntax.Construct(syntax.PY_TUPLE, var_names)
-            # here we need to create a tuple
-            assignment.construct.args[0] = res_tuple
+        assign_byref_value(topcalls)
+
+def assign_byref_value(topcalls):
+    """Assign the references passed to the call topcalls along with the value
+    it assigns"""
+    assignment = topcalls.parent_item
+    #c = topcalls.construct
+    # -- check the args of this call: do them contain a reference
+    # we need to find all the
+    refs = query([is_layering([syntax.REFERENCE, syntax.CALL, syntax.ASSIGNMENT, syntax.PROGRAM])], topcalls)
+    if len(refs) > 0:
+        var_names = list(map(lambda r: r.construct.args[0].args[0], refs))
+        var_names.insert(0, assignment.construct.args[0])
+        res_tuple = syntax.Construct(syntax.PY_TUPLE, var_names)
+        # here we need to create a tuple
+        assignment.construct.args[0] = res_tuple
+        add_to_index(assignment, res_tuple)
 
 def process_call_byref_noassign(topconstruct):
     """we are looking for assignations from byref calls that are at the toplevel of a program block"""
     for topcalls in query([is_layering([syntax.CALL, syntax.PROGRAM])], TreeItem(topconstruct)):
-        c = topcalls.construct
-        # -- check the args of this call: do them contain a reference
-        # we need to find all the
-        refs = query([is_layering([syntax.REFERENCE, syntax.CALL, syntax.PROGRAM])], topcalls)
-        if len(refs) > 0:
-            var_names = list(map(lambda r: r.construct.args[0].args[0], refs))
-            var_names.insert(0, syntax.Construct(syntax.PY_NOVAR))
-            res_tuple = syntax.Construct(syntax.PY_TUPLE, var_names)
-            assign = syntax.Construct(syntax.ASSIGNMENT, res_tuple, "=", c)
-            # here we need to create a tuple
-            topcalls.replace_construct(assign)
-
-def preprocess(topconstruct):
-    """Apply all pre processing operations to the syntax tree.
-    This is not super efficient because we have multiple passes,
-    etc... meant to be "simple" rather than performant :)"""
+        assign_byref_statement(topcalls)
+
+def assign_byref_statement(topcalls):
+    """Assign the references passed to the call topcalls (a statement)"""
+    c = topcalls.construct
+    # -- check the args of this call: do them contain a reference
+    # we need to find all the
+    refs = query([is_layering([syntax.REFERENCE, syntax.CALL, syntax.PROGRAM])], topcalls)
+    if len(refs) > 0:
+        var_names = list(map(lambda r: r.construct.args[0].args[0], refs))
+        var_names.insert(0, syntax.Construct(syntax.PY_NOVAR))
+        res_tuple = syntax.Construct(syntax.PY_TUPLE, var_names)
+        assign = syntax.Construct(syntax.ASSIGNMENT, res_tuple, "=", c)
+        # here we need to create a tuple
+        topcalls.replace_construct(assign)
+
+class ProcessState:
+    #pylint: disable=too-few-public-methods
+    """What the processing of the top level statements of a file, one
+    statement at a time, carries from a statement to the next"""
+    def __init__(self):
+        self.global_scopeset = ScopeSet()
+        self.try_catch_functions = 0
+        self.if_expr_functions = 0
+
+def preprocess_sequential(topconstruct, state=None):
+    """Apply all pre processing operations to the syntax tree, one pass
+    after the other (what preprocess does in fewer traversals)"""
+    if state is None:
+        state = ProcessState()
     lowercase_names(topconstruct)
-    annotate_scopes(topconstruct)
+    annotate_scopes(topconstruct, state.global_scopeset)
     # this is probably useless:
     process_call_byref_assign(topconstruct)
     process_call_byref_noassign(topconstruct)
@@ -1210,6 +1411,154 @@ def preprocess(topconstruct):
     return_last_function_value(topconstruct)
     return_last_function_assignment(topconstruct)
     replace_operators_by_calls(topconstruct, "as", "as_type", syntax.PY_RT_VAR_NAME)
-    replace_non_program_trycatch(topconstruct)
-    replace_non_program_ifexpr(topconstruct)
+    state.try_catch_functions += replace_non_program_trycatch(topconstruct, state.try_catch_functions)
+    state.if_expr_functions += replace_non_program_ifexpr(topconstruct, state.if_expr_functions)
     flatten_exprseq_outside_computation(topconstruct)
+
+# ############## FUSED PROCESSING
+# The steps of preprocess are run in as few traversals of the tree as they
+# allow: the consecutive rewrites share a single traversal (each item is
+# visited by the rewrites in order), the passes that need a traversal of
+# their own (the whole tree annotated first, or constructs inserted ahead of
+# the items queried) run alone, and the steps looking for kinds of constructs
+# that are not indexed in the tree are skipped.
+
+class Rewrite:
+    #pylint: disable=too-few-public-methods
+    """A processing step visiting the items its pattern selects, in post
+    order, then finishing the work it puts off until after the traversal
+    (when it would change the tree under the rewrites that follow: the
+    rewrites after it in the traversal put theirs off too)"""
+    def __init__(self, pattern, visit, finish=None):
+        self.pattern = pattern
+        self.kinds = pattern.kinds
+        self.visit = visit
+        self.finish = finish
+
+class Pass:
+    #pylint: disable=too-few-public-methods
+    """A processing step run alone on the tree (kinds is None when it runs
+    whatever the constructs of the tree)"""
+    def __init__(self, kinds, run):
+        self.kinds = None if kinds is None else frozenset(kinds)
+        self.run = run
+
+class Rules:
+    """The rewrites sharing a traversal, matched together: the ones that can
+    select an item are looked up by the kind of its construct"""
+    def __init__(self, rewrites):
+        self.rewrites = rewrites
+        self.by_kind = {}
+        if any(rewrite.kinds is None for rewrite in rewrites):
+            self.kinds = None
+        else:
+            self.kinds = frozenset().union(*(rewrite.kinds for rewrite in rewrites))
+
+    def positions(self, kind):
+        """The positions of the rewrites that can select a construct of kind"""
+        positions = self.by_kind.get(kind)
+        if positions is None:
+            positions = [i for i, rewrite in enumerate(self.rewrites)
+                if rewrite.kinds is None or kind in rewrite.kinds]
+            self.by_kind[kind] = positions
+        return positions
+
+    def visit(self, item):
+        """Visit item by the rewrites that select it, in order (the rewrites
+        after one that changes the construct are looked up for its new kind)"""
+        position = 0
+        while True:
+            positions = self.positions(item.construct.construct)
+            i = bisect.bisect_left(positions, position)
+            if i == len(positions):
+                return
+            rewrite = self.rewrites[positions[i]]
+            if rewrite.pattern(item):
+                rewrite.visit(item)
+            position = positions[i] + 1
+
+def processing_steps(state):
+    """The steps of preprocess, in order"""
+    byref_statements = []
+    references = []
+
+    def assign_byref_statements():
+        # the calls wrapped in assignments would take the references of
+        # the calls below them for byref values
+        for topcalls in byref_statements:
+            assign_byref_statement(topcalls)
+
+    def declare_collected_references():
+        # the declarations are inserted in the programs that are traversed
+        for vn in references:
+            declare_reference(vn)
+
+    def replace_as_operator(item):
+        if replace_op_by_call(item.construct, "as", "as_type", syntax.PY_RT_VAR_NAME):
+            add_to_index(item, item.construct)
+
+    def replace_trycatch(topconstruct):
+        state.try_catch_functions += replace_non_program_trycatch(topconstruct, state.try_catch_functions)
+
+    def replace_ifexpr(topconstruct):
+        state.if_expr_functions += replace_non_program_ifexpr(topconstruct, state.if_expr_functions)
+
+    function_end = [syntax.PROGRAM, syntax.EXPR_SEQ, syntax.FUNCTION_DEF]
+    return [
+        Rewrite(Pattern([syntax.VAR_NAME]), lowercase_name),
+        Pass(None, lambda topconstruct: annotate_scopes(topconstruct, state.global_scopeset)),
+        Rewrite(Pattern([syntax.CALL, syntax.ASSIGNMENT, syntax.PROGRAM]), assign_byref_value),
+        Rewrite(Pattern([syntax.CALL, syntax.PROGRAM]), byref_statements.append,
+            assign_byref_statements),
+        Rewrite(Pattern([syntax.REFERENCE]), references.append, declare_collected_references),
+        Pass([syntax.MACROSCRIPT_DEF], substitute_macroscripts),
+        Pass([syntax.ROLLOUT_DEF], substitute_rollouts),
+        Pass([syntax.PLUGIN_DEF], substitute_plugins),
+        Pass([syntax.ATTRIBUTES_DEF], substitute_attributes),
+        Rewrite(Pattern([PYTHON_EXPR] + function_end, [last_program_step]), return_value),
+        Rewrite(Pattern([syntax.ASSIGNMENT] + function_end, [last_program_step]),
+            return_assigned_value),
+        Rewrite(Pattern([syntax.COMPUTATION]), replace_as_operator),
+        Pass([syntax.TRY_EXPR], replace_trycatch),
+        Pass([syntax.IF_EXPR], replace_ifexpr),
+        Pass([syntax.EXPR_SEQ], flatten_exprseq_outside_computation)]
+
+def traverse(topconstruct, rewrites):
+    """Run the rewrites in a single traversal of topconstruct (of the trees
+    indexed with the kinds of constructs they select)"""
+    rules = Rules(rewrites)
+    top = TreeItem(topconstruct)
+    for item in iterate_item(top) if rules.kinds is None else iterate_kinds(top, rules.kinds):
+        rules.visit(item)
+    for rewrite in rewrites:
+        if rewrite.finish is not None:
+            rewrite.finish()
+
+def run_steps(topconstruct, steps):
+    """Run the processing steps on topconstruct, the consecutive rewrites in
+    a single traversal, skipping the passes whose kinds of constructs are not
+    indexed in the tree (the rewrites are not skipped: the rewrites before
+    them in the traversal may create their kinds, and the traversal only
+    goes through the trees indexed with them anyway)"""
+    rewrites = []
+    for step in steps:
+        # the steps that follow a finish (or a pass) need its changes
+        if rewrites and (not isinstance(step, Rewrite) or
+                (rewrites[-1].finish is not None and step.finish is None)):
+            traverse(topconstruct, rewrites)
+            rewrites = []
+        if isinstance(step, Rewrite):
+            rewrites.append(step)
+        elif step.kinds is None or not step.kinds.isdisjoint(index_kinds(topconstruct)):
+            step.run(topconstruct)
+    if rewrites:
+        traverse(topconstruct, rewrites)
+
+def preprocess(topconstruct, state=None):
+    """Apply all pre processing operations to the syntax tree (the same as
+    preprocess_sequential, fusing the passes that can share a traversal).
+    state carries the scopes and generated names of the statements
+    processed before (when a program is processed by parts)"""
+    if state is None:
+        state = ProcessState()
+    run_steps(topconstruct, processing_steps(state))
@@ -0,0 +1,586 @@
+"""
+The parsec combinators used by mxsp, made so that they can also run
+without recursion.
+
+Every parser of this module has two forms:
+
+- the direct form (calling the parser) which runs its sub parsers by
+  recursion like parsec does, this is the fast one,
+- the step form (Parser.steps), a generator that yields the
+  (sub parser, index) that it needs to run and gets their results back.
+
+run() drives the step forms with an explicit stack so that the nesting
+depth of what is parsed is only limited by the memory (and not by the
+interpreter stack).
+Parsers without step form (the leaves: string, regex, ... or plain parsec
+parsers) are called directly.
+
+The parsers made by generate and stepped are the named productions of the
+grammar, profiling() measures them.
+
+mark locates the (line, col) of what it parses with the line index of the
+text (see lineindex).
+"""
+# pylint: disable=invalid-name
+import contextlib
+import json
+import time
+import weakref
+import parsec
+from parsec import Value, ParseError
+from lineindex import line_index
+
+__all__ = [
+    "Parser", "Value", "ParseError", "run", "stepped", "generate", "string", "regex",
+    "eof", "success_with", "fail_with", "try_choices", "optional", "times", "many",
+    "many1", "separated", "sepBy", "sepBy1", "exclude", "ends_with", "mark",
+    "Profile", "profiling"]
+
+
+class Parser(parsec.Parser):
+    """A parsec parser that may have a step form"""
+
+    def __init__(self, fn, steps=None):
+        super().__init__(fn)
+        self.steps = steps
+
+    def try_choice(self, other):
+        """(^) Choice with backtrack"""
+        def try_choice_parser(text, index):
+            res = self(text, index)
+            return res if res.status else other(text, index)
+
+        def try_choice_steps(text, index):
+            res = yield self, index
+            if res.status:
+                return res
+            return (yield other, index)
+
+        return Parser(try_choice_parser, try_choice_steps)
+
+    def choice(self, other):
+        """(|) Choice, the other parser is only tried if this one did not consume"""
+        def choice_parser(text, index):
+            res = self(text, index)
+            return res if res.status or res.index != index else other(text, index)
+
+        def choice_steps(text, index):
+            res = yield self, index
+            if res.status or res.index != index:
+                return res
+            return (yield other, index)
+
+        return Parser(choice_parser, choice_steps)
+
+    def compose(self, other):
+        """(>>) Sequence, keeping the value of the other parser"""
+        def compose_parser(text, index):
+            res = self(text, index)
+            return res if not res.status else other(text, res.index)
+
+        def compose_steps(text, index):
+            res = yield self, index
+            if not res.status:
+                return res
+            return (yield other, res.index)
+
+        return Parser(compose_parser, compose_steps)
+
+    def ends_with(self, other):
+        """(<) Followed by what other parses (not consumed)"""
+        def ends_with_result(res, end):
+            if end.status:
+                return res
+            return Value.failure(end.index, f"ends with {end.expected}")
+
+        def ends_with_parser(text, index):
+            res = self(text, index)
+            if not res.status:
+                return res
+            return ends_with_result(res, other(text, res.index))
+
+        def ends_with_steps(text, index):
+            res = yield self, index
+            if not res.status:
+                return res
+            return ends_with_result(res, (yield other, res.index))
+
+        return Parser(ends_with_parser, ends_with_steps)
+
+    def bind(self, fn):
+        """(>=) Continue with the parser that fn makes of the value"""
+        args_count = parsec.expected_arguments(fn)
+        if not 1 <= args_count <= 2:
+            raise TypeError(f"can only bind on a function with one or two arguments, fn/{args_count}")
+
+        def bind_next(res, index):
+            return fn(res.value, index) if args_count == 2 else fn(res.value)
+
+        def bind_parser(text, index):
+            res = self(text, index)
+            if not res.status:
+                return res
+            return bind_next(res, index)(text, res.index)
+
+        def bind_steps(text, index):
+            res = yield self, index
+            if not res.status:
+                return res
+            return (yield bind_next(res, index), res.index)
+
+        return Parser(bind_parser, bind_steps)
+
+    def parsecmap(self, fn, star=False):
+        """Transform the value with fn"""
+        def parsecmap_parser(text, index):
+            res = self(text, index)
+            if not res.status:
+                return res
+            return Value.success(res.index, fn(*res.value) if star else fn(res.value))
+
+        def parsecmap_steps(text, index):
+            res = yield self, index
+            if not res.status:
+                return res
+            return Value.success(res.index, fn(*res.value) if star else fn(res.value))
+
+        return Parser(parsecmap_parser, parsecmap_steps)
+
+    def result(self, res):
+        """Give res as value"""
+        return self.parsecmap(lambda _: res)
+
+    def mark(self):
+        """Give the ((line, col), value, (line, col)) of what is parsed"""
+        return mark(self)
+
+
+def run(parser, text, index=0):
+    """Run parser at index, driving the step forms with an explicit stack"""
+    if getattr(parser, "steps", None) is None:
+        return parser(text, index)
+    stack = [parser.steps(text, index)]
+    res = None
+    while stack:
+        try:
+            parser, index = stack[-1].send(res)
+        except StopIteration as stop:
+            stack.pop()
+            res = stop.value
+            continue
+        steps = getattr(parser, "steps", None)
+        if steps is None:
+            res = parser(text, index)
+        else:
+            stack.append(steps(text, index))
+            res = None
+    return res
+
+
+def steps_parser(steps):
+    """Make a parser of a step form, the direct form runs the steps by recursion"""
+    def stepped_parser(text, index):
+        gen = steps(text, index)
+        try:
+            parser, at = next(gen)
+            while True:
+                parser, at = gen.send(parser(text, at))
+        except StopIteration as stop:
+            return stop.value
+
+    stepped_parser.__name__ = steps.__name__
+    return Parser(stepped_parser, steps)
+
+
+def stepped(steps):
+    """Make a production of a step form (see steps_parser)"""
+    return production(steps_parser(steps), steps.__name__)
+
+
+def generate(fn):
+    """Parser generator (as parsec's one, with a step form)"""
+    name = fn.__name__
+
+    def generated_end(endval, text, index):
+        # a parser returned by the generator finishes the parse
+        if isinstance(endval, parsec.Parser):
+            return endval(text, index)
+        return Value.success(index, endval)
+
+    def described(res, index):
+        # as parsec, a failure that did not consume is described by the name
+        if res.status or res.index != index:
+            return res
+        return Value.failure(index, name)
+
+    def generated(text, index):
+        start = index
+        iterator, value = fn(), None
+        try:
+            while True:
+                parser = iterator.send(value)
+                res = parser(text, index)
+                if not res.status:
+                    return described(res, start)
+                value, index = res.value, res.index
+        except StopIteration as stop:
+            return described(generated_end(stop.value, text, index), start)
+
+    def generated_steps(text, index):
+        start = index
+        iterator, value = fn(), None
+        while True:
+            try:
+                parser = iterator.send(value)
+            except StopIteration as stop:
+                endval = stop.value
+                if isinstance(endval, parsec.Parser):
+                    return described((yield endval, index), start)
+                return Value.success(index, endval)
+            res = yield parser, index
+            if not res.status:
+                return described(res, start)
+            value, index = res.value, res.index
+
+    generated.__name__ = name
+    generated.__doc__ = fn.__doc__
+    return production(Parser(generated, generated_steps), name)
+
+
+def leaf(make):
+    """Make a parsec leaf parser factory give parsers of this module"""
+    def make_leaf(*args, **kwargs):
+        return Parser(make(*args, **kwargs).fn)
+
+    make_leaf.__name__ = make.__name__
+    make_leaf.__doc__ = make.__doc__
+    return make_leaf
+
+
+string = leaf(parsec.string)
+regex = leaf(parsec.regex)
+eof = leaf(parsec.eof)
+success_with = leaf(parsec.success_with)
+fail_with = leaf(parsec.fail_with)
+
+
+# ###### PROFILING
+# the productions (parsers of generate and stepped) and the running profile
+_productions = weakref.WeakSet()
+_profile = None
+
+
+class Profile:
+    """Per production statistics of the parses run while profiling"""
+
+    FIELDS = ("calls", "successes", "failures", "backtracks", "consumed", "cumulative", "self")
+
+    def __init__(self):
+        # name: [calls, successes, failures, backtracks (failures after
+        # consuming), characters consumed, cumulative time, self time]
+        self.stats = {}
+        # [name, start time, time in the sub productions] of the running ones
+        self.frames = []
+        # name: how many times it is running (cumulative time is only
+        # counted for the outermost call of a recursive production)
+        self.depths = {}
+
+    def enter(self, name):
+        """A production starts"""
+        self.depths[name] = self.depths.get(name, 0) + 1
+        self.frames.append([name, time.perf_counter(), 0.0])
+
+    def leave(self, res, index):
+        """The running production (that started at index) gives res"""
+        name, start, inner = self.frames.pop()
+        elapsed = time.perf_counter() - start
+        stats = self.stats.get(name)
+        if stats is None:
+            stats = self.stats[name] = [0, 0, 0, 0, 0, 0.0, 0.0]
+        stats[0] += 1
+        if res.status:
+            stats[1] += 1
+            stats[4] += res.index - index
+        else:
+            stats[2] += 1
+            stats[3] += res.index != index
+        self.depths[name] -= 1
+        if not self.depths[name]:
+            stats[5] += elapsed
+        stats[6] += elapsed - inner
+        if self.frames:
+            self.frames[-1][2] += elapsed
+        return res
+
+    def abort(self):
+        """The running production raised"""
+        self.depths[self.frames.pop()[0]] -= 1
+
+    def measure(self, name, fn):
+        """Measured direct form of a production"""
+        def measured(text, index):
+            self.enter(name)
+            try:
+                res = fn(text, index)
+            except BaseException:
+                self.abort()
+                raise
+            return self.leave(res, index)
+
+        measured.__name__ = name
+        return measured
+
+    def measure_steps(self, name, steps):
+        """Measured step form of a production"""
+        def measured_steps(text, index):
+            self.enter(name)
+            try:
+                res = yield from steps(text, index)
+            except BaseException:
+                self.abort()
+                raise
+            return self.leave(res, index)
+
+        return measured_steps
+
+    def results(self, sort="self"):
+        """{name: {field: value}} sorted by decreasing sort field"""
+        column = self.FIELDS.index(sort)
+        ordered = sorted(self.stats.items(), key=lambda item: -item[1][column])
+        return {name: dict(zip(self.FIELDS, stats)) for name, stats in ordered}
+
+    def json(self, sort="self"):
+        """The results as json"""
+        return json.dumps(self.results(sort), indent=1)
+
+    def table(self, sort="self", limit=None):
+        """The results as a text table (of the limit first productions)"""
+        total = sum(stats[6] for stats in self.stats.values()) or 1.0
+        lines = [f"{'production':<32}{'calls':>10}{'success':>10}{'fail':>10}{'backtr':>10}"
+                 f"{'consumed':>11}{'cumul ms':>11}{'self ms':>11}{'self %':>8}"]
+        for name, res in list(self.results(sort).items())[:limit]:
+            lines.append(
+                f"{name:<32}{res['calls']:>10}{res['successes']:>10}{res['failures']:>10}"
+                f"{res['backtracks']:>10}{res['consumed']:>11}{res['cumulative'] * 1000:>11.1f}"
+                f"{res['self'] * 1000:>11.1f}{res['self'] * 100 / total:>8.1f}")
+        return "\n".join(lines)
+
+
+def measure(parser, name):
+    """Make a production measured by the running profile"""
+    parser.unprofiled = (parser.fn, parser.steps)
+    parser.fn = _profile.measure(name, parser.fn)
+    if parser.steps is not None:
+        parser.steps = _profile.measure_steps(name, parser.steps)
+
+
+def production(parser, name):
+    """Register a parser as the production name"""
+    parser.name = name
+    _productions.add(parser)
+    if _profile is not None:
+        measure(parser, name)
+    return parser
+
+
+@contextlib.contextmanager
+def profiling():
+    """Measure the productions while the with block runs, gives its Profile"""
+    global _profile  # pylint: disable=global-statement
+    if _profile is not None:
+        raise RuntimeError("already profiling")
+    _profile = Profile()
+    for parser in list(_productions):
+        measure(parser, parser.name)
+    try:
+        yield _profile
+    finally:
+        for parser in list(_productions):
+            parser.fn, parser.steps = parser.unprofiled
+            del parser.unprofiled
+        _profile = None
+
+
+def try_choices(*choices):
+    """Choose one of the choices (^)"""
+    ret = choices[0]
+    for choice in choices[1:]:
+        ret = ret ^ choice
+    return ret
+
+
+def optional(p, default_value=None):
+    """Optional p, default_value if it fails"""
+    def optional_result(res, index):
+        if res.status:
+            return res
+        return Value.success(index, default_value)
+
+    def optional_parser(text, index):
+        return optional_result(p(text, index), index)
+
+    def optional_steps(text, index):
+        return optional_result((yield p, index), index)
+
+    return Parser(optional_parser, optional_steps)
+
+
+def times(p, mint, maxt=None):
+    """Repeat p between mint and maxt times (as much as possible)"""
+    maxt = maxt if maxt else mint
+
+    def times_steps(text, index):
+        # (same as parsec's times)
+        cnt, values, res = 0, [], None
+        while cnt < maxt:
+            res = yield p, index
+            if res.status:
+                if maxt == float("inf") and res.index == index:
+                    break
+                values.append(res.value)
+                index, cnt = res.index, cnt + 1
+            else:
+                if cnt >= mint:
+                    break
+                return res
+            if cnt >= maxt:
+                break
+            if index >= len(text):
+                if cnt >= mint:
+                    break
+                r = yield p, index
+                if index != r.index:
+                    return Value.failure(index, "already meets the end, no enough text")
+        return Value.success(index, values)
+
+    return steps_parser(times_steps)
+
+
+def many(p):
+    """Repeat p 0 to infinity times"""
+    return times(p, 0, float("inf"))
+
+
+def many1(p):
+    """Repeat p 1 to infinity times"""
+    return times(p, 1, float("inf"))
+
+
+def separated(p, sep, mint, maxt=None, end=None):
+    """Repeat p separated by sep between mint and maxt times (as parsec's one)"""
+    maxt = maxt if maxt else mint
+
+    def separated_steps(text, index):
+        cnt, values_index, values, res = 0, index, [], None
+        while cnt < maxt:
+            res = yield p, index
+            if res.status:
+                current_value_index = res.index
+                current_value = res.value
+                index, cnt = res.index, cnt + 1
+            else:
+                if cnt < mint:
+                    return res
+                return Value.success(values_index, values)
+
+            # consume the sep
+            res = yield sep, index
+            if res.status:
+                index = res.index
+                if end in [True, None]:
+                    current_value_index = res.index
+            else:
+                if cnt < mint or (cnt == mint and end is True):
+                    return res
+                if end is True:
+                    return Value.success(values_index, values)
+                values_index = current_value_index
+                values.append(current_value)
+                return Value.success(values_index, values)
+
+            values_index = current_value_index
+            values.append(current_value)
+        return Value.success(values_index, values)
+
+    def separated_parser(text, index):
+        # the direct form of the steps, written out as it is hot
+        cnt, values_index, values, res = 0, index, [], None
+        while cnt < maxt:
+            res = p(text, index)
+            if res.status:
+                current_value_index = res.index
+                current_value = res.value
+                index, cnt = res.index, cnt + 1
+            else:
+                if cnt < mint:
+                    return res
+                return Value.success(values_index, values)
+
+            res = sep(text, index)
+            if res.status:
+                index = res.index
+                if end in [True, None]:
+                    current_value_index = res.index
+            else:
+                if cnt < mint or (cnt == mint and end is True):
+                    return res
+                if end is True:
+                    return Value.success(values_index, values)
+                values_index = current_value_index
+                values.append(current_value)
+                return Value.success(values_index, values)
+
+            values_index = current_value_index
+            values.append(current_value)
+        return Value.success(values_index, values)
+
+    return Parser(separated_parser, separated_steps)
+
+
+def sepBy(p, sep):
+    """Zero or more p separated by sep"""
+    return separated(p, sep, 0, maxt=float("inf"), end=False)
+
+
+def sepBy1(p, sep):
+    """One or more p separated by sep"""
+    return separated(p, sep, 1, maxt=float("inf"), end=False)
+
+
+def exclude(p, excluded):
+    """p if excluded does not match"""
+    def exclude_parser(text, index):
+        res = excluded(text, index)
+        if res.status:
+            return Value.failure(index, f"something other than {res.value}")
+        return p(text, index)
+
+    def exclude_steps(text, index):
+        res = yield excluded, index
+        if res.status:
+            return Value.failure(index, f"something other than {res.value}")
+        return (yield p, index)
+
+    return Parser(exclude_parser, exclude_steps)
+
+
+def ends_with(pa, pb):
+    """pa followed by what pb parses (<)"""
+    return pa.ends_with(pb)
+
+
+def mark(p):
+    """Give the ((line, col), value, (line, col)) of what p parses"""
+    def marked(res, text, index):
+        if not res.status:
+            return res
+        lines = line_index(text)
+        return Value.success(res.index, (lines.position(index), res.value, lines.position(res.index)))
+
+    def mark_parser(text, index):
+        return marked(p(text, index), text, index)
+
+    def mark_steps(text, index):
+        return marked((yield p, index), text, index)
+
+    return Parser(mark_parser, mark_steps)
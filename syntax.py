@@ -37,6 +37,7 @@ NAMED_ARGUMENT = "NAMED_ARGUMENT"
 NUMBER = "NUMBER"
 OPERATOR = "OPERATOR"
 PATH_NAME = "PATH_NAME"
+PARSE_ERROR = "PARSE_ERROR"
 PARAMETERS_DEF = "PARAMETERS_DEF"
 PARAMETERS_HANDLER = "PARAMETERS_HANDLER"
 PERSISTENTGLOBAL = "PERSISTENTGLOBAL"
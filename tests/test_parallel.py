@@ -0,0 +1,60 @@
+"""
+ParallelFile against file: the statements parsed by chunks in the worker
+processes, stitched together, must give the value of file.
+"""
+import unittest
+
+import mxsp
+
+# statements going on over lines that start with a word, where chunk_bounds
+# may cut in the middle of a statement
+SOURCES = {
+    "continued lines": "\n".join(
+        f"x{i} = a +\nb{i}\nif c{i} then\nprint {i}\nelse\nprint 0\nfn f{i} a =\n(\na + {i}\n)"
+        for i in range(12)),
+    "blocks": "\n".join(
+        f"for i in 1 to {i} do\n(\nk = i * 2\nprint k\n)\nwhile k > {i} do\nk -= 1"
+        for i in range(12)),
+    "mixed": "\n".join(
+        f"struct S{i} ( v = {i}, fn m = v )\ncase x of\n(\n1: print 1\ndefault: print 2\n)\n"
+        f"try (f {i}) catch (print \"e\")\ny = #(1, 2,\n3)"
+        for i in range(12)),
+}
+
+CHUNK_SIZES = [20, 60, 200]
+
+
+def value_signature(value):
+    """The positions and tree of a file value (the trees compare by str)"""
+    start, tree, end = value
+    return start, str(tree), end
+
+
+class ParallelFileTest(unittest.TestCase):
+    """ParallelFile gives the value of file"""
+
+    def test_sources(self):
+        for name, text in SOURCES.items():
+            expected = value_signature(mxsp.file.parse(text))
+            for size in CHUNK_SIZES:
+                with self.subTest(name, chunk_size=size):
+                    self.assertGreater(len(mxsp.chunk_bounds(text, size)), 1)
+                    parsed = mxsp.ParallelFile(workers=2, chunk_size=size).parse(text)
+                    self.assertEqual(value_signature(parsed), expected)
+
+    def test_cuts_in_statements(self):
+        # the stitching parses the statements that the chunks cut
+        text = SOURCES["continued lines"]
+        with mxsp.parse_tables(text):
+            starts = {statement[0] for statement in mxsp.top_level_statements(text, 0)}
+        cuts = {start for start, _ in mxsp.chunk_bounds(text, 20)}
+        self.assertTrue(cuts - starts)
+
+    def test_single_worker(self):
+        text = SOURCES["mixed"]
+        parsed = mxsp.ParallelFile(workers=1, chunk_size=20).parse(text)
+        self.assertEqual(value_signature(parsed), value_signature(mxsp.file.parse(text)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,79 @@
+"""
+The fused preprocess against preprocess_sequential: both must leave the
+same tree.
+"""
+import unittest
+
+import mxscp
+import mxsp
+import pytreeprocess
+import syntax
+
+SNIPPETS = {
+    "byref in an assignment": "fn f a = ( x = foo (bar &y; 1) &z; x )",
+    "byref statements": "fn g a = ( foo (bar &y; baz &w) &z )",
+    "byref of a local": "fn h a = ( local q; q = foo &q )",
+    "byref in a subscript": "fn o = ( a[(foo &x; 1)] = bar &y )",
+    "nested byref": "fn q = ( foo (x = bar (baz &u; 2) &v; 1) &w; y = (if a then b &c else d); 2 as float )",
+    "byref in a try": "fn r = ( try (foo &a) catch (); z = foo &b )",
+    "byref in blocks": "fn s = ( (foo &k; (bar &l)) )",
+    "struct method": "struct T ( fn m = ( r = g &h ) )",
+    "references": "x = &y\nfn u = ( z = &x; *z )",
+    "as": "fn k = ( r = 3 as string; r as integer )",
+    "last value": "fn v a = ( b = a + 1 )\nfn w a = ( a * 2 )",
+    "try as the last value": "fn m = ( try (1) catch (2) )",
+    "try and if in an expression": "fn n = ( x = (try (1) catch (2)) + (if a then 1 else 2); x )",
+    "try in an if in an expression": "fn t a = ( v = 1 + (if a then (try (foo &a) catch (0)) else 2); v )",
+    "macroscripts": 'macroscript A category:"x" ( on execute do print 1 )\n'
+        'macroscript B category:"x" ( on execute do print (2 as string) )',
+    "rollout": 'rollout R "r" ( button b "b"\n on b pressed do ( foo &b ) )',
+    "in a function": 'fn p = ( macroscript C category:"y" ( print 3 ) ; rollout S "s" ( ) ; 1 as string )',
+    "plugin": 'plugin simpleObject P name:"p" classID:#(1,2) '
+        '( parameters main ( a type:#float ) on buildMesh do ( x = 1 as string ) )',
+    "attributes": "ca = attributes A ( parameters main ( b type:#integer ) )",
+}
+
+
+def tree_signature(tree):
+    """What the output of a processed tree depends on (to compare trees)"""
+    if isinstance(tree, syntax.Construct):
+        return (tree.construct,
+            getattr(tree, "resolution", None),
+            hasattr(tree, "mark_for_local_declaration"),
+            tuple(tree_signature(arg) for arg in tree.args))
+    if isinstance(tree, (list, tuple)):
+        return (type(tree).__name__,) + tuple(tree_signature(item) for item in tree)
+    return tree
+
+
+class PreprocessTest(unittest.TestCase):
+    """preprocess gives the tree of preprocess_sequential"""
+
+    def test_snippets(self):
+        for name, src in SNIPPETS.items():
+            with self.subTest(name):
+                (_, tree, _), errors = mxsp.parse_recovering(mxscp.scan(src).stripped)
+                self.assertEqual(errors, [])
+                fused, sequential = mxsp.copy_tree(tree), mxsp.copy_tree(tree)
+                pytreeprocess.preprocess(fused)
+                pytreeprocess.preprocess_sequential(sequential)
+                self.assertEqual(tree_signature(fused), tree_signature(sequential))
+
+    def test_kinds_created_in_a_traversal(self):
+        # a rewrite sees the kinds that the rewrites before it in the
+        # traversal create, though the tree had none of them
+        tree = mxsp.file.parse("x = y")[1]
+        strings = []
+
+        def to_string(item):
+            item.construct.construct = syntax.STRING
+            pytreeprocess.add_to_index(item, item.construct)
+
+        pytreeprocess.run_steps(tree, [
+            pytreeprocess.Rewrite(pytreeprocess.Pattern([syntax.VAR_NAME]), to_string),
+            pytreeprocess.Rewrite(pytreeprocess.Pattern([syntax.STRING]), strings.append)])
+        self.assertEqual(len(strings), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+"""
+Stress test of the STACKLESS parsing mode: sources nested deeper than the
+interpreter stack allows parse to the end, without raising the recursion
+limit.
+"""
+import sys
+import unittest
+
+import mxsp
+
+DEPTH = 5000
+
+# lower than what the recursive parse of DEPTH levels needs
+RECURSION_LIMIT = 1000
+
+
+class StacklessTest(unittest.TestCase):
+    """Parse nested sources with mxsp.STACKLESS"""
+
+    def setUp(self):
+        self.limit, self.stackless = sys.getrecursionlimit(), mxsp.STACKLESS
+        sys.setrecursionlimit(RECURSION_LIMIT)
+        mxsp.STACKLESS = True
+
+    def tearDown(self):
+        mxsp.STACKLESS = self.stackless
+        sys.setrecursionlimit(self.limit)
+
+    def assert_parsed(self, src):
+        """src parses as a file, to its end"""
+        rest = mxsp.file.parse_partial(src)[1]
+        self.assertEqual(len(rest), 0, f"{len(rest)} characters left unparsed")
+
+    def test_parens(self):
+        self.assert_parsed("x = " + "(" * DEPTH + "a" + ")" * DEPTH)
+
+    def test_if_else_chain(self):
+        self.assert_parsed("if a then b " + "else if a then b " * DEPTH)
+
+    def test_nested_if(self):
+        self.assert_parsed("if a then (" * DEPTH + "b" + ")" * DEPTH)
+
+    def test_calls(self):
+        self.assert_parsed("f (" * DEPTH + "x" + ")" * DEPTH)
+
+    def test_arrays(self):
+        self.assert_parsed("x = " + "#(" * DEPTH + ")" * DEPTH)
+
+    def test_fn_bodies(self):
+        self.assert_parsed("fn f = (\n" * DEPTH + "1" + "\n)" * DEPTH)
+
+    def test_recursive_mode_fails(self):
+        # what the STACKLESS mode is for
+        mxsp.STACKLESS = False
+        with self.assertRaises(RecursionError):
+            mxsp.file.parse_partial("x = " + "(" * DEPTH + "a" + ")" * DEPTH)
+
+
+if __name__ == "__main__":
+    unittest.main()